@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+''' Share rooms between servers (nodes) running on different machines
+
+Every node publishes the events of its rooms on the backplane: messages broadcast to a room,
+history appended to it and users joining or leaving it. Other nodes deliver these events to
+their own users in the same room only, so a room can have members on any number of nodes:
+
+	python backplane.py --port 42100  # broker, on any machine the nodes can reach
+
+	from backplane import SocketBackplane
+	Server(port=42069, backplane=SocketBackplane("192.168.1.10", 42100)).run()
+
+MemoryBackplane connects servers running in the same process (for testing), the broker
+of SocketBackplane stands in for a real message broker.
+
+Events are dicts with "kind" ("broadcast", "history", "presence", "hello" or "gone"), the
+"node" that published them and the "room" they belong to.
+
+'''
+
+import argparse
+import asyncio
+import codec
+import uuid
+
+
+class Backplane:
+
+	def __init__(self, node=None):
+		''' Base class of backplanes, "node" is a unique name of this server (random by default) '''
+		self.node = node if node else uuid.uuid4().hex[:12]
+		self.task = None  # delivers events, finishes with an exception if the connection is lost
+		self.published = 0
+		self.received = 0
+
+	async def start(self, handler):
+		''' Start delivering events of other nodes to "await handler(event)", in the order they were published '''
+		raise NotImplementedError
+
+	def publish(self, event):
+		''' Send event to every other node, without waiting (events are dropped once closed) '''
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+	async def wait(self):
+		''' Wait until the backplane is closed or its connection is lost '''
+		if self.task:
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+
+	def stats(self):
+		''' Return number of events published and received '''
+		return {"node": self.node, "published": self.published, "received": self.received}
+
+
+class MemoryBackplane(Backplane):
+
+	HUB = []  # backplanes of the same process share this list, unless they are given their own
+
+	def __init__(self, hub=None, node=None):
+		''' Backplane between servers running in the same process '''
+		super().__init__(node)
+		self.hub = self.HUB if hub is None else hub
+		self.queue = None
+
+	async def start(self, handler):
+		self.queue = asyncio.Queue()
+		self.hub.append(self)
+		self.task = asyncio.ensure_future(self._run(handler))
+
+	def publish(self, event):
+		if self not in self.hub:
+			return
+		event = {**event, "node": self.node}
+		self.published += 1
+		for other in self.hub:
+			if other is not self:
+				other.queue.put_nowait(event)
+
+	def close(self):
+		if self in self.hub:
+			self.publish({"kind": "gone"})
+			self.hub.remove(self)
+			self.task.cancel()
+
+	async def _run(self, handler):
+		while True:
+			event = await self.queue.get()
+			self.received += 1
+			await handler(event)
+
+
+class SocketBackplane(Backplane):
+
+	LIMIT = 2 ** 24  # longest event in bytes
+
+	def __init__(self, host="127.0.0.1", port=42100, node=None):
+		''' Backplane through the broker at host:port (see serve()), events are sent as lines of JSON '''
+		super().__init__(node)
+		self.host = host
+		self.port = port
+		self.writer = None
+
+	async def start(self, handler):
+		reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=self.LIMIT)
+		self.task = asyncio.ensure_future(self._run(reader, handler))
+
+	def publish(self, event):
+		if self.writer is None:
+			return
+		self.published += 1
+		self.writer.write(codec.dumpb({**event, "node": self.node}) + b"\n")
+
+	def close(self):
+		if self.writer:
+			self.writer.close()
+			self.task.cancel()
+			self.writer = None
+
+	async def _run(self, reader, handler):
+		while True:
+			line = await reader.readline()
+			if not line:
+				raise ConnectionError(f"backplane broker at {self.host}:{self.port} closed the connection")
+			self.received += 1
+			await handler(codec.loads(line))
+
+
+class Broker:
+
+	def __init__(self):
+		''' Forward every line received from a node to all other nodes, tell them when a node is gone '''
+		self.nodes = {}  # writer: node name (from the first event it published)
+
+	async def handle(self, reader, writer):
+		self.nodes[writer] = None
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				if self.nodes[writer] is None:
+					self.nodes[writer] = codec.loads(line).get("node")
+				for other in self.nodes:
+					if other is not writer:
+						other.write(line)
+		except (ConnectionError, ValueError):
+			pass
+		finally:
+			node = self.nodes.pop(writer)
+			writer.close()
+			if node is not None:
+				line = codec.dumpb({"kind": "gone", "node": node}) + b"\n"
+				for other in self.nodes:
+					other.write(line)
+
+
+async def serve(host="127.0.0.1", port=42100):
+	''' Run a broker until cancelled '''
+	server = await asyncio.start_server(Broker().handle, host, port, limit=SocketBackplane.LIMIT)
+	print(f"Backplane broker at {host}:{port}")
+	async with server:
+		await server.serve_forever()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run a backplane broker for servers sharing rooms.")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=42100)
+	args = parser.parse_args()
+	try:
+		asyncio.run(serve(args.host, args.port))
+	except KeyboardInterrupt:
+		pass
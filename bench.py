@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+''' Microbenchmarks of the functions that run for every message
+
+	python bench.py --save before.json
+	python bench.py --compare before.json  # after making changes
+	python bench.py --filter headsets
+
+For every benchmark the number of operations a second is reported, along with the
+peak memory allocated by a single operation and the number of memory blocks it keeps.
+Frames queued by the server are encoded (like the writer task would) and cleared after
+every operation, so sending is included in the cost.
+
+'''
+
+import argparse
+import asyncio
+import codec
+import contextlib
+import io
+import json
+import random
+import sys
+import timeit
+import tracemalloc
+import wire
+from server import Server
+
+ROOM_SIZES = (1, 10, 50)
+HISTORY = 50
+
+MESSAGES = {
+	"msg": {"room": "lobby", "type": "msg", "data": "Hello, I would like to cooperate this round."},
+	"button": {"room": "lobby", "type": "button", "data": "cooperate"},
+	"transform": {"room": "lobby", "type": "transform", "data": {
+		"pos": {"x": 1.2345678, "y": 1.6543210, "z": -0.9876543},
+		"rot": {"x": 12.345678, "y": 187.65432, "z": -3.2109876}
+	}}
+}
+
+
+class Connection:
+
+	remote_address = ("127.0.0.1", 0)
+
+	async def send(self, data):
+		pass
+
+	async def close(self, code=1000, reason=""):
+		pass
+
+
+def run(coro):
+	''' Run a coroutine that never has to wait, without the overhead of an event loop '''
+	try:
+		coro.send(None)
+	except StopIteration as e:
+		return e.value
+	raise RuntimeError("coroutine was suspended")
+
+
+def drain(server):
+	''' Encode every queued frame once (as the writer tasks would), then clear the queues '''
+	for state in server.users.values():
+		for frame in state.outbox.frames:
+			frame.data
+		state.outbox.frames.clear()
+
+
+def room(size, seed=0, **options):
+	''' Return a server with "size" logged in users in the lobby, with a full history (options are passed to Server) '''
+	with contextlib.redirect_stdout(io.StringIO()):
+		server = Server(ip="127.0.0.1", log_level=0, **options)
+	server.log_level = -1
+	rng = random.Random(seed)
+	for i in range(size):
+		user = Connection()
+		server.connect(user)
+		server.users[user].auth = True
+		server.rename(user, f"user_{i}")
+		run(server.join(user, Server.DEFAULT_ROOM))
+	for i in range(HISTORY):
+		server.history(Server.DEFAULT_ROOM, server._validate_out({**MESSAGES["msg"], "user": f"user_{rng.randrange(size)}"}))
+	drain(server)
+	return server
+
+
+def move(server, rng):
+	''' Give every user in the lobby a new transform '''
+	for user in server.rooms[Server.DEFAULT_ROOM].users:
+		server.transform(user, Server.DEFAULT_ROOM, {
+			"pos": {"x": rng.uniform(-10, 10), "y": 1.6, "z": rng.uniform(-10, 10)},
+			"rot": {"x": 0.0, "y": rng.uniform(-180, 180), "z": 0.0}
+		})
+
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+	''' Register a function returning the operation to measure '''
+	def register(setup):
+		BENCHMARKS[name] = setup
+		return setup
+	return register
+
+
+for name, backend in codec.available().items():
+	for kind, message in MESSAGES.items():
+		encoded = backend.dumps(message)
+
+		benchmark(f"{name}.loads {kind}")(lambda backend=backend, encoded=encoded: lambda: backend.loads(encoded))
+		benchmark(f"{name}.dumps {kind}")(lambda backend=backend, message=message: lambda: backend.dumps(message))
+		benchmark(f"{name}.dumpb {kind}")(lambda backend=backend, message=message: lambda: backend.dumpb(message))
+
+for kind, message in MESSAGES.items():
+	benchmark(f"_validate_in {kind}")(lambda message=message: lambda: Server._validate_in(message))
+	benchmark(f"_validate_out {kind}")(lambda message=message: lambda: Server._validate_out({"user": "user_0", **message}))
+
+
+@benchmark("_validate_transform")
+def _():
+	return lambda: Server._validate_transform(codec.loads(codec.dumps(MESSAGES["transform"])))
+
+
+@benchmark("ingest transform")
+def _():
+	server = room(1, transform_rate=0)
+	user = next(iter(server.users))
+	encoded = codec.dumps(MESSAGES["transform"])
+	return lambda: run(server.ingest(user, codec.loads(encoded)))
+
+
+@benchmark("ingest transform rate limited")
+def _():
+	server = room(1)
+	user = next(iter(server.users))
+	encoded = codec.dumps(MESSAGES["transform"])
+	return lambda: run(server.ingest(user, codec.loads(encoded)))
+
+
+@benchmark("receive binary transform")
+def _():
+	server = room(1, transform_rate=0)
+	user = next(iter(server.users))
+	encoded = wire.pack_transform(0, MESSAGES["transform"]["data"], "float32")
+	return lambda: run(server.receive_transform(user, encoded))
+
+
+@benchmark("system pong")
+def _():
+	server = room(1)
+	user = next(iter(server.users))
+	return lambda: (run(server.system(user, 220)), drain(server))
+
+
+@benchmark("system with detail")
+def _():
+	server = room(1)
+	user = next(iter(server.users))
+	return lambda: (run(server.system(user, 212, detail={"lobby": "Lobby"})), drain(server))
+
+
+for size in ROOM_SIZES:
+
+	@benchmark(f"_create_payload {size} transforms")
+	def _(size=size):
+		server = room(1)
+		payload = [{"user": f"user_{i}", "type": "transform", "data": MESSAGES["transform"]["data"]} for i in range(size)]
+		return lambda: server._create_payload(Server.DEFAULT_ROOM, payload)
+
+	@benchmark(f"history append ({size} users)")
+	def _(size=size):
+		server = room(size)
+		payload = server._validate_out({**MESSAGES["msg"], "user": "user_0"})
+		return lambda: server.history(Server.DEFAULT_ROOM, payload)
+
+	@benchmark(f"list_users {size} users")
+	def _(size=size):
+		server = room(size)
+		user = next(iter(server.users))
+		return lambda: (run(server.list_users(user, Server.DEFAULT_ROOM)), drain(server))
+
+	@benchmark(f"broadcast msg to {size} users")
+	def _(size=size):
+		server = room(size)
+		payload = server._validate_out({**MESSAGES["msg"], "user": "user_0"})
+		return lambda: (run(server.broadcast(Server.DEFAULT_ROOM, payload)), drain(server))
+
+	@benchmark(f"broadcast 10 buttons to {size} users")
+	def _(size=size):
+		server = room(size)
+		payload = server._validate_out({**MESSAGES["button"], "user": "user_0"})
+		return lambda: ([run(server.broadcast(Server.DEFAULT_ROOM, payload)) for i in range(10)], drain(server))
+
+	@benchmark(f"broadcast 10 buttons to {size} users coalesced")
+	def _(size=size):
+		server = room(size, coalesce=1.0)
+		payload = server._validate_out({**MESSAGES["button"], "user": "user_0"})
+		return lambda: ([run(server.broadcast(Server.DEFAULT_ROOM, payload)) for i in range(10)], run(server.flush(Server.DEFAULT_ROOM)), drain(server))
+
+	@benchmark(f"headsets {size} users moving")
+	def _(size=size):
+		server = room(size)
+		rng = random.Random(size)
+		return lambda: (move(server, rng), run(server.headsets()), drain(server))
+
+	@benchmark(f"headsets {size} users idle")
+	def _(size=size):
+		server = room(size)
+		run(server.headsets())
+		drain(server)
+		return lambda: (run(server.headsets()), drain(server))
+
+
+def measure(operation, seconds=0.5, repeat=3, overhead=0):
+	''' Return ops/sec (best of "repeat" runs), peak bytes allocated by one operation and blocks kept by it '''
+	timer = timeit.Timer(operation)
+	number, elapsed = timer.autorange()
+	number = max(1, int(number * seconds / max(elapsed, 1e-9)))
+	best = min(timer.repeat(repeat=repeat, number=number))
+	operation()  # warm up caches before tracing memory
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	blocks = sys.getallocatedblocks()
+	operation()
+	kept = sys.getallocatedblocks() - blocks - overhead
+	peak = tracemalloc.get_traced_memory()[1] - before
+	tracemalloc.stop()
+	return {"ops": number / best, "peak_bytes": peak, "blocks": kept}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Microbenchmarks of the server's message path.")
+	parser.add_argument("--filter", default="", help="only run benchmarks containing this text")
+	parser.add_argument("--seconds", type=float, default=0.5, help="time to spend on a single run of a benchmark")
+	parser.add_argument("--save", default="", help="save results as JSON")
+	parser.add_argument("--compare", default="", help="compare results to a JSON file saved earlier")
+	args = parser.parse_args()
+
+	asyncio.set_event_loop(asyncio.new_event_loop())  # writer tasks are created, but never run
+	baseline = {}
+	if args.compare:
+		with open(args.compare, encoding="utf-8") as f:
+			baseline = json.load(f)["results"]
+
+	overhead = measure(lambda: None, 0.01)["blocks"]  # blocks kept by measuring itself
+	results = {}
+	for name, setup in BENCHMARKS.items():
+		if args.filter not in name:
+			continue
+		results[name] = measure(setup(), args.seconds, overhead=overhead)
+		line = f"{name:<40} {results[name]['ops']:>14,.0f} ops/s {results[name]['peak_bytes']:>10,} B peak {results[name]['blocks']:>6} blocks"
+		if name in baseline:
+			line += f"  {results[name]['ops'] / baseline[name]['ops']:>6.2f}x"
+		print(line)
+
+	if args.save:
+		with open(args.save, "w", encoding="utf-8") as f:
+			json.dump({"python": sys.version, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+''' JSON encoding and decoding with the fastest library installed
+
+Backends are tried in order of BACKENDS: orjson, msgspec, ujson, then the json module
+of the standard library (always available). Set the JSON_CODEC environment variable,
+or call use() before starting the server, to pick one:
+
+	import codec
+	codec.use("json")
+	codec.loads('{"system": "ping"}')  # str or bytes
+	codec.current.name  # "json"
+	codec.dumps({"system": "ping"})  # str, for text frames
+	codec.dumpb({"system": "ping"})  # UTF-8 bytes, no str in between for libraries that produce bytes
+
+Every backend raises one of codec.DecodeError on malformed input.
+
+'''
+
+import os
+
+
+class Codec:
+
+	__slots__ = ("name", "loads", "dumps", "dumpb", "errors")
+
+	def __init__(self, name, loads, dumps, dumpb, errors):
+		self.name = name
+		self.loads = loads
+		self.dumps = dumps
+		self.dumpb = dumpb
+		self.errors = errors
+
+
+def _orjson():
+	import orjson
+	option = orjson.OPT_NON_STR_KEYS  # id tables are keyed by int
+
+	def dumpb(obj):
+		return orjson.dumps(obj, option=option)
+
+	return Codec("orjson", orjson.loads, lambda obj: dumpb(obj).decode(), dumpb, (orjson.JSONDecodeError,))
+
+
+def _msgspec():
+	import msgspec
+	encoder = msgspec.json.Encoder()
+	decoder = msgspec.json.Decoder()
+	return Codec("msgspec", decoder.decode, lambda obj: encoder.encode(obj).decode(), encoder.encode, (msgspec.DecodeError, UnicodeDecodeError))
+
+
+def _ujson():
+	import ujson
+	return Codec("ujson", ujson.loads, ujson.dumps, lambda obj: ujson.dumps(obj).encode(), (ValueError,))
+
+
+def _json():
+	import json
+	return Codec("json", json.loads, json.dumps, lambda obj: json.dumps(obj).encode(), (ValueError,))
+
+
+BACKENDS = {
+	"orjson": _orjson,
+	"msgspec": _msgspec,
+	"ujson": _ujson,
+	"json": _json
+}
+
+
+def available():
+	''' Return a Codec for every backend that can be imported '''
+	result = {}
+	for name, backend in BACKENDS.items():
+		try:
+			result[name] = backend()
+		except ImportError:
+			pass
+	return result
+
+
+def select(name=""):
+	''' Return the Codec of backend "name", or of the first one installed if no name was given '''
+	if name:
+		if name not in BACKENDS:
+			raise ValueError(f"unknown JSON codec \"{name}\", expected one of {', '.join(BACKENDS)}")
+		return BACKENDS[name]()
+	for backend in BACKENDS.values():
+		try:
+			return backend()
+		except ImportError:
+			pass
+
+
+def use(name=""):
+	''' Switch the module level functions to another backend, return its Codec '''
+	global current, loads, dumps, dumpb, DecodeError
+	current = select(name)
+	loads = current.loads
+	dumps = current.dumps
+	dumpb = current.dumpb
+	DecodeError = current.errors
+	return current
+
+
+current = loads = dumps = dumpb = DecodeError = None  # set by use()
+use(os.environ.get("JSON_CODEC", ""))
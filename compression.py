@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+''' Per-message compression policy for websocket connections
+
+Once a client negotiates permessage-deflate, websockets compresses every message sent to it.
+With a Compression policy the server decides for every message instead: messages shorter than
+"threshold" characters, or of a type not in "types", are sent uncompressed (RFC 7692 lets
+every message choose, clients decompress only the ones flagged as compressed):
+
+	from compression import Compression
+	policy = Compression(threshold=512, types={"msg", "user", "system"}, window_bits=12, mem_level=5)
+	websockets.serve(handler, ip, port, compression=None, extensions=[policy.factory()])
+
+	deflate = policy.extension(websocket)  # once the connection is open
+	deflate.compress = policy.wants("transform", len(data))  # right before sending a message
+	await websocket.send(data)
+
+Larger windows ("window_bits", 8..15) and "mem_level" (1..9) compress better, but cost more
+memory on both ends of every connection. "level" (0..9) trades CPU time for size.
+
+'''
+
+import time
+from websockets import frames
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+
+
+class Compression:
+
+	def __init__(self, threshold=512, types=None, window_bits=12, client_window_bits=12, mem_level=5, level=6):
+		''' Compress messages of at least "threshold" characters whose type is in "types" (all types if None) '''
+		self.threshold = threshold
+		self.types = None if types is None else set(types)
+		self.window_bits = window_bits
+		self.client_window_bits = client_window_bits
+		self.mem_level = mem_level
+		self.level = level
+		self.compressed = 0  # messages
+		self.skipped = 0
+		self.input = 0  # bytes before and after compression
+		self.output = 0
+		self.seconds = 0.0  # spent compressing
+
+	def factory(self):
+		''' Return the extension factory to pass to websockets.serve() in "extensions" '''
+		return _Factory(self, server_max_window_bits=self.window_bits, client_max_window_bits=self.client_window_bits,
+						compress_settings={"memLevel": self.mem_level, "level": self.level})
+
+	def wants(self, kind, size):
+		''' True if a message of type "kind" (None if not known) and "size" characters should be compressed '''
+		return size >= self.threshold and (self.types is None or kind is None or kind in self.types)
+
+	@staticmethod
+	def extension(websocket):
+		''' Return the SelectiveDeflate extension of a connection, None if the client did not ask for compression '''
+		for extension in getattr(websocket, "extensions", ()):
+			if isinstance(extension, SelectiveDeflate):
+				return extension
+		return None
+
+	def stats(self):
+		''' Return number of messages compressed and skipped, bytes before and after compression and time spent '''
+		return {
+			"compressed": self.compressed,
+			"skipped": self.skipped,
+			"input": self.input,
+			"output": self.output,
+			"seconds": self.seconds
+		}
+
+
+class SelectiveDeflate(PerMessageDeflate):
+
+	def __init__(self, policy, *args):
+		''' permessage-deflate that compresses a message only if "compress" was set when it was sent '''
+		super().__init__(*args)
+		self.policy = policy
+		self.compress = True
+		self.compressing = True  # decision for the message being sent, continuation frames follow it
+
+	def encode(self, frame):
+		if frame.opcode in frames.CTRL_OPCODES:
+			return frame
+		if frame.opcode is not frames.OP_CONT:
+			self.compressing = self.compress
+			if not self.compressing:
+				self.policy.skipped += 1
+		if not self.compressing:
+			return frame
+		start = time.perf_counter()
+		encoded = super().encode(frame)
+		self.policy.seconds += time.perf_counter() - start
+		self.policy.input += len(frame.data)
+		self.policy.output += len(encoded.data)
+		if frame.opcode is not frames.OP_CONT:
+			self.policy.compressed += 1
+		return encoded
+
+
+class _Factory(ServerPerMessageDeflateFactory):
+
+	def __init__(self, policy, **options):
+		super().__init__(**options)
+		self.policy = policy
+
+	def process_request_params(self, params, accepted_extensions):
+		response, extension = super().process_request_params(params, accepted_extensions)
+		return response, SelectiveDeflate(self.policy, extension.remote_no_context_takeover, extension.local_no_context_takeover,
+										  extension.remote_max_window_bits, extension.local_max_window_bits, extension.compress_settings)
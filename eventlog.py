@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import os
+import queue
+import atexit
+import threading
+import time
+
+
+class EventLog:
+
+	QUEUE_SIZE = 100000  # lines waiting to be written before new ones are dropped
+
+	def __init__(self, path, interval=1.0, size=65536):
+		''' Append lines to a file from a background thread, so disk I/O never blocks the event loop
+
+		The file is kept open and written in batches, it is flushed every "interval" seconds
+		or whenever "size" characters are waiting in the buffer, whichever comes first.
+		Everything written is flushed when close() is called or when the application exits.
+
+		'''
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.file = open(path, "a", encoding="utf-8", newline="", buffering=max(1, size))
+		self.path = path
+		self.interval = interval
+		self.size = size
+		self.queue = queue.Queue(self.QUEUE_SIZE)
+		self.peak = 0
+		self.written = 0
+		self.dropped = 0
+		self.errors = 0  # failed writes and flushes (disk full, etc.), the thread keeps going
+		self.thread = threading.Thread(target=self._run, name=f"EventLog({path})", daemon=True)
+		self.thread.start()
+		atexit.register(self.close)
+
+	def write(self, line):
+		''' Queue line for writing, return False if it had to be dropped because the disk can not keep up '''
+		try:
+			self.queue.put_nowait(line)
+		except queue.Full:
+			self.dropped += 1
+			return False
+		self.peak = max(self.peak, self.queue.qsize())
+		return True
+
+	def close(self):
+		''' Write and flush everything queued so far, then close the file '''
+		if self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join()
+
+	def stats(self):
+		''' Return number of lines waiting, written and dropped, and number of failed writes '''
+		return {
+			"queued": self.queue.qsize(),
+			"peak": self.peak,
+			"written": self.written,
+			"dropped": self.dropped,
+			"errors": self.errors
+		}
+
+	def _run(self):
+		buffered = 0
+		flushed = time.monotonic()
+		while True:
+			try:
+				line = self.queue.get(timeout=max(0.0, self.interval - (time.monotonic() - flushed)))
+			except queue.Empty:
+				line = ""
+			if line is None:
+				break
+			if line:
+				try:
+					self.file.write(line)
+					self.written += 1
+					buffered += len(line)
+				except OSError:
+					self.errors += 1  # the line is lost, the queue is still drained
+			if buffered >= self.size or time.monotonic() - flushed >= self.interval:
+				if buffered:
+					self._flush()
+				buffered = 0
+				flushed = time.monotonic()
+		self._flush()
+		try:
+			self.file.close()
+		except OSError:
+			self.errors += 1
+
+	def _flush(self):
+		try:
+			self.file.flush()
+		except OSError:
+			self.errors += 1
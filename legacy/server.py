@@ -4,11 +4,14 @@ import asyncio
 import websockets
 import time
 import codecs
-import json
+import os
+import sys
 from copy import deepcopy
 from socket import gethostbyname, gethostname
 
 import game
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import codec  # shared with the new server, in the parent directory
 SETTINGS = "settings.ini"
 
 def log(message):
@@ -31,7 +34,7 @@ async def vr_server(websocket, path):
 	log(f"Incoming connection: {client_ip}")
 	try:
 		while True:
-			data = json.loads(await websocket.recv())
+			data = codec.loads(await websocket.recv())
 			# first connection
 			if client_type == "UNKNOWN" and "type" in data and data["type"] in ("SUBJECT", "EXPERIMENTER"):
 				client_type = data["type"]
@@ -186,7 +189,7 @@ async def send(sender,data):
 					CONNECTIONS[sender]["data"][key] = data[key]
 			data["timestamp"] = CONNECTIONS[sender]["data"]["timestamp"]
 			data["games_played"] = GAMES_PLAYED
-			message = json.dumps(data)
+			message = codec.dumps(data)
 			# send to others
 			for recipient in CONNECTIONS:
 				if sender != recipient:
@@ -204,7 +207,7 @@ async def echo(sender,data):
 				CONNECTIONS[sender]["data"][key] = data[key]
 		data["timestamp"] = CONNECTIONS[sender]["data"]["timestamp"]
 		data["games_played"] = GAMES_PLAYED
-		message = json.dumps(data)
+		message = codec.dumps(data)
 		for socket in CONNECTIONS[sender]["socket"]:
 			await socket.send(message)
 
@@ -215,7 +218,7 @@ async def send_all():
 			CONNECTIONS[sender]["data"]["timestamp"] = time.time()
 			data = deepcopy(CONNECTIONS[sender]["data"])
 			data["games_played"] = GAMES_PLAYED
-			message = json.dumps(data)
+			message = codec.dumps(data)
 			for recipient in CONNECTIONS:
 				if sender != recipient:
 					if CONNECTIONS[recipient]["ready"]:
@@ -235,6 +238,7 @@ if __name__ == "__main__":
 	SESSION = 0 # make sure this increases every time
 	log(f"Starting game session {SESSION}")
 	log(f"Starting server at {IP}:{PORT}")
+	log(f"Encoding JSON with {codec.current.name}")
 	service = websockets.serve(vr_server, IP, PORT)
 	asyncio.get_event_loop().run_until_complete(service)
 	asyncio.get_event_loop().run_forever()
\ No newline at end of file
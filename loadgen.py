@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+''' Simulate lots of headsets from a single process to measure how the server holds up
+
+Every simulated headset logs in, joins one of the rooms, then sends its transform and chat
+messages at a fixed rate. Transforms and messages carry a sequence number, so every client
+can tell how long it took for them to be fanned out to the room:
+
+	python loadgen.py --clients 1000 --rooms 10 --transforms 90 --chat 0.2 --duration 60
+	python loadgen.py --clients 200 --spawn --fps 30  # start a server on localhost first
+
+'''
+
+import argparse
+import asyncio
+import codec
+import json
+import multiprocessing
+import random
+import time
+import websockets
+import wire
+from replay import percentiles
+from server import Server
+
+SEQUENCE = 30000  # sequence numbers are sent as pos.x in millimeters, so they fit int16 transforms too
+
+
+class LoadGenerator:
+
+	def __init__(self, url, clients=100, rooms=1, transforms=10.0, chat=0.1, duration=30.0, ramp=5.0, encoding="json", fps=0.0):
+		''' Simulate "clients" headsets in "rooms" rooms, sending "transforms" and "chat" messages a second each '''
+		self.url = url
+		self.clients = clients
+		self.rooms = [Server.DEFAULT_ROOM] if rooms <= 1 else [f"load_{i}" for i in range(rooms)]
+		self.transforms = transforms
+		self.chat = chat
+		self.duration = duration
+		self.ramp = ramp
+		self.encoding = encoding
+		self.fps = fps
+		self.running = False
+		self.stopped = None
+		self.connected = 0
+		self.failed = 0
+		self.sent = {"transform": 0, "msg": 0}
+		self.received = {"frames": 0, "bytes": 0, "transform": 0, "msg": 0}
+		self.timestamps = {"transform": {}, "msg": {}}  # type: {(nick, sequence): time sent}
+		self.latency = {"transform": [], "msg": []}
+		self.intervals = []  # time between transform frames received by the same client
+		self.errors = {}
+
+	async def run(self):
+		''' Connect all clients (spread over "ramp" seconds), run for "duration" seconds, return the report '''
+		self.running = True
+		self.stopped = asyncio.Event()
+		tasks = []
+		for i in range(self.clients):
+			tasks.append(asyncio.ensure_future(self.client(i)))
+			await asyncio.sleep(self.ramp / self.clients)
+		start = time.monotonic()
+		await asyncio.sleep(self.duration)
+		self.running = False
+		self.stopped.set()
+		duration = time.monotonic() - start
+		await asyncio.gather(*tasks, return_exceptions=True)
+		return self.report(duration)
+
+	async def client(self, i):
+		''' A single simulated headset '''
+		nick = f"load_{i}"
+		room = self.rooms[i % len(self.rooms)]
+		try:
+			ws = await websockets.connect(self.url, max_size=None, ping_interval=None)
+		except (OSError, websockets.InvalidHandshake, asyncio.TimeoutError):
+			self.failed += 1
+			return
+		self.connected += 1
+		ids = {}
+		receiver = asyncio.ensure_future(self.receive(ws, ids))
+		try:
+			options = {"user": nick, "pass": ""}
+			if self.encoding != "json":
+				options["wire"] = self.encoding
+			await ws.send(codec.dumps({"system": "login", "options": options}))
+			if room != Server.DEFAULT_ROOM:
+				await ws.send(codec.dumps({"room": room, "type": "join", "data": ""}))
+				await ws.send(codec.dumps({"room": Server.DEFAULT_ROOM, "type": "leave", "data": ""}))
+			await asyncio.gather(self.send_transforms(ws, nick, room, ids), self.send_chat(ws, nick, room))
+		except websockets.ConnectionClosed:
+			self.errors["closed"] = self.errors.get("closed", 0) + 1
+		finally:
+			await ws.close()
+			await asyncio.gather(receiver, return_exceptions=True)
+
+	async def send_transforms(self, ws, nick, room, ids):
+		''' Send transforms at a fixed rate, with the sequence number as pos.x '''
+		if not self.transforms:
+			return
+		sequence = 0
+		heading, z = random.uniform(-180, 180), random.uniform(-10, 10)
+		await asyncio.sleep(random.random() / self.transforms)
+		deadline = time.monotonic()
+		while self.running:
+			sequence = (sequence + 1) % SEQUENCE
+			transform = {"pos": {"x": sequence / wire.POS_SCALE, "y": 1.7, "z": z}, "rot": {"x": 0.0, "y": heading, "z": 0.0}}
+			self.timestamps["transform"][(nick, sequence)] = time.monotonic()
+			self.timestamps["transform"].pop((nick, (sequence - 1000) % SEQUENCE), None)
+			if self.encoding != "json" and room in ids:
+				await ws.send(wire.pack_transform(ids[room], transform, self.encoding))
+			else:
+				await ws.send(codec.dumps({"room": room, "type": "transform", "data": transform}))
+			self.sent["transform"] += 1
+			deadline += 1.0 / self.transforms
+			await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+
+	async def send_chat(self, ws, nick, room):
+		''' Send chat messages at random intervals, "chat" messages a second on average '''
+		if not self.chat:
+			return
+		sequence = 0
+		while self.running:
+			try:
+				await asyncio.wait_for(self.stopped.wait(), random.expovariate(self.chat))
+				break
+			except asyncio.TimeoutError:
+				pass
+			sequence += 1
+			self.timestamps["msg"][(nick, sequence)] = time.monotonic()
+			await ws.send(codec.dumps({"room": room, "type": "msg", "data": f"{sequence}"}))
+			self.sent["msg"] += 1
+
+	async def receive(self, ws, ids):
+		''' Measure fan-out latency of every transform and message received '''
+		nicks = {}
+		last = None
+		try:
+			async for data in ws:
+				received = time.monotonic()
+				self.received["frames"] += 1
+				self.received["bytes"] += len(data)
+				if type(data) is bytes:
+					frame = wire.unpack(data)
+					last = self.interval(last, received)
+					for p in frame["payload"]:
+						self.transform(nicks.get((frame["room"], p["user"])), p["data"], received)
+					continue
+				message = codec.loads(data)
+				if message.get("info") == "user":
+					transforms = False
+					for p in message["payload"]:
+						if p["type"] == "transform":
+							transforms = True
+							self.transform(p["user"], p["data"], received)
+						elif p["type"] == "msg":
+							self.received["msg"] += 1
+							sent = self.timestamps["msg"].get((p["user"], int(p["data"]) if p["data"].isdigit() else None))
+							if sent and self.running:
+								self.latency["msg"].append(received - sent)
+					if transforms:
+						last = self.interval(last, received)
+				elif message.get("info") == "system" and message["response"]["code"] == 213:
+					detail = message["response"]["detail"]
+					ids[detail["room"]] = detail["id"]
+					nicks.update({(detail["id"], int(user_id)): nick for user_id, nick in detail["users"].items()})
+				elif message.get("info") == "error":
+					code = message["response"]["code"]
+					self.errors[code] = self.errors.get(code, 0) + 1
+		except websockets.ConnectionClosed:
+			pass
+
+	def transform(self, nick, data, received):
+		self.received["transform"] += 1
+		sent = self.timestamps["transform"].get((nick, round(data["pos"]["x"] * wire.POS_SCALE)))
+		if sent and self.running:  # keyframes received while shutting down resend old transforms
+			self.latency["transform"].append(received - sent)
+
+	def interval(self, last, received):
+		if last is not None and self.running:
+			self.intervals.append(received - last)
+		return received
+
+	def report(self, duration):
+		''' Return latency percentiles (ms), tic jitter, dropped frames and throughput '''
+		intervals = sorted(self.intervals)
+		expected = 1.0 / self.fps if self.fps else (intervals[len(intervals) // 2] if intervals else 0.0)
+		jitter = [abs(interval - expected) for interval in intervals]
+		# a tic without a frame shows up as an interval of about two tics (or more)
+		dropped = sum(max(0, round(interval / expected) - 1) for interval in intervals) if expected else 0
+		return {
+			"clients": self.clients,
+			"connected": self.connected,
+			"failed": self.failed,
+			"rooms": len(self.rooms),
+			"duration": duration,
+			"sent": self.sent,
+			"received": self.received,
+			"latency": {action: {"count": len(values), **percentiles(values)} for action, values in self.latency.items()},
+			"tic": {"interval": expected * 1000, "jitter": percentiles(jitter)},
+			"dropped_frames": dropped,
+			"throughput": {
+				"sent": sum(self.sent.values()) / duration,
+				"frames": self.received["frames"] / duration,
+				"bytes": self.received["bytes"] / duration
+			},
+			"errors": {str(code): count for code, count in self.errors.items()}
+		}
+
+
+def serve(ip, port, fps):
+	''' Run a server in a child process, so it does not compete with the clients for the same core '''
+	Server(ip=ip, port=port, fps=fps, log_level=0).run()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Simulate lots of headsets connected to a server.")
+	parser.add_argument("--ip", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=42069)
+	parser.add_argument("--clients", type=int, default=100)
+	parser.add_argument("--rooms", type=int, default=1, help="number of rooms, clients are spread evenly")
+	parser.add_argument("--transforms", type=float, default=10.0, help="transforms sent by each client a second")
+	parser.add_argument("--chat", type=float, default=0.1, help="chat messages sent by each client a second")
+	parser.add_argument("--duration", type=float, default=30.0, help="seconds to run after all clients connected")
+	parser.add_argument("--ramp", type=float, default=5.0, help="seconds to spread connecting clients over")
+	parser.add_argument("--wire", default="json", choices=["json", *wire.ENCODINGS])
+	parser.add_argument("--fps", type=float, default=0.0, help="tic rate of the server (guessed from frames received if not set)")
+	parser.add_argument("--spawn", action="store_true", help="start a server on localhost first")
+	parser.add_argument("--report", default="", help="save report as JSON")
+	args = parser.parse_args()
+
+	try:
+		import resource
+		soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+		resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, min(hard, args.clients * 2 + 256)), hard))
+	except (ImportError, ValueError, OSError):
+		pass
+
+	server = None
+	if args.spawn:
+		server = multiprocessing.Process(target=serve, args=(args.ip, args.port, args.fps or 1), daemon=True)
+		server.start()
+		time.sleep(1.0)
+
+	generator = LoadGenerator(f"ws://{args.ip}:{args.port}", args.clients, args.rooms, args.transforms, args.chat,
+							  args.duration, args.ramp, args.wire, args.fps)
+	print(f"Simulating {args.clients} headsets in {len(generator.rooms)} rooms for {args.duration}s")
+	result = asyncio.run(generator.run())
+	print(json.dumps(result, indent=4))
+	if args.report:
+		with open(args.report, "w", encoding="utf-8") as f:
+			json.dump(result, f, indent=4)
+	if server:
+		server.terminate()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+''' Counters, gauges and histograms, served over HTTP in the Prometheus text format
+
+Recording a value is a single dict update (plus a bisect for histograms), so metrics can be
+left on under full load. Gauges (and counters kept elsewhere) can instead be given a function,
+that is only called when the metrics are scraped:
+
+	registry = Registry("server")
+	sent = registry.counter("frames_sent_total", "Frames sent.", ("type",))
+	sent.inc("transform")
+	latency = registry.histogram("send_latency_seconds", "Time from queueing a frame to sending it.")
+	latency.observe(0.0042)
+	registry.gauge("users", "Connected users.", function=lambda: len(users))
+	await registry.serve("0.0.0.0", 9100)  # GET http://0.0.0.0:9100/metrics
+
+Labels are passed as positional values, in the order of the names given when the metric was
+created. Functions return a number, or a dict of {label value (or tuple of values): number}.
+
+'''
+
+import asyncio
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # seconds
+DURATION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)  # seconds, of single calls
+
+
+def _number(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(value) if type(value) is float else str(value)
+
+
+def _escape(value):
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+	pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+
+	TYPE = "untyped"
+
+	def __init__(self, name, help, labels=(), function=None):
+		''' A named metric, with a value for every combination of label values '''
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.function = function
+		self.values = {}  # label values: value
+
+	def collect(self):
+		''' Return {label values: value}, calling the function of the metric if it has one '''
+		if self.function is None:
+			return self.values
+		values = self.function()
+		if type(values) is not dict:
+			return {(): values}
+		return {key if type(key) is tuple else (key,): value for key, value in values.items()}
+
+	def remove(self, *labels):
+		''' Forget the value of one combination of label values (of a room that was closed, etc.) '''
+		self.values.pop(labels, None)
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+		for key, value in self.collect().items():
+			lines.append(f"{self.name}{_labels(self.labels, key)} {_number(value)}")
+		return lines
+
+
+class Counter(Metric):
+
+	TYPE = "counter"
+
+	def inc(self, *labels):
+		self.values[labels] = self.values.get(labels, 0) + 1
+
+	def add(self, value, *labels):
+		self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+
+	TYPE = "gauge"
+
+	def set(self, value, *labels):
+		self.values[labels] = value
+
+
+class Histogram(Metric):
+
+	TYPE = "histogram"
+
+	def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+		''' Number of values observed up to every bucket's upper bound, with their count and sum '''
+		super().__init__(name, help, labels)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, *labels):
+		counts = self.values.get(labels)
+		if counts is None:
+			counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # buckets, +Inf, then the sum
+		counts[bisect_left(self.buckets, value)] += 1
+		counts[-1] += value
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+		for key, counts in self.values.items():
+			total = 0
+			for bound, count in zip((*self.buckets, float("inf")), counts):
+				total += count
+				le = 'le="' + _number(bound) + '"'
+				lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {total}")
+			lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(counts[-1])}")
+			lines.append(f"{self.name}_count{_labels(self.labels, key)} {total}")
+		return lines
+
+
+class Registry:
+
+	TIMEOUT = 10.0  # seconds a client has to send its request and read the response
+
+	def __init__(self, prefix=""):
+		''' Metrics of a single process, every name is prefixed with "prefix_" '''
+		self.prefix = f"{prefix}_" if prefix else ""
+		self.metrics = []
+
+	def register(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def counter(self, name, help, labels=(), function=None):
+		return self.register(Counter(self.prefix + name, help, labels, function))
+
+	def gauge(self, name, help, labels=(), function=None):
+		return self.register(Gauge(self.prefix + name, help, labels, function))
+
+	def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+		return self.register(Histogram(self.prefix + name, help, labels, buckets))
+
+	def render(self):
+		''' Return every metric in the Prometheus text format '''
+		return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+	async def serve(self, host="", port=9100):
+		''' Answer GET /metrics on host:port (every interface if host is not set), return the asyncio server '''
+		return await asyncio.start_server(self._request, host or None, port)
+
+	async def _request(self, reader, writer):
+		try:
+			request = await asyncio.wait_for(self._read(reader), self.TIMEOUT)
+			if len(request) >= 2 and request[0] == b"GET" and request[1].split(b"?")[0] in (b"/", b"/metrics"):
+				status, body = "200 OK", self.render().encode("utf-8")
+			else:
+				status, body = "404 Not Found", b"Metrics are served at /metrics\n"
+			writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+			await asyncio.wait_for(writer.drain(), self.TIMEOUT)
+		except (ConnectionError, asyncio.LimitOverrunError, ValueError, asyncio.TimeoutError):
+			pass
+		finally:
+			writer.close()
+
+	@staticmethod
+	async def _read(reader):
+		''' Return the words of the request line, skipping the headers '''
+		request = (await reader.readline()).split()
+		while (await reader.readline()).strip():
+			pass  # headers are not needed
+		return request
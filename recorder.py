@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+''' Binary recording of headset transforms
+
+Transforms are saved as fixed-width little-endian records into chunk files of a directory:
+	transforms_000000.bin, transforms_000001.bin, ...  (64 byte header, then records)
+	index.json  (chunks, room and user tables, every connection is a user of its own with its nick and ip)
+
+Every record is: time (float64), room id (uint16), user id (uint16), pos x, y, z, rot x, y, z (float32)
+so a whole session can be loaded into NumPy without parsing:
+
+	import recorder
+	records, index = recorder.load("logs/session")
+	records["pos"]  # shape (n, 3)
+
+'''
+
+import os
+import json
+import queue
+import struct
+import atexit
+import threading
+
+MAGIC = b"GTSTRANS"
+VERSION = 1
+HEADER = struct.Struct("<8sHHdQ")  # magic, version, record size, time of first record, number of records
+HEADER_SIZE = 64
+RECORD = struct.Struct("<dHH6f")
+DTYPE = [("time", "<f8"), ("room", "<u2"), ("user", "<u2"), ("pos", "<f4", (3,)), ("rot", "<f4", (3,))]
+
+
+class TransformRecorder:
+
+	QUEUE_SIZE = 1000  # blocks of records waiting to be written before new ones are dropped
+
+	def __init__(self, directory, chunk=1000000, block=65536):
+		''' Record transforms into chunks of "chunk" records each, written by a background thread
+
+		Records are packed into blocks of about "block" bytes, each block is handed
+		to the writer thread once it is full or when flush() is called (on every tic).
+
+		'''
+		os.makedirs(directory, exist_ok=True)
+		self.directory = directory
+		self.chunk = chunk
+		self.block = block
+		self.buffer = bytearray()
+		self.rooms = {}
+		self.users = {}
+		self.chunks = []
+		self.queue = queue.Queue(self.QUEUE_SIZE)
+		self.written = 0
+		self.dropped = 0
+		self.thread = threading.Thread(target=self._run, name=f"TransformRecorder({directory})", daemon=True)
+		self.thread.start()
+		atexit.register(self.close)
+
+	def _id(self, table, key):
+		if key not in table:
+			table[key] = len(table)
+		return table[key]
+
+	def write(self, time, room, connection, nick, ip, values):
+		''' Pack a single transform (6 floats) of user "nick" from "ip" in "room", it is dropped if it does not fit a record
+
+		Every "connection" (any number that is never reused, like a serial number) is recorded as
+		a user of its own, even if others share its nick and ip.
+
+		'''
+		room_id = self._id(self.rooms, room)
+		user_id = self._id(self.users, (connection, nick, ip))
+		try:
+			self.buffer += RECORD.pack(time, room_id, user_id, *values)
+		except (struct.error, OverflowError):
+			# values beyond float32 (or ids beyond uint16)
+			self.dropped += 1
+			return
+		if len(self.buffer) >= self.block:
+			self.flush()
+
+	def flush(self):
+		''' Hand packed records to the writer thread '''
+		if self.buffer:
+			try:
+				self.queue.put_nowait(bytes(self.buffer))
+			except queue.Full:
+				self.dropped += len(self.buffer) // RECORD.size
+			self.buffer.clear()
+
+	def close(self):
+		''' Write everything recorded so far, then close the last chunk and update the index '''
+		if self.thread.is_alive():
+			self.flush()
+			self.queue.put(None)
+			self.thread.join()
+
+	def stats(self):
+		''' Return number of blocks waiting, records written and records dropped (queue full or values that do not fit) '''
+		return {
+			"queued": self.queue.qsize(),
+			"written": self.written,
+			"dropped": self.dropped
+		}
+
+	def _run(self):
+		f = None
+		count = 0
+		known = 0
+		while True:
+			data = self.queue.get()
+			if data is None:
+				break
+			while data:
+				if f is None:
+					f, count = self._open(len(self.chunks), RECORD.unpack_from(data)[0]), 0
+				size = min(len(data), (self.chunk - count) * RECORD.size)
+				f.write(data[:size])
+				data = data[size:]
+				count += size // RECORD.size
+				self.written += size // RECORD.size
+				self._header(f, count)
+				if count >= self.chunk:
+					f.close()
+					f = None
+					self._index()
+			if len(self.rooms) + len(self.users) != known:
+				# new room or user, keep the index readable while recording
+				known = len(self.rooms) + len(self.users)
+				self._index()
+		if f is not None:
+			f.close()
+		self._index()
+
+	def _open(self, n, start):
+		name = f"transforms_{n:06d}.bin"
+		self.chunks.append({"file": name, "start": start, "records": 0})
+		f = open(os.path.join(self.directory, name), "w+b")
+		f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, start, 0).ljust(HEADER_SIZE, b"\0"))
+		return f
+
+	def _header(self, f, count):
+		''' Update number of records in the header, so chunks can be read while they are still written '''
+		f.flush()
+		f.seek(HEADER.size - 8)
+		f.write(struct.pack("<Q", count))
+		f.seek(0, os.SEEK_END)
+		self.chunks[-1]["records"] = count
+
+	def _index(self):
+		index = {
+			"version": VERSION,
+			"record": RECORD.format,
+			"header": HEADER_SIZE,
+			"chunks": self.chunks,
+			"rooms": {room_id: room for room, room_id in self.rooms.copy().items()},
+			"users": {user_id: {"nick": nick, "ip": ip, "connection": connection} for (connection, nick, ip), user_id in self.users.copy().items()}
+		}
+		path = os.path.join(self.directory, "index.json")
+		with open(path + ".tmp", "w", encoding="utf-8") as f:
+			json.dump(index, f, indent="\t")
+		os.replace(path + ".tmp", path)
+
+
+def read_header(path):
+	''' Return (time of first record, number of records) of a chunk file '''
+	with open(path, "rb") as f:
+		magic, version, size, start, count = HEADER.unpack(f.read(HEADER.size))
+	if magic != MAGIC or version != VERSION or size != RECORD.size:
+		raise ValueError(f"{path} is not a transform recording")
+	return start, count
+
+
+def load(directory):
+	''' Load all chunks of a recording as one NumPy structured array (see DTYPE), return (records, index) '''
+	import numpy
+
+	with open(os.path.join(directory, "index.json"), encoding="utf-8") as f:
+		index = json.load(f)
+	chunks = []
+	for chunk in index["chunks"]:
+		path = os.path.join(directory, chunk["file"])
+		start, count = read_header(path)
+		if count:
+			chunks.append(numpy.memmap(path, dtype=DTYPE, mode="r", offset=HEADER_SIZE, shape=(count,)))
+	if not chunks:
+		return numpy.empty(0, dtype=DTYPE), index
+	return (chunks[0] if len(chunks) == 1 else numpy.concatenate(chunks)), index
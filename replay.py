@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+''' Replay a session saved by Server.dump() against a running server
+
+Every recorded user gets their own websocket connection, then joins, leaves, messages,
+button presses and transforms are resent with the original timing (or faster):
+
+	python replay.py logs/log_2019-09-20_12-00-00.csv --ip 192.168.1.1 --speed 10
+	python replay.py logs/log_2019-09-20_12-00-00.csv --speed 0  # as fast as possible
+
+Reports how long it took for events to be delivered to the other users in the room,
+and every event that was not delivered as expected.
+
+'''
+
+import argparse
+import asyncio
+import codec
+import json
+import time
+import websockets
+import wire
+from datetime import datetime
+from server import Server
+
+
+def read(path):
+	''' Return list of (timestamp, ip, nick, room, action, message) events from a CSV saved by Server.dump() '''
+	events = []
+	with open(path, encoding="utf-8") as f:
+		for line in f:
+			fields = line.rstrip("\r\n").split(";")
+			if len(fields) < 6 or not fields[2]:
+				continue
+			timestamp, ip, nick, room, action, message = fields[:6]
+			try:
+				timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f").timestamp()
+			except ValueError:
+				continue
+			events.append((timestamp, ip, nick, room, action, message))
+	return sorted(events, key=lambda event: event[0])
+
+
+def percentiles(values, points=(50, 90, 99)):
+	''' Return percentiles and maximum of a list of latencies in milliseconds '''
+	if not values:
+		return {}
+	values = sorted(values)
+	result = {f"p{point}": values[min(len(values) - 1, int(len(values) * point / 100))] * 1000 for point in points}
+	result["max"] = values[-1] * 1000
+	return result
+
+
+class Replay:
+
+	def __init__(self, url, events, speed=1.0, wait=2.0):
+		''' Replay events against server at "url", "speed" times faster than recorded (0 = as fast as possible) '''
+		self.url = url
+		self.events = events
+		self.speed = speed
+		self.wait = wait
+		self.connections = {}  # (ip, nick): websocket
+		self.rooms = {}  # (ip, nick): set of rooms joined
+		self.receivers = []
+		self.sent = {}  # (nick, room, type, data): list of [time sent, users that should receive it]
+		self.transforms = {}  # (nick, room): (key, entry) of the latest transform sent
+		self.superseded = 0  # transforms replaced by a newer one before the next tic
+		self.latency = {}  # type: list of latencies
+		self.missing = {}  # type: number of deliveries that never arrived
+		self.unexpected = {}  # type: number of events received that were never sent by the replay
+		self.errors = {}  # code: number of errors received
+
+	async def run(self):
+		''' Replay all events, then wait for the last deliveries and return the report '''
+		if not self.events:
+			return self.report(0.0)
+		start = time.monotonic()
+		first = self.events[0][0]
+		for timestamp, ip, nick, room, action, message in self.events:
+			if self.speed:
+				await asyncio.sleep(max(0.0, start + (timestamp - first) / self.speed - time.monotonic()))
+			await self.replay((ip, nick), room, action, message)
+		duration = time.monotonic() - start
+		await asyncio.sleep(self.wait)
+		for ws in self.connections.values():
+			await ws.close()
+		await asyncio.gather(*self.receivers, return_exceptions=True)
+		return self.report(duration)
+
+	async def connect(self, user):
+		''' Open a connection for a recorded user and log in '''
+		ws = await websockets.connect(self.url, max_size=None)
+		self.connections[user] = ws
+		self.rooms[user] = {Server.DEFAULT_ROOM} if Server.JOIN_DEFAULT_ROOM else set()
+		self.receivers.append(asyncio.ensure_future(self.receive(user, ws)))
+		await ws.send(codec.dumps({"system": "login", "options": {"user": user[1], "pass": ""}}))
+
+	async def replay(self, user, room, action, message):
+		''' Resend a single recorded event '''
+		if user not in self.connections:
+			await self.connect(user)
+		if action == "join":
+			if room not in self.rooms[user]:
+				self.rooms[user].add(room)
+				await self.send(user, {"room": room, "type": "join", "data": ""})
+		elif action == "leave":
+			if room in self.rooms[user]:
+				self.rooms[user].discard(room)
+				# transforms waiting for the next tic will not reach (or come from) the user anymore
+				for (nick, other), (key, entry) in self.transforms.items():
+					if other == room and nick == user[1]:
+						entry[1].clear()
+					elif other == room:
+						entry[1].discard(user[1])
+				await self.send(user, {"room": room, "type": "leave", "data": ""})
+		else:
+			if action == "transform":
+				try:
+					# the server keeps coordinates as floats
+					message = wire.unflatten(wire.flatten(json.loads(message)))
+				except (ValueError, TypeError, KeyError):
+					return
+			# everyone in the room should receive it, including the sender
+			recipients = {other[1] for other in self.rooms if room in self.rooms[other]}
+			key = (user[1], room, action, json.dumps(message, sort_keys=True))
+			entry = [time.monotonic(), recipients]
+			if action == "transform":
+				# the server only sends the latest transform on tics, and only if it changed
+				latest = self.transforms.get((user[1], room))
+				if latest and latest[0] == key:
+					entry = None
+				elif latest and latest[1][1]:
+					self.superseded += 1
+					latest[1][1].clear()
+				if entry:
+					self.transforms[(user[1], room)] = (key, entry)
+			if entry:
+				self.sent.setdefault(key, []).append(entry)
+			await self.send(user, {"room": room, "type": action, "data": message})
+
+	async def send(self, user, message):
+		try:
+			await self.connections[user].send(codec.dumps(message))
+		except websockets.ConnectionClosed:
+			self.errors["closed"] = self.errors.get("closed", 0) + 1
+
+	async def receive(self, user, ws):
+		''' Match every event received by a user to the event the replay sent '''
+		try:
+			async for data in ws:
+				received = time.monotonic()
+				if type(data) is bytes:
+					continue
+				message = json.loads(data)
+				if message.get("info") == "error":
+					code = message["response"]["code"]
+					self.errors[code] = self.errors.get(code, 0) + 1
+				if message.get("info") != "user":
+					continue
+				for p in message["payload"]:
+					if p["type"] in ("join", "leave"):
+						continue
+					key = (p["user"], message["room"], p["type"], json.dumps(p["data"], sort_keys=True))
+					for sent in self.sent.get(key, ()):
+						if user[1] in sent[1]:
+							sent[1].discard(user[1])
+							self.latency.setdefault(p["type"], []).append(received - sent[0])
+							break
+					else:
+						# events can arrive again with room history, keyframes also contain headsets that never moved
+						if key not in self.sent and p["type"] != "transform":
+							self.unexpected[p["type"]] = self.unexpected.get(p["type"], 0) + 1
+		except websockets.ConnectionClosed:
+			pass
+
+	def report(self, duration):
+		''' Return delivery latencies (ms) and the number of deliveries missing per event type '''
+		for (nick, room, action, data), sent in self.sent.items():
+			for entry in sent:
+				if entry[1]:
+					self.missing[action] = self.missing.get(action, 0) + len(entry[1])
+		return {
+			"events": len(self.events),
+			"users": len(self.connections),
+			"duration": duration,
+			"latency": {action: {"count": len(values), **percentiles(values)} for action, values in self.latency.items()},
+			"missing": self.missing,
+			"superseded": self.superseded,
+			"unexpected": self.unexpected,
+			"errors": {str(code): count for code, count in self.errors.items()}
+		}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Replay a session saved by Server.dump() against a running server.")
+	parser.add_argument("log", help="CSV file saved by the server")
+	parser.add_argument("--ip", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=42069)
+	parser.add_argument("--speed", type=float, default=1.0, help="time scale, 10 = ten times faster, 0 = as fast as possible")
+	parser.add_argument("--wait", type=float, default=2.0, help="seconds to wait for deliveries after the last event")
+	parser.add_argument("--report", default="", help="save report as JSON")
+	args = parser.parse_args()
+
+	events = read(args.log)
+	print(f"Replaying {len(events)} events from \"{args.log}\" at {args.speed or 'full'} speed")
+	result = asyncio.run(Replay(f"ws://{args.ip}:{args.port}", events, args.speed, args.wait).run())
+	print(json.dumps(result, indent=4))
+	if args.report:
+		with open(args.report, "w", encoding="utf-8") as f:
+			json.dump(result, f, indent=4)
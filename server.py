@@ -1,88 +1,695 @@
 #!/usr/bin/env python
 
-import codecs
-import json
 import asyncio
 import websockets
-import atexit
+import cProfile
+import hmac
+import math
+import os
+import signal
+import time
+import wire
+import codec
+from eventlog import EventLog
+from recorder import TransformRecorder
+from metrics import Registry, DURATION_BUCKETS
+from compression import Compression
+from array import array
+from collections import deque
 from socket import gethostbyname, gethostname
 from datetime import datetime
 
 
+def use_loop(name=""):
+	''' Make asyncio create "uvloop" or "asyncio" event loops (uvloop if it is installed by default), return the name used '''
+	if name not in ("", "uvloop", "asyncio"):
+		raise ValueError(f"unknown event loop \"{name}\", expected \"uvloop\" or \"asyncio\"")
+	if name != "asyncio":
+		try:
+			import uvloop
+			asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+			return "uvloop"
+		except ImportError:
+			if name:
+				raise
+	asyncio.set_event_loop_policy(None)
+	return "asyncio"
+
+
+class Frame:
+
+		__slots__ = ("message", "kind", "room", "encoding", "created", "_data")
+
+		def __init__(self, message, kind="user", room=None, encoding=None, data=None):
+			''' Message that is serialized only once, no matter how many users it is sent to
+
+			"kind" is the type of the message ("transform", "msg", "system", etc.) and
+			decides what happens when it does not fit in a user's outbound queue.
+			Frames with an "encoding" are sent in the binary wire format (see wire.py).
+			Messages that are already encoded can be passed as "data" instead (with message=None).
+
+			'''
+			self.message = message
+			self.kind = kind
+			self.room = room
+			self.encoding = encoding
+			self.created = time.monotonic()
+			self._data = data
+
+		@property
+		def data(self):
+			''' Encoded message, the same str (or bytes) object is handed to every websocket '''
+			if self._data is None:
+				self._data = wire.pack(self.message, self.encoding) if self.encoding else codec.dumps(self.message)
+			return self._data
+
+		def copy(self):
+			''' Same frame sharing the encoded data, created now (latency of a cached frame is measured from when it is sent again) '''
+			return Frame(self.message, self.kind, self.room, self.encoding, self.data)
+
+		def merge(self, newer):
+			''' Combine with a newer frame of the same room, keeping the latest event of every user '''
+			events = {p["user"]: p for p in self.message["payload"]}
+			events.update({p["user"]: p for p in newer.message["payload"]})
+			frame = Frame({**newer.message, "payload": list(events.values())}, newer.kind, newer.room, newer.encoding)
+			frame.created = self.created  # latency is measured from the oldest event
+			return frame
+
+
+class Outbox:
+
+		__slots__ = ("size", "frames", "ready", "task", "closing", "peak", "dropped", "coalesced")
+
+		def __init__(self, size):
+			''' Bounded queue of frames waiting to be sent to a single connection by its writer task '''
+			self.size = size
+			self.frames = deque()
+			self.ready = asyncio.Event()
+			self.task = None
+			self.closing = False
+			self.peak = 0
+			self.dropped = 0
+			self.coalesced = 0
+
+		def __len__(self):
+			return len(self.frames)
+
+		def full(self):
+			return len(self.frames) >= self.size
+
+		def put(self, frame):
+			''' Add frame to the end of the queue '''
+			self.frames.append(frame)
+			self.peak = max(self.peak, len(self.frames))
+			self.ready.set()
+
+		def coalesce(self, frame):
+			''' Merge frame into the latest queued frame of the same kind and room, False if there was none '''
+			for i in range(len(self.frames) - 1, -1, -1):
+				if self.frames[i].kind == frame.kind and self.frames[i].room == frame.room:
+					self.frames[i] = self.frames[i].merge(frame)
+					self.coalesced += 1
+					return True
+			return False
+
+		def clear(self):
+			self.dropped += len(self.frames)
+			self.frames.clear()
+
+		async def get(self):
+			''' Wait for the next frame to send '''
+			while not self.frames:
+				self.ready.clear()
+				await self.ready.wait()
+			return self.frames.popleft()
+
+
+class Ticker:
+
+		__slots__ = ("frequency", "deadline", "tics", "skipped", "duration", "duration_max", "jitter", "jitter_max")
+
+		def __init__(self, fps):
+			''' Absolute deadlines of tics running "fps" times a second on the monotonic clock, with timing stats '''
+			self.frequency = 1.0 / fps
+			self.deadline = time.monotonic()
+			self.tics = 0
+			self.skipped = 0
+			self.duration = 0.0  # total time spent in tics
+			self.duration_max = 0.0
+			self.jitter = 0.0  # total time tics started after their deadline
+			self.jitter_max = 0.0
+
+		def done(self, start, end, catchup=0):
+			''' Record a tic that started at "start" and finished at "end", then move to the next deadline
+
+			Tics that are late are run right away, but if more than "catchup" tics were missed,
+			the rest are skipped, so an overloaded server does not fall further and further behind.
+
+			'''
+			self.tics += 1
+			self.duration += end - start
+			self.duration_max = max(self.duration_max, end - start)
+			self.jitter += start - self.deadline
+			self.jitter_max = max(self.jitter_max, start - self.deadline)
+			self.deadline += self.frequency
+			missed = int((end - self.deadline) / self.frequency)
+			if missed > catchup:
+				self.deadline += (missed - catchup) * self.frequency
+				self.skipped += missed - catchup
+
+		def stats(self):
+			''' Return tic timing stats in seconds '''
+			return {
+				"fps": 1.0 / self.frequency,
+				"tics": self.tics,
+				"skipped": self.skipped,
+				"duration": self.duration / self.tics if self.tics else 0.0,
+				"duration_max": self.duration_max,
+				"jitter": self.jitter / self.tics if self.tics else 0.0,
+				"jitter_max": self.jitter_max
+			}
+
+
+class Record:
+
+		__slots__ = ()
+		KEYS = ()
+
+		# attributes can also be read and set like the keys of a dict, for code written for the old dict shape
+		def __getitem__(self, key):
+			if key not in self.KEYS:
+				raise KeyError(key)
+			return getattr(self, key)
+
+		def __setitem__(self, key, value):
+			if key not in self.KEYS:
+				raise KeyError(key)
+			setattr(self, key, value)
+
+		def __contains__(self, key):
+			return key in self.KEYS
+
+		def keys(self):
+			return self.KEYS
+
+		def get(self, key, default=None):
+			return getattr(self, key) if key in self.KEYS else default
+
+		def update(self, data):
+			for key in data:
+				self[key] = data[key]
+
+
+class User(Record):
+
+		__slots__ = KEYS = ("auth", "nick", "level", "status", "connected", "updated", "ip", "rooms", "meta", "wire", "outbox",
+							"tokens", "refilled", "accepted", "throttled", "serial")
+
+		def __init__(self, ip, now, outbox, burst=1.0, serial=0):
+			''' State of a single connection, with a token bucket limiting the rate of transforms it can send '''
+			self.auth = False
+			self.nick = ""
+			self.level = "user"
+			self.status = "online"
+			self.connected = now
+			self.updated = now
+			self.ip = ip
+			self.rooms = set()
+			self.meta = {}
+			self.wire = None  # binary wire format of transforms, see wire.py
+			self.outbox = outbox
+			self.tokens = burst
+			self.refilled = time.monotonic()
+			self.accepted = 0  # transforms stored
+			self.throttled = 0  # transforms dropped by the rate limit
+			self.serial = serial  # number of the connection, never reused by the server
+
+		def allow(self, rate, burst):
+			''' Take a token for a transform, False if there is none left (tokens are added "rate" times a second, up to "burst") '''
+			now = time.monotonic()
+			self.tokens = min(burst, self.tokens + (now - self.refilled) * rate)
+			self.refilled = now
+			if self.tokens >= 1.0:
+				self.tokens -= 1.0
+				return True
+			self.throttled += 1
+			return False
+
+
+class Member(Record):
+
+		__slots__ = ("nick", "id", "dirty", "stale", "matrix")
+		KEYS = ("nick", "id", "dirty", "stale", "transform")
+
+		def __init__(self, nick, id, matrix):
+			''' A user in a room, whose transform is row "id" of the room's transform matrix '''
+			self.nick = nick
+			self.id = id
+			self.dirty = True  # moved since the last tic
+			self.stale = True  # moved since it was last sent to everyone in the room
+			self.matrix = matrix
+
+		@property
+		def values(self):
+			''' Copy of the transform as 6 floats (pos x, y, z, rot x, y, z) '''
+			return self.matrix[self.id * 6:self.id * 6 + 6]
+
+		@values.setter
+		def values(self, values):
+			self.matrix[self.id * 6:self.id * 6 + 6] = array("d", values)
+
+		def store(self, values):
+			''' Overwrite the transform with 6 floats in place, marking it dirty and stale if it changed '''
+			values = array("d", values)
+			row = self.id * 6
+			if values != self.matrix[row:row + 6]:
+				self.matrix[row:row + 6] = values
+				self.dirty = True
+				self.stale = True
+
+		@property
+		def transform(self):
+			return wire.unflatten(self.values)
+
+		@transform.setter
+		def transform(self, transform):
+			self.values = wire.flatten(transform)
+
+
+class Room(Record):
+
+		__slots__ = KEYS = ("title", "created", "users", "history", "size", "keyframe", "id", "ticker", "interest", "replay", "matrix",
+							"window", "pending", "flusher")
+
+		def __init__(self, id, ticker, interest=None, now=0.0, size=50, window=0.0):
+			''' State of a room, transforms of its users are kept in a single flat array of 6 floats per user
+
+			Events broadcast within "window" seconds are held back in "pending" and sent together.
+
+			'''
+			self.title = ""
+			self.created = now
+			self.users = {}  # connection: Member
+			self.history = deque(maxlen=size)
+			self.size = size
+			self.keyframe = -math.inf  # monotonic time of the last keyframe
+			self.id = id
+			self.ticker = ticker
+			self.interest = interest
+			self.replay = None  # history as a pre-encoded frame, rebuilt only after history changes
+			self.matrix = array("d")
+			self.window = window
+			self.pending = []  # (frame, ignored user) of events held back
+			self.flusher = None  # task sending pending events once the window is over
+
+		def add(self, user, nick, id):
+			''' Add a user to the room with a zero transform in row "id" '''
+			if len(self.matrix) < (id + 1) * 6:
+				self.matrix.extend(array("d", bytes(8 * ((id + 1) * 6 - len(self.matrix)))))
+			member = self.users[user] = Member(nick, id, self.matrix)
+			member.values = (0.0,) * 6
+			return member
+
+
 class Server:
 
 		DEFAULT_ROOM = "lobby"
 		JOIN_DEFAULT_ROOM = True
 		ALLOW_MULTIPLE_ROOMS = True
 		DEFAULT_HISTORY = 50
+		KEYFRAME_INTERVAL = 2.0  # seconds between resending every headset, not just the ones that moved
+		MAX_CATCHUP = 1  # number of missed tics to run late before skipping the rest
+		LAG_INTERVAL = 0.05  # seconds between checks of how late the event loop is
+		DRAIN_TIMEOUT = 2.0  # seconds to wait for queued messages to be sent when stopping
+		TRANSFORM_BURST = 10  # transforms a connection can send at once, before "transform_rate" limits it
+		IMMEDIATE_TYPES = {"transform", "join", "leave"}  # never held back by coalescing, events held back so far are sent first
+		SEND_TIMEOUT = 1.0  # seconds before giving up on a single recipient
+		QUEUE_POLICY = {"transform": "coalesce"}  # what to do when a user's queue is full: "coalesce", "drop" or "disconnect"
+		DEFAULT_QUEUE_POLICY = "disconnect"
+		METRIC_TYPES = {"transform", "msg", "button", "join", "leave", "list", "user", "system", "error"}  # others are counted as "other"
+		SYSTEM_MESSAGES = {
+			# ok
+			200: "Ok.",  # may be overwritten
+			202: "Access granted.",
+			212: "Listing information.",
+			213: "Transform id table.",
+			214: "Help message.",  # TODO: add info
+			220: "Pong.",
+			# error
+			400: "Bad request.",
+			401: "User unauthorized.",
+			403: "Access denied.",
+			406: "Data object has invalid structure.",
+			409: "Request conflicts current status.",
+			500: "Internal server error.",
+			501: "Command not recognized."
+		}
+		SYSTEM_HANDLERS = {  # {"system": command}: (method, requires auth), see register_system()
+			"login": ("_on_login", False),
+			"ping": ("_on_ping", False),
+			"rooms": ("_on_rooms", True),
+			"profile": ("_on_profile", True)  # admins only
+		}
+		MESSAGE_HANDLERS = {  # {"type": kind}: (method, user has to be in the room), see register_message()
+			"transform": ("_on_transform", True),
+			"join": ("_on_join", False),
+			"leave": ("_on_leave", True),
+			"list": ("_on_list", True),
+			"button": ("_on_button", True),
+			None: ("_on_message", True)  # any other type
+		}
 
-		def __init__(self, ip="", port=42069, fps=1, log_level=3, log_file=""):
+		def __init__(self, ip="", port=42069, fps=1, log_level=3, log_file="", queue_size=64, room_fps={}, room_interest={}, coalesce=0.0, room_coalesce={},
+					 log_interval=1.0, log_buffer=65536, record_dir="", json_codec="", backplane=None, metrics_port=0,
+					 admin_pass="", profile_dir="profiles", lag_threshold=0.1, event_loop="", compression={},
+					 transform_rate=120.0):
 			''' Init Server class. Will run on local IP:42069 by default.
 
 			Headset information will be broadcasted depending on the value of "fps",
 			sending it more frequently from the client side will have no effect.
 			fps = 10  # resend headset transformation 10 times in a second
+			room_fps = {"experiment": 60}  # rooms can also have their own rate
+			Only headsets that moved since the last tic are sent, except for every
+			KEYFRAME_INTERVAL seconds, when all of them are resent to keep clients in sync.
+			A single connection can send at most "transform_rate" transforms a second (0 for no limit),
+			the rest are dropped without a response.
+
+			In large rooms users can be sent only the headsets that are close to them:
+			room_interest = {"hall": {"radius": 5.0, "far": 10}}  # headsets further than ~5 units away are sent every 10th tic
+			Set "far" to 0 to never send distant headsets (they are still sent on keyframes).
+
+			Events (messages, button presses, etc.) can be sent to a room together, in a single frame:
+			coalesce = 0.05  # events are held back for up to 0.05 seconds (or until the next tic of the room)
+			room_coalesce = {"experiment": 0.1}  # rooms can also have their own window
+			Transforms, joins and leaves are never held back, see IMMEDIATE_TYPES.
+
+			Every connection has its own outbound queue of at most "queue_size" messages,
+			see QUEUE_POLICY for what happens to clients that can not keep up.
+
+			Events are written to "log_file" by a background thread, the file is flushed
+			every "log_interval" seconds or when "log_buffer" characters are waiting.
+			If "record_dir" is set, headset transforms are recorded there in binary (see recorder.py)
+			instead of being written to the event log.
+
+			JSON is encoded with the fastest library installed, unless "json_codec"
+			names one of codec.BACKENDS ("orjson", "msgspec", "ujson" or "json").
+
+			Servers on different machines can share rooms through a "backplane" (see backplane.py),
+			users only receive the events of other servers for the rooms they joined.
+
+			Metrics (messages and bytes in and out, latencies, tics, queues, rooms and users)
+			are served in the Prometheus text format at http://ip:metrics_port/metrics, if set.
+			The time spent in every message handler, broadcast, headsets and dump is measured too.
+
+			Users logging in with "admin_pass" as their password are admins, who can profile the
+			server with {"system": "profile", "options": {"seconds": 10}}, results are saved to "profile_dir".
+			Whenever the event loop is blocked for longer than "lag_threshold" seconds, it is logged.
+
+			Clients that support it are sent messages compressed (permessage-deflate), except short ones:
+			compression = {"threshold": 512, "types": {"msg", "user", "system"}}  # only these types, of at least 512 characters
+			compression = {"window_bits": 15, "mem_level": 8, "level": 9}  # smaller messages, more memory and CPU time
+			Set it to None to never compress, see compression.py for every option.
+
+			run() uses uvloop if it is installed, set "event_loop" to "asyncio" (or "uvloop") to choose.
+			The server can also be run on an event loop of the application with "await server.serve()".
 
 			'''
 
 			self.ip = ip if ip else gethostbyname(gethostname())
 			self.port = port
 			self.frequency = 1.0 / fps
+			self.room_fps = room_fps
+			self.room_interest = room_interest
+			self.coalesce = coalesce
+			self.room_coalesce = room_coalesce
+			self.transform_rate = transform_rate
 			self.log_level = max(0, log_level)
 			self.log_file = log_file
+			self.queue_size = max(1, queue_size)
+			self.metrics_port = metrics_port
+			self.admin_pass = admin_pass
+			self.profile_dir = profile_dir
+			self.profiler = None  # task of the profile running
+			self.lag_threshold = lag_threshold
+			self.event_loop = event_loop
+			self.compression = None if compression is None else Compression(**compression)
 
 			self.rooms = {}
+			self.room_ids = {}
+			self.wakeup = asyncio.Event()
 			self.open(self.DEFAULT_ROOM)
 			self.users = {}
-			self.loop = asyncio.get_event_loop()
-			asyncio.set_event_loop(self.loop)
+			self.connections = 0  # accepted so far, numbers the connections
+			self.nicks = {}  # nick: {connection: None} of the users logged in with that nick, in the order they logged in
+			self.backplane = backplane
+			self.remote = {}  # room: {nick: node} of users joined on other servers of the backplane
 			self.service = None
 			self.tasks = []
+			self.stopping = asyncio.Event()
+			self.system_handlers = {}  # command: (handler, requires auth, metric label)
+			self.message_handlers = {}  # kind: (handler, user has to be in the room, metric label)
+			for command, (method, auth) in self.SYSTEM_HANDLERS.items():
+				self.register_system(command, getattr(self, method), auth)
+			for kind, (method, joined) in self.MESSAGE_HANDLERS.items():
+				self.register_message(kind, getattr(self, method), joined)
+			self.system_templates = {}
 
+			self.events = None
 			if self.log_file:
-				self.log(f"Server will save event to file \"{self.log_file}\"")
+				try:
+					self.events = EventLog(self.log_file, log_interval, log_buffer)
+					self.log(f"Server will save event to file \"{self.log_file}\"")
+				except OSError as e:
+					self.log(f"Server can not save events to file: {e}")
+					self.log_file = ""
 			else:
 				self.log(f"Server will not save events to file.")
+			self.recorder = None
+			if record_dir:
+				try:
+					self.recorder = TransformRecorder(record_dir)
+					self.log(f"Server will record transforms to \"{record_dir}\"")
+				except OSError as e:
+					self.log(f"Server can not record transforms: {e}")
+			if json_codec:
+				codec.use(json_codec)
+			self.log(f"Server will encode JSON with \"{codec.current.name}\"")
+			self.metrics = self._create_metrics()
 
 		@staticmethod
 		def now(f=""):
 			''' Return current timestamp with microseconds, format it as string if "f" is set '''
 			if not f:
-				return datetime.timestamp(datetime.now())
+				return time.time()
 			else:
 				return datetime.now().strftime(f)
 
 		# start server
 		def run(self):
-			''' Run server based on class information '''
-			self.service = websockets.serve(self._connection, self.ip, self.port)
-			self.tasks = [asyncio.ensure_future(self.service), asyncio.ensure_future(self.tic())]
-			self.log(f"Server starting at {self.ip}:{self.port}")
+			''' Run server on a new event loop until interrupted (Ctrl+C or SIGTERM) '''
+			self.log(f"Server will run on \"{use_loop(self.event_loop)}\" event loop")
 			try:
-				self.loop.run_until_complete(asyncio.gather(*self.tasks))
-				self.loop.run_forever()
+				asyncio.run(self._main())
 			except KeyboardInterrupt:
-				self.stop()
+				pass
+
+		async def _main(self):
+			try:
+				asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop)
+			except (NotImplementedError, RuntimeError):
+				pass  # not available on Windows or outside the main thread
+			await self.serve()
+
+		async def serve(self):
+			''' Accept connections until stop() is called (or the task is cancelled), then shut down cleanly
+
+			Runs on the event loop it is awaited on, next to any other service of the application:
+			await asyncio.gather(Server(port=42069).serve(), other_service())
+
+			'''
+			asyncio.get_running_loop().slow_callback_duration = self.lag_threshold  # slow callbacks are named in asyncio debug mode
+			self.stopping.clear()
+			extensions = [self.compression.factory()] if self.compression else None
+			self.service = await websockets.serve(self._connection, self.ip, self.port, compression=None, extensions=extensions)
+			metrics = None
+			try:
+				self.tasks = [asyncio.ensure_future(self.tic()), asyncio.ensure_future(self.monitor())]
+				if self.backplane:
+					self.tasks.append(asyncio.ensure_future(self.connect_backplane()))
+				if self.compression:
+					self.log(f"Server will compress messages of at least {self.compression.threshold} characters")
+				if self.metrics_port:
+					metrics = await self.metrics.serve(self.ip, self.metrics_port)
+					self.log(f"Server will serve metrics at http://{self.ip}:{self.metrics_port}/metrics")
+				self.log(f"Server starting at {self.ip}:{self.port}")
+				await self.stopping.wait()
+			finally:
+				await self.shutdown(metrics)
 
-		@atexit.register
 		def stop(self):
-			''' Stop server (hopefully called when closing application) '''
+			''' Ask the server to shut down, serve() returns once it did '''
+			self.stopping.set()
+
+		async def shutdown(self, metrics=None):
+			''' Stop tics, send what is still queued (for up to DRAIN_TIMEOUT seconds), close every connection, then flush logs '''
 			self.log("Closing server.")
-			self.service.ws_server.close()
-			self.service.ws_server.wait_closed()
-			asyncio.gather(*asyncio.Task.all_tasks()).cancel()
-			self.loop.close()
-			self.loop = None
+			for task in self.tasks:
+				task.cancel()
+			for room in list(self.rooms):
+				await self.flush(room)
+			deadline = time.monotonic() + self.DRAIN_TIMEOUT
+			while any(len(self.users[user].outbox) for user in self.users) and time.monotonic() < deadline:
+				await asyncio.sleep(0.01)
+			self.service.close()  # users leave their rooms as their connections are closed
+			await self.service.wait_closed()
+			if self.backplane:
+				self.backplane.close()
+			if self.profiler:
+				self.profiler.cancel()
+				self.tasks.append(self.profiler)
+			await asyncio.gather(*self.tasks, return_exceptions=True)
+			self.tasks = []
+			if metrics:
+				metrics.close()
+				await metrics.wait_closed()
+			if self.events:
+				self.events.close()
+			if self.recorder:
+				self.recorder.close()
 
 		# send out headset orientation on tics
 		async def tic(self):
-			''' Generate tics in background to send headset information async '''
-			current = self.now()
+			''' Generate tics in background to send headset information async
+
+			Every room has its own absolute deadlines on the monotonic clock, so tics do not drift.
+			Between tics the server sleeps until the closest deadline (or until a new room is opened).
+			A tic that fails is logged, the room still moves on to its next deadline.
+
+			'''
+			while True:
+				for room in list(self.rooms):
+					if room in self.rooms and self.rooms[room].ticker.deadline <= time.monotonic():
+						ticker = self.rooms[room].ticker
+						start = time.monotonic()
+						self.metrics.tic_jitter.observe(start - ticker.deadline)
+						try:
+							await self.headsets([room])
+						except Exception as e:
+							# the other rooms (and the next tics of this one) still have to run
+							self.metrics.tic_errors.inc()
+							self.log(f"Failed to send headsets of room \"{room}\": {e!r}")
+						end = time.monotonic()
+						self.metrics.tic_duration.observe(end - start)
+						ticker.done(start, end, self.MAX_CATCHUP)
+				deadline = min(self.rooms[room].ticker.deadline for room in self.rooms)
+				self.wakeup.clear()
+				try:
+					await asyncio.wait_for(self.wakeup.wait(), max(0.0, deadline - time.monotonic()))
+				except asyncio.TimeoutError:
+					pass
+
+		def tics(self):
+			''' Return tic rate, duration and jitter stats of every room '''
+			return {room: self.rooms[room].ticker.stats() for room in self.rooms}
+
+		def timings(self):
+			''' Return number of calls, total and average seconds spent in every handler, broadcast, headsets and dump '''
+			return {function: {
+				"calls": sum(counts[:-1]),
+				"total": counts[-1],
+				"mean": counts[-1] / max(1, sum(counts[:-1]))
+			} for (function,), counts in self.metrics.calls.values.items()}
+
+		async def monitor(self):
+			''' Log whenever the event loop was blocked for longer than "lag_threshold" seconds
+
+			A task sleeping for LAG_INTERVAL seconds should wake up on time, if it is late, something
+			else kept the loop busy. Run with PYTHONASYNCIODEBUG=1 to have asyncio log the slow callbacks.
+
+			'''
 			while True:
-				if current + self.frequency < self.now():
-					current = self.now()
-					await self.headsets()
-				await asyncio.sleep(self.frequency/10.0)
+				start = time.monotonic()
+				await asyncio.sleep(self.LAG_INTERVAL)
+				lag = time.monotonic() - start - self.LAG_INTERVAL
+				self.metrics.loop_lag.observe(lag)
+				if lag > self.lag_threshold:
+					self.metrics.loop_blocked.inc()
+					self.log(f"Event loop was blocked for {lag * 1000:.0f}ms", level=1)
+
+		def _create_metrics(self):
+			''' Create the metrics of the server, the ones that are not counted as they happen are read when scraped '''
+			m = Registry("server")
+			m.received = m.counter("messages_received_total", "Messages received by type.", ("type",))
+			m.received_bytes = m.counter("bytes_received_total", "Bytes received.")
+			m.sent = m.counter("frames_sent_total", "Frames sent by type.", ("type",))
+			m.sent_bytes = m.counter("bytes_sent_total", "Bytes sent.")
+			m.latency = m.histogram("send_latency_seconds", "Time from creating a frame to sending it to a recipient.", ("type",))
+			m.timeouts = m.counter("send_timeouts_total", "Frames that could not be sent within SEND_TIMEOUT.")
+			m.dropped = m.counter("frames_dropped_total", "Frames dropped because a queue was full, by queue policy.", ("policy",))
+			m.coalesced = m.counter("frames_coalesced_total", "Frames merged into a queued frame because a queue was full.")
+			m.room_received = m.counter("room_messages_received_total", "Messages received by room.", ("room",))
+			m.room_sent = m.counter("room_frames_sent_total", "Frames sent by room.", ("room",))
+			m.room_sent_bytes = m.counter("room_bytes_sent_total", "Bytes sent by room.", ("room",))
+			m.throttled = m.counter("transforms_throttled_total", "Transforms dropped by the rate limit of a connection.")
+			m.tic_duration = m.histogram("tic_duration_seconds", "Time spent sending headsets of a room on a tic.")
+			m.tic_errors = m.counter("tic_errors_total", "Tics of a room that failed with an exception.")
+			m.tic_jitter = m.histogram("tic_jitter_seconds", "Time a tic started after its deadline.")
+			m.calls = m.histogram("call_seconds", "Time spent in message handlers, broadcast, headsets and dump.", ("function",), DURATION_BUCKETS)
+			m.loop_lag = m.histogram("loop_lag_seconds", "Time a sleeping task woke up later than it should have.")
+			m.loop_blocked = m.counter("loop_blocked_total", "Times the event loop was blocked for longer than lag_threshold.")
+			m.counter("tics_skipped_total", "Tics skipped because the server fell behind.", ("room",),
+					  lambda: {room: self.rooms[room].ticker.skipped for room in self.rooms})
+			m.gauge("users", "Connected users.", function=lambda: len(self.users))
+			m.gauge("rooms", "Open rooms.", function=lambda: len(self.rooms))
+			m.gauge("room_users", "Users joined to a room on this server.", ("room",),
+					function=lambda: {room: len(self.rooms[room].users) for room in self.rooms})
+			m.gauge("queued_frames", "Frames waiting in outbound queues.", function=lambda: sum(len(u.outbox) for u in self.users.values()))
+			m.gauge("queue_depth_max", "Frames waiting in the longest outbound queue.",
+					function=lambda: max((len(u.outbox) for u in self.users.values()), default=0))
+			if self.events:
+				m.gauge("events_queued", "Events waiting to be written to the event log.", function=lambda: self.events.stats()["queued"])
+				m.counter("events_written_total", "Events written to the event log.", function=lambda: self.events.written)
+				m.counter("events_dropped_total", "Events dropped because the disk could not keep up.", function=lambda: self.events.dropped)
+				m.counter("event_log_errors_total", "Writes to the event log that failed (disk full, etc.).", function=lambda: self.events.errors)
+			if self.recorder:
+				m.gauge("records_queued", "Blocks of transforms waiting to be recorded.", function=lambda: self.recorder.stats()["queued"])
+				m.counter("records_written_total", "Transforms recorded.", function=lambda: self.recorder.written)
+				m.counter("records_dropped_total", "Transforms dropped because the disk could not keep up or they did not fit a record.", function=lambda: self.recorder.dropped)
+			if self.compression:
+				m.counter("compression_messages_total", "Messages sent to clients that accept compression, by whether they were compressed.", ("compressed",),
+						  lambda: {"true": self.compression.compressed, "false": self.compression.skipped})
+				m.counter("compression_input_bytes_total", "Bytes of messages before compression.", function=lambda: self.compression.input)
+				m.counter("compression_output_bytes_total", "Bytes of messages after compression.", function=lambda: self.compression.output)
+				m.counter("compression_seconds_total", "Time spent compressing messages.", function=lambda: self.compression.seconds)
+			if self.backplane:
+				m.gauge("remote_users", "Users joined to a room on other servers.", ("room",),
+						function=lambda: {room: len(nicks) for room, nicks in self.remote.items()})
+				m.counter("backplane_published_total", "Events published on the backplane.", function=lambda: self.backplane.published)
+				m.counter("backplane_received_total", "Events received from the backplane.", function=lambda: self.backplane.received)
+			return m
+
+		async def profile(self, seconds, path):
+			''' Run cProfile on the event loop for "seconds" (or until cancelled), then save the stats to "path"
+
+			Load the results with pstats.Stats(path), or any viewer of cProfile output (snakeviz, etc.).
+
+			'''
+			profiler = cProfile.Profile()
+			profiler.enable()
+			try:
+				await asyncio.sleep(seconds)
+			except asyncio.CancelledError:
+				pass
+			finally:
+				profiler.disable()
+				self.profiler = None
+			try:
+				if os.path.dirname(path):
+					os.makedirs(os.path.dirname(path), exist_ok=True)
+				await asyncio.get_running_loop().run_in_executor(None, profiler.dump_stats, path)
+				self.log(f"Profile saved to \"{path}\"")
+			except OSError as e:
+				self.log(f"Server can not save profile: {e}")
 
 		def log(self, con, msg=None, level=0):
 			''' Print server messages based on log level '''
@@ -93,29 +700,31 @@ class Server:
 
 		def dump(self, user, room, action, message):
 			''' Save relevant user events to CSV file '''
-			if self.log_file and user in self.users:
-				try:
-					f = codecs.open(self.log_file, "a+", encoding="utf-8")
-				except Exception as e:
-					self.log(e)
-					return
-				ip = self.users[user]["ip"]
-				nick = "" if not self.users[user]["nick"] else self.users[user]["nick"]
+			if self.events and user in self.users:
+				start = time.perf_counter()
+				ip = self.users[user].ip
+				nick = "" if not self.users[user].nick else self.users[user].nick
 				timestamp = self.now("%Y-%m-%d %H:%M:%S.%f")  # microseconds
-				if type(message) not in (str, int, float):
-					message = json.dumps(message)
-				f.write(f"{timestamp};{ip};{nick.replace(';', ',')};{room.replace(';', ',')};{action.replace(';', ',')};{message.replace(';', ',')};\r\n")
-				f.close()
+				if type(message) is not str:
+					message = codec.dumps(message)
+				if not self.events.write(f"{timestamp};{ip};{nick.replace(';', ',')};{room.replace(';', ',')};{action.replace(';', ',')};{message.replace(';', ',')};\r\n"):
+					# disk can not keep up, warn on the first and on every 1000th dropped event
+					if self.events.dropped % 1000 == 1:
+						self.log(f"Event log is falling behind, {self.events.dropped} events dropped so far")
+				self.metrics.calls.observe(time.perf_counter() - start, "dump")
 
 		@staticmethod
 		def _validate_in(payload):
-			''' Ensure that received payload from client is valid '''
+			''' Ensure that received payload from client is valid, "room" and "type" are looked up in tables so they have to be strings '''
 			result = {}
 			for must in ("room", "data"):
 				if must not in payload:
 					raise KeyError(f"payload missing key {must}")
 				result[must] = payload[must]
 			result["type"] = payload["type"] if "type" in payload else "msg"
+			for key in ("room", "type"):
+				if type(result[key]) is not str:
+					raise ValueError(f"payload key {key} is not a string")
 			result["time"] = payload["time"] if "time" in payload else Server.now()
 			return result
 
@@ -142,44 +751,18 @@ class Server:
 						payload["data"][key][cord] = 0
 			return {key: payload["data"][key].copy() for key in ("pos", "rot")}
 
-		@staticmethod
-		def _get_system_message(code):
+		@classmethod
+		def _get_system_message(cls, code):
 			''' Return system codes similar to HTTP / FTP status (200-300 ok, 400-500 error) '''
-			# ok
-			if code == 200:
-				return "Ok."  # may be overwritten
-			elif code == 202:
-				return "Access granted."
-			elif code == 212:
-				return "Listing information."
-			elif code == 214:
-				return "Help message."  # TODO: add info
-			elif code == 220:
-				return "Pong."
-			# error
-			elif code == 400:
-				return "Bad request."
-			elif code == 401:
-				return "User unauthorized."
-			elif code == 403:
-				return "Access denied."
-			elif code == 406:
-				return "Data object has invalid structure."
-			elif code == 409:
-				return "Request conflicts current status."
-			elif code == 500:
-				return "Internal server error."
-			elif code == 501:
-				return "Command not recognized."
-			return "Unknown."
+			return cls.SYSTEM_MESSAGES.get(code, "Unknown.")
 
 		def id(self, user):
 			''' Return user's "ip" or "nick (ip)" if nick is set '''
 			if user not in self.users:
 				return f'{user}'
-			if not self.users[user]["nick"]:
-				return f'{self.users[user]["ip"]} '
-			return f'{self.users[user]["nick"]} ({self.users[user]["ip"]}) '
+			if not self.users[user].nick:
+				return f'{self.users[user].ip} '
+			return f'{self.users[user].nick} ({self.users[user].ip}) '
 
 		async def _connection(self, user, path):
 			''' Handle all incoming connections and messages from clients '''
@@ -189,84 +772,77 @@ class Server:
 				# wait for data from user once the connection is established
 				while True:
 					try:
-						self.users[user]["updated"] = self.now()
-						message = json.loads(await user.recv())
-
-						if "system" in message:
-							# system commands
-							# log in with credentials
-							if message["system"] == "login":
-								# TODO: do actual authentication later
-								if "user" in message["options"] and "pass" in message["options"]:
-									self.users[user]["nick"] = message["options"]["user"]
-									self.users[user]["auth"] = True
-									self.log(self.id(user), 'logged in', 1)
-									await self.system(user, 202)
-									# await self.system(user, 400)
-									if self.JOIN_DEFAULT_ROOM:
-										await self.join(user, self.DEFAULT_ROOM)
-								else:
-									await self.system(user, 400)
-							elif message["system"] == "ping":
-								await self.system(user, 220)
-
-							# system messages that require auth
-							elif self.users[user]["auth"]:
-								if message["system"] == "rooms":
-									await self.list_rooms(user)
-								else:
-									# not implemented
-									await self.system(user, 501)
-							else:
+						self.users[user].updated = self.now()
+						message = await user.recv()
+						self.metrics.received_bytes.add(len(message))
+						if type(message) is bytes:
+							# transforms in the binary wire format skip JSON entirely
+							self.metrics.received.inc("transform")
+							await self.receive_transform(user, message)
+							continue
+						message = codec.loads(message)
+
+						if type(message) is not dict:
+							self.metrics.received.inc("invalid")
+							await self.system(user, 400)
+							self.log(self.id(user), 'sent invalid data', 1)
+
+						elif self.fast_transforms and message.get("type") == "transform" and "system" not in message:
+							# transforms skip validation and the handler table, see ingest()
+							self.metrics.received.inc("transform")
+							await self.ingest(user, message)
+
+						elif "system" in message:
+							self.metrics.received.inc("system")
+							# system commands, most of them require auth
+							handler = self.system_handlers.get(message["system"]) if type(message["system"]) is str else False
+							if handler is False:
+								# commands are strings, anything else may not even be hashable
+								await self.system(user, 400)
+								self.log(self.id(user), 'sent invalid data', 1)
+							elif handler is None:
+								# not implemented (or not authorized)
+								await self.system(user, 501 if self.users[user].auth else 403)
+							elif handler[1] and not self.users[user].auth:
 								# not authorized
 								await self.system(user, 403)
+							else:
+								start = time.perf_counter()
+								await handler[0](user, message)
+								self.metrics.calls.observe(time.perf_counter() - start, handler[2])
 
 						# non system messages, that all require auth
-						elif self.users[user]["auth"]:
+						elif self.users[user].auth:
 							# check payload after auth
 							try:
 								message = self._validate_in(message)
-							except KeyError as e:
+							except (KeyError, ValueError) as e:
+								self.metrics.received.inc("invalid")
 								await self.system(user, 400)
 								self.log(self.id(user), 'sent invalid data', 1)
 								continue
 
-							# in room
-							if self.in_room(user, message["room"]):
-								if message["type"] == "transform":
-									self.rooms[message["room"]]["users"][user]["transform"] = self._validate_transform(message)
-								elif message["type"] == "join":
-									# already in room
-									await self.system(user, 409)
-								elif message["type"] == "leave":
-									await self.leave(user, message["room"])
-								elif message["type"] == "list":
-									await self.list_users(user, message["room"])
-								elif message["type"] == "button":
-									# same as msg but does not save it to history
-									payload = self._validate_out({"user": self.users[user]["nick"], **message})
-									self.dump(user, message["room"], message["type"], message["data"])
-									await self.broadcast(message["room"], payload)
-								else:
-									# otherwise save the data to history and broadcast it
-									payload = self._validate_out({"user": self.users[user]["nick"], **message})
-									self.history(message["room"], payload)
-									self.dump(user, message["room"], message["type"], message["data"])
-									await self.broadcast(message["room"], payload)
-							# not in room
+							self.metrics.received.inc(message["type"] if message["type"] in self.METRIC_TYPES else "other")
+							if message["room"] in self.rooms:
+								self.metrics.room_received.inc(message["room"])
+
+							# any other type is saved to history and broadcasted
+							handler, joined, label = self.message_handlers.get(message["type"], self.message_handlers[None])
+							if joined is None or joined == self.in_room(user, message["room"]):
+								start = time.perf_counter()
+								await handler(user, message)
+								self.metrics.calls.observe(time.perf_counter() - start, label)
+							elif joined:
+								# need to join room first
+								await self.system(user, 401)
 							else:
-								if message["type"] == "join":
-									if self.ALLOW_MULTIPLE_ROOMS:
-										await self.join(user, message["room"])
-									else:
-										await self.switch(user, message["room"])
-								else:
-									# need to join room first
-									await self.system(user, 401)
+								# already in room
+								await self.system(user, 409)
 						else:
 							await self.system(user, 403)
 
-					except json.decoder.JSONDecodeError:
+					except codec.DecodeError:
+						self.metrics.received.inc("invalid")
 						await self.system(user, 406)
 						self.log(self.id(user), 'sent malformed JSON', 1)
 						continue
@@ -285,108 +861,312 @@ class Server:
 					await self.disconnect(user)
 				except Exception as e:
 					self.log(self.id(user), f'failed to safely disconnect from: {e}')
-					del self.users[user]
+					# nothing here may fail, or the user would never be removed
+					state = self.users.pop(user, None)
+					if state is not None and state.outbox.task:
+						state.outbox.task.cancel()
+					for nick in [nick for nick, connections in self.nicks.items() if user in connections]:
+						del self.nicks[nick][user]
+						if not self.nicks[nick]:
+							del self.nicks[nick]
+					for r in self.rooms.values():
+						r.users.pop(user, None)
+
+		def register_system(self, command, handler, auth=True):
+			''' Handle {"system": command} with "await handler(user, message)", only for logged in users if "auth" is set '''
+			self.system_handlers[command] = (handler, auth, self._label(handler))
+
+		def register_message(self, kind, handler, joined=True):
+			''' Handle room messages of type "kind" with "await handler(user, message)"
+
+			Messages are validated by _validate_in() first. If "joined" is True the user has to be
+			in the room, if False the user must not be in the room yet, None allows both.
+			Use kind=None to replace the handler of all types that are not registered.
+
+			'''
+			self.message_handlers[kind] = (handler, joined, self._label(handler))
+			self.fast_transforms = self.message_handlers.get("transform", (None,))[0] == self._on_transform
+
+		@staticmethod
+		def _label(handler):
+			''' Name of a handler in the metrics, callables without a __name__ (functools.partial, etc.) go by their type '''
+			return getattr(handler, "__name__", type(handler).__name__)
+
+		### handle system commands
+
+		async def _on_login(self, user, message):
+			''' Log in with credentials '''
+			# TODO: do actual authentication later
+			# optional binary format for transforms: "float32" or "int16"
+			options = message.get("options")
+			encoding = options.get("wire", "json") if type(options) is dict else None
+			if type(encoding) is str and (encoding == "json" or encoding in wire.ENCODINGS) and \
+					"user" in options and "pass" in options and type(options["user"]) is str:
+				self.rename(user, options["user"])
+				self.users[user].wire = None if encoding == "json" else encoding
+				self.users[user].level = "admin" if self._admin(options["pass"]) else "user"
+				self.users[user].auth = True
+				self.log(self.id(user), 'logged in', 1)
+				await self.system(user, 202)
+				# await self.system(user, 400)
+				if self.JOIN_DEFAULT_ROOM:
+					await self.join(user, self.DEFAULT_ROOM)
+			else:
+				await self.system(user, 400)
+
+		def _admin(self, password):
+			''' True if "password" is the admin password (compared as UTF-8 bytes, in constant time) '''
+			if not self.admin_pass:
+				return False
+			# compare_digest() only takes ASCII str, lone surrogates (allowed by some JSON decoders) are kept as they are
+			return hmac.compare_digest(str(password).encode("utf-8", "surrogatepass"), self.admin_pass.encode("utf-8", "surrogatepass"))
+
+		async def _on_ping(self, user, message):
+			await self.system(user, 220)
+
+		async def _on_rooms(self, user, message):
+			await self.list_rooms(user)
+
+		async def _on_profile(self, user, message):
+			''' Profile the server for "seconds" (10 by default), or stop profiling early with 0 seconds '''
+			options = message.get("options", {})
+			seconds = options.get("seconds", 10) if type(options) is dict else None
+			if self.users[user].level != "admin":
+				await self.system(user, 403)
+			elif type(seconds) not in (int, float) or not 0 <= seconds < math.inf:
+				await self.system(user, 400)
+			elif seconds == 0:
+				if self.profiler:
+					self.profiler.cancel()
+				await self.system(user, 200, "Profiling stopped.")
+			elif self.profiler:
+				await self.system(user, 409)
+			else:
+				path = os.path.join(self.profile_dir, f"profile_{self.now('%Y-%m-%d_%H-%M-%S')}.prof")
+				self.profiler = asyncio.ensure_future(self.profile(seconds, path))
+				self.log(self.id(user), f'started profiling for {seconds}s', 1)
+				await self.system(user, 200, f"Profiling for {seconds} seconds.", {"file": path})
+
+		### handle room messages
+
+		async def _on_transform(self, user, message):
+			await self.ingest(user, message)
+
+		async def _on_join(self, user, message):
+			if self.ALLOW_MULTIPLE_ROOMS:
+				await self.join(user, message["room"])
+			else:
+				await self.switch(user, message["room"])
+
+		async def _on_leave(self, user, message):
+			await self.leave(user, message["room"])
+
+		async def _on_list(self, user, message):
+			await self.list_users(user, message["room"])
+
+		async def _on_button(self, user, message):
+			''' Same as msg but does not save it to history '''
+			payload = self._validate_out({"user": self.users[user].nick, **message})
+			self.dump(user, message["room"], message["type"], message["data"])
+			await self.broadcast(message["room"], payload)
+
+		async def _on_message(self, user, message):
+			''' Save the data to history and broadcast it '''
+			payload = self._validate_out({"user": self.users[user].nick, **message})
+			self.history(message["room"], payload)
+			self.dump(user, message["room"], message["type"], message["data"])
+			await self.broadcast(message["room"], payload)
+
+		async def ingest(self, user, message):
+			''' Store a transform sent as JSON, checking only what is needed (no _validate_in() or _validate_transform())
+
+			Transforms over the rate limit of the connection are dropped before anything else,
+			the rest overwrite the latest transform of the user in place.
+
+			'''
+			state = self.users[user]
+			if not state.auth:
+				await self.system(user, 403)
+				return
+			if self.transform_rate and not state.allow(self.transform_rate, self.TRANSFORM_BURST):
+				self.metrics.throttled.inc()
+				return
+			if "room" not in message or "data" not in message:
+				await self.system(user, 400)
+				return
+			room = self.rooms.get(message["room"]) if type(message["room"]) is str else None
+			member = room.users.get(user) if room else None
+			if member is None:
+				await self.system(user, 401)
+				return
+			try:
+				member.store(wire.values(message["data"]))
+			except (TypeError, ValueError, AttributeError):
+				# coordinates are stored as floats
+				await self.system(user, 406)
+				self.log(self.id(user), 'sent invalid transform', 1)
+				return
+			state.accepted += 1
+			self.metrics.room_received.inc(message["room"])
+
+		async def receive_transform(self, user, data):
+			''' Handle a transform sent in the binary wire format '''
+			state = self.users[user]
+			if not state.auth:
+				await self.system(user, 403)
+				return
+			if self.transform_rate and not state.allow(self.transform_rate, self.TRANSFORM_BURST):
+				self.metrics.throttled.inc()
+				return
+			try:
+				room_id, values = wire.unpack_values(data)
+			except ValueError:
+				await self.system(user, 406)
+				self.log(self.id(user), 'sent malformed transform', 1)
+				return
+			if not self.in_room(user, self.room_ids.get(room_id)):
+				await self.system(user, 401)
+			else:
+				self.metrics.room_received.inc(self.room_ids[room_id])
+				self.rooms[self.room_ids[room_id]].users[user].store(values)
+				state.accepted += 1
+
+		def transform(self, user, room, transform):
+			''' Store the latest headset transform (dict or 6 floats) of a user in a room, to be sent on the next tic if it changed
+
+			Raises ValueError if a coordinate is not a finite number (see wire.number()), missing ones are 0.
+
+			'''
+			self.rooms[room].users[user].store(wire.values(transform) if type(transform) is dict else wire.checked(transform))
+
+		def rates(self):
+			''' Return number of transforms accepted and dropped by the rate limit for every connection, by id(connection) '''
+			return {id(user): {
+				**self._peer(user),
+				"accepted": self.users[user].accepted,
+				"throttled": self.users[user].throttled
+			} for user in self.users}
 
 		def connect(self, user, data={}):
 			''' Create user data when connection is established '''
 			if user in self.users:
 				return
-			default = {
-				"auth": False,
-				"nick": "",
-				"level": "user",
-				"status": "online",
-				"connected": self.now(),
-				"updated": self.now(),
-				"ip": (user.remote_address[0] if user.remote_address else "0.0.0.0"),
-				"rooms": set(),
-				"meta": {},
-			}
-			self.users[user] = {**default, **data}
+			self.connections += 1
+			self.users[user] = User((user.remote_address[0] if user.remote_address else "0.0.0.0"), self.now(), Outbox(self.queue_size),
+									self.TRANSFORM_BURST, self.connections)
+			self.users[user].update(data)
+			self.rename(user, self.users[user].nick)
+			self.users[user].outbox.task = asyncio.ensure_future(self._writer(user, self.users[user].outbox))
 
 		async def disconnect(self, user):
 			''' Remove user data when connection is closed '''
 			if user in self.users:
-				for room in self.users[user]["rooms"].copy():
+				for room in self.users[user].rooms.copy():
 					await self.leave(user, room)
+				self.users[user].outbox.task.cancel()
+				self.rename(user, "")
 				del self.users[user]
 
+		def rename(self, user, nick):
+			''' Set the nick of a user, keeping the nick index up to date '''
+			old = self.users[user].nick
+			if old in self.nicks:
+				self.nicks[old].pop(user, None)
+				if not self.nicks[old]:
+					del self.nicks[old]
+			self.users[user].nick = nick
+			if nick:
+				self.nicks.setdefault(nick, {})[user] = None
+
+		def find(self, nick):
+			''' Return the connection of the user logged in as "nick" (the latest one, if there are several), or None '''
+			connections = self.nicks.get(nick)
+			return next(reversed(connections)) if connections else None
+
 		def open(self, room, payload={}):
 			''' Open a new room '''
 			if room in self.rooms:
 				return
-			default = {
-				"title": "",
-				"created": self.now(),
-				"users": {},
-				"history": [],
-				"size": self.DEFAULT_HISTORY
-			}
-			self.rooms[room] = {**default, **payload}
+			self.rooms[room] = Room(self._room_id(), Ticker(self.room_fps.get(room, 1.0 / self.frequency)),
+									self.room_interest.get(room), self.now(), self.DEFAULT_HISTORY, self.room_coalesce.get(room, self.coalesce))
+			self.rooms[room].update(payload)
+			self.rooms[room].history = deque(self.rooms[room].history, maxlen=self.rooms[room].size)
+			self.room_ids[self.rooms[room].id] = room
+			self.wakeup.set()
 
-		def _room_user(self, user):
-			''' Generate cache of user for a room '''
-			return {
-				"nick": self.users[user]["nick"],
-				"transform": {
-					"pos": {
-						"x": 0.0,
-						"y": 0.0,
-						"z": 0.0
-					},
-					"rot": {
-						"x": 0.0,
-						"y": 0.0,
-						"z": 0.0
-					}
-				}
-			}
+		def _room_id(self):
+			''' Return the id of a new room '''
+			return self._free_id(self.room_ids)
+
+		@staticmethod
+		def _free_id(used):
+			''' Return the lowest id not in use (ids are sent as uint16 in the binary wire format) '''
+			return next(i for i in range(len(used) + 1) if i not in used)
 
 		async def close(self, room):
 			''' Close a room, force users joined to leave '''
 			if room == self.DEFAULT_ROOM:
 				return
 			if room in self.rooms:
-				for user in self.users:
+				for user in list(self.rooms[room].users):
 					await self.leave(user, room, True)
 
+		async def kick(self, nick, room=None):
+			''' Force user "nick" to leave "room" (or every room), return False if nobody is logged in as "nick" '''
+			user = self.find(nick)
+			if user is None:
+				return False
+			for joined in ([room] if room else list(self.users[user].rooms)):
+				if self.in_room(user, joined):
+					await self.leave(user, joined, True)
+			return True
+
 		async def join(self, user, room):
 			''' Join a room, open room if not available '''
-			if room and user in self.users and self.users[user]["auth"]:
+			if room and user in self.users and self.users[user].auth:
 				if room not in self.rooms:
 					self.open(room)
-				self.users[user]["rooms"].add(room)
-				self.rooms[room]["users"][user] = self._room_user(user)
+				await self.flush(room)  # events held back so far happened before the user joined
+				self.users[user].rooms.add(room)
+				self.rooms[room].add(user, self.users[user].nick, self._free_id({member.id for member in self.rooms[room].users.values()}))
+				self.rooms[room].keyframe = -math.inf  # new user needs everyone's headset on next tic
 				# send history to user
 				await self.list_users(user, room)
-				history = self.history(room)
-				if history:
-					await self.send(user, room, history)
+				if self.history(room):
+					await self.send(user, room, self.replay(room))
 
 				# broadcast join event for everyone but the user
-				await self.broadcast(room, [{"user": self.users[user]["nick"], "type": "join", "data": ""}], ignore=user)
-				self.log(self.id(user), f'joined "{room}" ({len(self.rooms[room]["users"].keys())})', 2)
+				await self.broadcast(room, [{"user": self.users[user].nick, "type": "join", "data": ""}], ignore=user)
+				await self.ids(room)
+				self.publish({"kind": "presence", "room": room, "nick": self.users[user].nick, "joined": True})
+				self.log(self.id(user), f'joined "{room}" ({len(self.rooms[room].users.keys())})', 2)
 				self.dump(user, room, "join", "")
 			else:
-				self.log(self.id(user), f'failed to join "{room}" ({len(self.rooms[room]["users"].keys())})', 2)
+				self.log(self.id(user), f'failed to join "{room}" ({len(self.rooms[room].users.keys())})', 2)
 				await self.system(user, 401)
 
 		async def leave(self, user, room, force=False):
 			''' Leave a room, close room if empty, except if it's the default lobby '''
 			if not user or not room:
 				return
-			await self.broadcast(room, [{"user": self.users[user]["nick"], "type": "leave", "data": ""}],
+			await self.broadcast(room, [{"user": self.users[user].nick, "type": "leave", "data": ""}],
 								 ignore=(None if force else user))
 			if user in self.users and room in self.rooms:
-				self.users[user]["rooms"].discard(room)
-				del self.rooms[room]["users"][user]
+				self.users[user].rooms.discard(room)
+				del self.rooms[room].users[user]
+				self.publish({"kind": "presence", "room": room, "nick": self.users[user].nick, "joined": False})
 
-				if len(self.rooms[room]["users"]) == 0:
-					if room != self.DEFAULT_ROOM:
-						del self.rooms[room]
-				self.log(self.id(user), f'left "{room}" ({len(self.rooms[room]["users"].keys())})', 2)
+				self.log(self.id(user), f'left "{room}" ({len(self.rooms[room].users.keys())})', 2)
+				if len(self.rooms[room].users) == 0 and room != self.DEFAULT_ROOM:
+					del self.room_ids[self.rooms[room].id]
+					del self.rooms[room]
+					# any client can open rooms, so their metrics must not outlive them
+					for metric in (self.metrics.room_received, self.metrics.room_sent, self.metrics.room_sent_bytes):
+						metric.remove(room)
+				else:
+					await self.ids(room)
 			elif room in self.rooms and "users" in self.rooms[room]:
-				self.log(self.id(user), f'failed to leave "{room}" ({len(self.rooms[room]["users"].keys())})', 2)
+				self.log(self.id(user), f'failed to leave "{room}" ({len(self.rooms[room].users.keys())})', 2)
 				await self.system(user, 401)
 			else:
 				self.log(self.id(user), f'failed to leave "{room}"', 2)
@@ -397,38 +1177,105 @@ class Server:
 			''' Leave all other rooms and join new one '''
 			if user not in self.users:
 				return
-			for old_room in self.users[user]["rooms"].copy():
+			for old_room in self.users[user].rooms.copy():
 				await self.leave(user, old_room)
 			await self.join(user, room)
 
 		async def list_users(self, user, room):
 			''' Send list of users in room for a single user (user has to be in that room) '''
 			if room and user in self.users and room in self.rooms:
-				nicks = sorted([self.rooms[room]["users"][con]["nick"] for con in self.rooms[room]["users"]], key=str.lower)
+				nicks = [self.rooms[room].users[con].nick for con in self.rooms[room].users] + list(self.remote.get(room, ()))
+				nicks = sorted(nicks, key=str.lower)
 				await self.send(user, room, [{"user": nick, "type": "join", "data": ""} for nick in nicks])
 			else:
-				self.log(self.id(user), f'failed to list users in "{room}" ({len(self.rooms[room]["users"].keys())})', 2)
+				self.log(self.id(user), f'failed to list users in "{room}" ({len(self.rooms[room].users.keys())})', 2)
 				await self.system(user, 401)
 
 		async def list_rooms(self, user):
 			''' List available rooms for a single user as system message (does not have to be in a room) '''
 			if user in self.users:
 				# rooms = sorted([room for room in self.rooms], key=str.lower)
-				detail = {room: self.rooms[room]["title"] for room in self.rooms}
+				detail = {room: self.rooms[room].title for room in self.rooms}
 				await self.system(user, 212, "", detail)
 			else:
 				self.log(self.id(user), f'failed to list rooms', 2)
 				await self.system(user, 401)
 
+		async def ids(self, room):
+			''' Send room and user ids to users of a room that receive transforms in the binary wire format '''
+			if room not in self.rooms:
+				return
+			members = self.rooms[room].users
+			recipients = [con for con in members if con in self.users and self.users[con].wire]
+			if recipients:
+				detail = {"room": room, "id": self.rooms[room].id, "users": {members[con].id: members[con].nick for con in members}}
+				frame = self._create_system(213, "", detail)
+				for recipient in recipients:
+					await self.post(recipient, frame)
+
 		def in_room(self, user, room):
 			''' True if user in that room, False otherwise '''
 			if user in self.users:
 				if room in self.rooms:
-					return user in self.rooms[room]["users"]
+					return user in self.rooms[room].users
 			return False
 
+		### share rooms with other servers
+
+		async def connect_backplane(self):
+			''' Start receiving events from other servers, then ask them who is in their rooms '''
+			try:
+				await self.backplane.start(self._remote)
+				self.log(f"Server joined backplane as \"{self.backplane.node}\"")
+				self.publish({"kind": "hello"})
+				await self.backplane.wait()
+			except (OSError, ConnectionError) as e:
+				self.log(f"Server lost connection to the backplane: {e}")
+
+		def publish(self, event):
+			''' Send event to the other servers of the backplane (if there is one) '''
+			if self.backplane:
+				self.backplane.publish(event)
+
+		async def _remote(self, event):
+			''' Deliver an event of another server to the users of this one '''
+			kind, room = event["kind"], event.get("room")
+			if kind == "broadcast":
+				await self.broadcast(room, event["payload"], publish=False)
+			elif kind == "history":
+				if room in self.rooms:
+					self.rooms[room].history.append(event["payload"])
+					self.rooms[room].replay = None
+			elif kind == "presence":
+				if event["joined"]:
+					self.remote.setdefault(room, {})[event["nick"]] = event["node"]
+				elif event["nick"] in self.remote.get(room, ()):
+					del self.remote[room][event["nick"]]
+					if not self.remote[room]:
+						del self.remote[room]
+			elif kind == "hello":
+				# a new server does not know who joined the rooms so far
+				for joined in self.rooms:
+					for member in self.rooms[joined].users.values():
+						self.publish({"kind": "presence", "room": joined, "nick": member.nick, "joined": True})
+			elif kind == "gone":
+				for joined in list(self.remote):
+					for nick in [nick for nick, node in self.remote[joined].items() if node == event["node"]]:
+						await self.broadcast(joined, [{"user": nick, "type": "leave", "data": ""}], publish=False)
+						del self.remote[joined][nick]
+					if not self.remote[joined]:
+						del self.remote[joined]
+
 		### handle sending messages
 
+		def _create_frame(self, room, payload, check=True):
+			''' Create a pre-encoded frame for sending the same user messages to multiple users '''
+			if isinstance(payload, Frame):
+				return payload
+			message = self._create_payload(room, payload, check)
+			kinds = {p["type"] for p in message["payload"]}
+			return Frame(message, kinds.pop() if len(kinds) == 1 else "user", room)
+
 		def _create_payload(self, room, payload, check=True):
 			''' Create a payload for sending user messages '''
 			if type(payload) is not list:
@@ -439,65 +1286,277 @@ class Server:
 				"payload": [self._validate_out(p) if check else p for p in payload]
 			}
 
+		async def _writer(self, user, outbox):
+			''' Send queued frames to a single user, so slow connections do not hold up anyone else '''
+			metrics = self.metrics
+			deflate = Compression.extension(user) if self.compression else None  # None if the client did not ask for compression
+			while True:
+				frame = await outbox.get()
+				try:
+					data = frame.data
+					if deflate is not None:
+						deflate.compress = self.compression.wants(frame.kind, len(data))
+					await asyncio.wait_for(user.send(data), self.SEND_TIMEOUT)
+					kind = frame.kind if frame.kind in self.METRIC_TYPES else "other"
+					metrics.sent.inc(kind)
+					metrics.sent_bytes.add(len(data))
+					metrics.latency.observe(time.monotonic() - frame.created, kind)
+					if frame.room in self.rooms:  # not after the room was closed, see leave()
+						metrics.room_sent.inc(frame.room)
+						metrics.room_sent_bytes.add(len(data), frame.room)
+				except asyncio.TimeoutError:
+					metrics.timeouts.inc()
+					self.log(self.id(user), f"timed out after {self.SEND_TIMEOUT}s", 1)
+				except websockets.ConnectionClosed:
+					return
+				except Exception as e:
+					self.log(self.id(user), f"unable to send message: {e}", 1)
+
 		async def post(self, user, message):
-			''' Force send any message to a single user through websocket connection '''
-			try:
-				if user in self.users:
-					await user.send(json.dumps(message))
-			except Exception as e:
-				self.log(f"Unable to send to {self.id(user)}: {e}", 1)
+			''' Queue any message (or pre-encoded Frame) for a single user, return False if it was not accepted '''
+			if user not in self.users:
+				return False
+			if not isinstance(message, Frame):
+				message = Frame(message, message.get("info", "user"))
+			outbox = self.users[user].outbox
+			if outbox.closing:
+				return False
+			if not outbox.full():
+				outbox.put(message)
+				return True
+			policy = self.QUEUE_POLICY.get(message.kind, self.DEFAULT_QUEUE_POLICY)
+			if policy == "coalesce" and outbox.coalesce(message):
+				self.metrics.coalesced.inc()
+				return True
+			if policy == "disconnect":
+				self.log(self.id(user), f"can not keep up with {len(outbox)} queued messages", 1)
+				self.metrics.dropped.add(len(outbox) + 1, policy)
+				outbox.clear()
+				outbox.dropped += 1  # the frame that did not fit
+				outbox.closing = True
+				asyncio.ensure_future(user.close(1008, "Too many queued messages."))
+			else:
+				self.metrics.dropped.inc(policy)
+				outbox.dropped += 1
+			return False
+
+		def queues(self):
+			''' Return outbound queue depth and drop counters of every connection, by id(connection) '''
+			return {id(user): {
+				**self._peer(user),
+				"depth": len(self.users[user].outbox),
+				"peak": self.users[user].outbox.peak,
+				"dropped": self.users[user].outbox.dropped,
+				"coalesced": self.users[user].outbox.coalesced
+			} for user in self.users}
+
+		def _peer(self, user):
+			''' Return nick, ip and port of a connection, several connections can share them (not logged in yet, same nick, etc.) '''
+			return {
+				"nick": self.users[user].nick,
+				"ip": self.users[user].ip,
+				"port": user.remote_address[1] if user.remote_address else 0
+			}
 
 		async def send(self, user, room, payload):
 			''' Make sure payload is valid, then send it to a single user in a room '''
 			if room in self.rooms and user in self.users:
-				await self.post(user, self._create_payload(room, payload))
+				await self.post(user, self._create_frame(room, payload))
 
 		async def system(self, user, code=200, msg="", detail={}):
 			''' Send system message (including errors) to user (does not need to be in a room) '''
 			if user in self.users:
-				payload = {
-					"info": ("system" if (code >= 100 and code < 400) else "error"),
-					"response": {
-						"time": self.now(),
-						"code": code,
-						"msg": (msg if msg else self._get_system_message(code)),
-						"detail": detail
-					}
+				await self.post(user, self._create_system(code, msg, detail))
+
+		def _create_system(self, code=200, msg="", detail={}):
+			''' Create a pre-encoded frame for system messages '''
+			info = "system" if (code >= 100 and code < 400) else "error"
+			if msg or detail:
+				return Frame(self._system_message(info, code, msg, detail, self.now()), info)
+			# responses that are always the same are encoded only once, only the time is filled in
+			if code not in self.system_templates:
+				self.system_templates[code] = codec.dumps(self._system_message(info, code, msg, detail, "@time@")).split('"@time@"')
+			head, tail = self.system_templates[code]
+			return Frame(None, info, data=f"{head}{self.now()!r}{tail}")
+
+		def _system_message(self, info, code, msg, detail, time):
+			return {
+				"info": info,
+				"response": {
+					"time": time,
+					"code": code,
+					"msg": (msg if msg else self._get_system_message(code)),
+					"detail": detail
 				}
-				await self.post(user, payload)
+			}
 
-		async def broadcast(self, room, payload, ignore=None):
-			''' Make sure payload is valid, then send it to all users in room (except to optinal ignore=user) '''
-			if room in self.rooms:
-				message = self._create_payload(room, payload)
-				for recipient in self.rooms[room]["users"]:
-					if recipient in self.users and self.users[recipient]["auth"] and recipient != ignore:
-						await self.post(recipient, message)
-
-		async def headsets(self):
-			''' Send all headset data to all users in all rooms (called on tics) '''
-			for room in self.rooms:
-				all_transforms = []
-				for recipient in self.rooms[room]["users"]:
-					all_transforms.append({
-						"user": self.rooms[room]["users"][recipient]["nick"],
-						"type": "transform",
-						"data": self.rooms[room]["users"][recipient]["transform"]
-					})
-					self.dump(recipient, room, "transform", self.rooms[room]["users"][recipient]["transform"])
-				if all_transforms:
-					await self.broadcast(room, all_transforms)
+		async def broadcast(self, room, payload, ignore=None, encoded={}, recipients=None, publish=True):
+			''' Make sure payload is valid, then send it to all users in room (or only to "recipients", except to optinal ignore=user)
+
+			Messages are only queued here, every connection is sent its messages by its own
+			writer task, so a single slow connection will not hold up the room.
+			Users with a binary wire format are sent the matching frame from "encoded" instead, if there is one.
+			Messages for the whole room are also published on the backplane, unless "publish" is False.
+			If the room coalesces events, messages for the whole room are held back and sent later (see flush()).
+			Returns the list of recipients the message could not be delivered to.
+
+			'''
+			if room not in self.rooms:
+				return []
+			start = time.perf_counter()
+			frame = self._create_frame(room, payload)
+			if publish and recipients is None and self.backplane:
+				self.publish({"kind": "broadcast", "room": room, "payload": frame.message["payload"]})
+			r = self.rooms[room]
+			if r.window and recipients is None and frame.message is not None and frame.kind not in self.IMMEDIATE_TYPES:
+				self.hold(room, frame, ignore)
+				self.metrics.calls.observe(time.perf_counter() - start, "broadcast")
+				return []
+			if r.pending:
+				await self.flush(room)
+			failed = []
+			for recipient in (self.rooms[room].users if recipients is None else recipients):
+				if recipient in self.users and self.users[recipient].auth and recipient != ignore:
+					if not await self.post(recipient, encoded.get(self.users[recipient].wire, frame)):
+						failed.append(recipient)
+			self.metrics.calls.observe(time.perf_counter() - start, "broadcast")
+			return failed
+
+		def hold(self, room, frame, ignore=None):
+			''' Hold back a frame for everyone in the room (except "ignore"), until the window of the room is over '''
+			r = self.rooms[room]
+			r.pending.append((frame, ignore))
+			if r.flusher is None:
+				r.flusher = asyncio.ensure_future(self._flush_later(room, r))
+
+		async def _flush_later(self, room, r):
+			await asyncio.sleep(r.window)
+			r.flusher = None
+			if self.rooms.get(room) is r:
+				await self.flush(room)
+
+		async def flush(self, room):
+			''' Send the events of a room held back so far, every recipient gets the events meant for them in a single frame '''
+			r = self.rooms.get(room)
+			if r is None or not r.pending:
+				return
+			pending, r.pending = r.pending, []
+			if r.flusher is not None:
+				r.flusher.cancel()
+				r.flusher = None
+			# users ignored by some of the events get their own frame (if anything is left for them), everyone else shares one
+			frames = {}
+			for ignored in {None, *(ignore for frame, ignore in pending)}:
+				events = [p for frame, ignore in pending if ignore is None or ignore is not ignored for p in frame.message["payload"]]
+				frames[ignored] = self._create_frame(room, events, False) if events else None
+				if events:
+					frames[ignored].created = pending[0][0].created  # latency is measured from the oldest event
+			for recipient in r.users:
+				frame = frames[recipient] if recipient in frames else frames[None]
+				if frame is not None and recipient in self.users and self.users[recipient].auth:
+					await self.post(recipient, frame)
+
+		async def headsets(self, rooms=None):
+			''' Send changed headset data to all users in all rooms, or just the listed ones (called on tics)
+
+			Headsets are "dirty" if they moved since the last tic and "stale" if they moved since
+			they were last sent to everyone in the room. Rooms with area of interest filtering only
+			send dirty headsets to users nearby, stale ones are sent to everyone on every "far" tic.
+
+			'''
+			start = time.perf_counter()
+			clock = time.monotonic()  # keyframes keep coming if the system clock is set back
+			for room in (self.rooms if rooms is None else rooms):
+				r = self.rooms[room]
+				if r.pending:
+					await self.flush(room)  # events are not held back beyond the next tic
+				interest = r.interest
+				keyframe = clock - r.keyframe >= self.KEYFRAME_INTERVAL
+				if keyframe:
+					r.keyframe = clock
+				far = keyframe or not interest or (interest["far"] and r.ticker.tics % interest["far"] == 0)
+				# a single pass over the members decides what is recorded and sent
+				changed = []
+				for con, member in r.users.items():
+					if keyframe or member.dirty:
+						self.record(con, room)
+					if keyframe or (member.stale if far else member.dirty):
+						changed.append(con)
+				if far:
+					for con in changed:
+						r.users[con].dirty = r.users[con].stale = False
+					if changed:
+						await self.transforms(room, changed)
+				elif changed:
+					for recipients, nearby in self._interest(room, interest["radius"]):
+						await self.transforms(room, [con for con in nearby if r.users[con].dirty], recipients)
+					for con in changed:
+						r.users[con].dirty = False
+			if self.recorder:
+				self.recorder.flush()
+			self.metrics.calls.observe(time.perf_counter() - start, "headsets")
+
+		def record(self, user, room):
+			''' Save the headset transform of a user, in binary if transforms are recorded, otherwise to the event log '''
+			member = self.rooms[room].users[user]
+			if self.recorder and user in self.users:
+				self.recorder.write(self.now(), room, self.users[user].serial, self.users[user].nick, self.users[user].ip, member.values)
+			elif self.events:
+				self.dump(user, room, "transform", member.transform)
+
+		def _interest(self, room, radius):
+			''' Group users of a room on a horizontal (x, z) grid, yield (users in a cell, users in and around that cell) '''
+			r = self.rooms[room]
+			matrix = r.matrix
+			cells = {}
+			for con, member in r.users.items():
+				row = member.id * 6
+				x, z = matrix[row] / radius, matrix[row + 2] / radius
+				# positions that are not finite (stored without validation) can not be floored, they go to the origin's cell
+				cell = (math.floor(x), math.floor(z)) if math.isfinite(x) and math.isfinite(z) else (0, 0)
+				cells.setdefault(cell, []).append(con)
+			for (x, z), recipients in cells.items():
+				yield recipients, [con for dx in (-1, 0, 1) for dz in (-1, 0, 1) for con in cells.get((x + dx, z + dz), ())]
+
+		async def transforms(self, room, users, recipients=None):
+			''' Send the transforms of "users" to everyone in the room (or just to "recipients") in every wire format needed
+
+			Rows of the room's transform matrix are copied once, the JSON payload and the
+			binary frames (see wire.pack) are both built from the same copies.
+
+			'''
+			if not users:
+				return
+			r = self.rooms[room]
+			now = self.now()
+			rows = [(r.users[con], r.users[con].values) for con in users]
+			transforms = [{"time": now, "user": member.nick, "type": "transform", "data": wire.unflatten(values)} for member, values in rows]
+			binary = {
+				"room": r.id,
+				"time": now,
+				"payload": [{"user": member.id, "data": values} for member, values in rows]
+			}
+			encodings = {self.users[con].wire for con in (r.users if recipients is None else recipients) if con in self.users and self.users[con].wire}
+			encoded = {encoding: Frame(binary, "transform", room, encoding) for encoding in encodings}
+			await self.broadcast(room, self._create_frame(room, transforms, False), encoded=encoded, recipients=recipients)
 
 		def history(self, room, payload=None):
-			''' Returns room history as list of events. If payload is set, appends it to history first. '''
+			''' Returns room history as a ring buffer of events. If payload is set, appends it to history first. '''
 			if room in self.rooms:
 				if payload is not None:
-					self.rooms[room]["history"].append(payload)
-					self.rooms[room]["history"] = self.rooms[room]["history"][-self.rooms[room]["size"]:]
-				return self.rooms[room]["history"]
+					self.rooms[room].history.append(payload)  # oldest event is dropped once "size" is reached
+					self.rooms[room].replay = None
+					self.publish({"kind": "history", "room": room, "payload": payload})
+				return self.rooms[room].history
 			else:
 				return []
 
+		def replay(self, room):
+			''' Returns room history as a frame, that is only encoded once no matter how many users join '''
+			if self.rooms[room].replay is None:
+				self.rooms[room].replay = self._create_frame(room, list(self.rooms[room].history), False)
+			return self.rooms[room].replay.copy()
+
 
 if __name__ == "__main__":
 	server = Server(log_file=f"logs/log_{Server.now('%Y-%m-%d_%H-%M-%S')}.csv")
@@ -0,0 +1,99 @@
+''' Fake connections, and a server whose outbound frames stay queued (or are sent to a Client) so tests can look at them '''
+
+import asyncio
+import codec
+import contextlib
+import io
+import websockets
+import wire
+from server import Server
+
+
+class Connection:
+
+	def __init__(self, port=0):
+		''' Stands in for a websocket connection, remembers the code it was closed with '''
+		self.remote_address = ("127.0.0.1", port)
+		self.closed = None
+
+	async def send(self, data):
+		pass
+
+	async def close(self, code=1000, reason=""):
+		self.closed = code
+
+
+class Client(Connection):
+
+	def __init__(self, port=0):
+		''' Connection for Server._connection(), messages are handed to it with say() and what it was sent is kept '''
+		super().__init__(port)
+		self.incoming = asyncio.Queue()
+		self.sent = []
+
+	async def recv(self):
+		message = await self.incoming.get()
+		if message is None:
+			raise websockets.ConnectionClosed(None, None)
+		return message
+
+	async def send(self, data):
+		self.sent.append(data)
+
+	def say(self, message):
+		''' Send a message to the server (dicts are encoded as JSON), None closes the connection '''
+		self.incoming.put_nowait(message if message is None or type(message) in (str, bytes) else codec.dumps(message))
+
+	def received(self):
+		''' Take the JSON messages sent to the client so far, decoded '''
+		received = [codec.loads(data) for data in self.sent if type(data) is str]
+		self.sent.clear()
+		return received
+
+	def codes(self):
+		''' Take the codes of the system and error messages sent to the client so far '''
+		return [message["response"]["code"] for message in self.received() if "response" in message]
+
+
+async def settle():
+	''' Let the server handle what was said and its writer tasks send the answers '''
+	for i in range(20):
+		await asyncio.sleep(0)
+
+
+def server(**options):
+	''' Return a quiet server on 127.0.0.1 (options are passed to Server), it is never started '''
+	with contextlib.redirect_stdout(io.StringIO()):
+		s = Server(ip="127.0.0.1", log_level=0, **options)
+	s.log_level = -1
+	return s
+
+
+async def login(s, nick, join=True):
+	''' Connect and log in a fake user, joined to the lobby if "join" is set, with an empty queue
+
+	The writer task of the user is cancelled, frames stay in its outbox until taken with frames().
+
+	'''
+	user = Connection(len(s.users) + 1)
+	s.connect(user)
+	s.users[user].outbox.task.cancel()
+	s.users[user].auth = True
+	s.rename(user, nick)
+	if join:
+		await s.join(user, Server.DEFAULT_ROOM)
+	s.users[user].outbox.frames.clear()
+	return user
+
+
+def frames(s, user):
+	''' Take the frames queued for a user, decoded (binary ones with wire.unpack) '''
+	outbox = s.users[user].outbox
+	decoded = [wire.unpack(frame.data) if frame.encoding else codec.loads(frame.data) for frame in outbox.frames]
+	outbox.frames.clear()
+	return decoded
+
+
+def events(s, user):
+	''' Take the frames queued for a user, as the list of (type, data) of their events, one list per frame '''
+	return [[(p["type"], p["data"]) for p in frame["payload"]] for frame in frames(s, user)]
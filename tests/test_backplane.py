@@ -0,0 +1,129 @@
+import asyncio
+import unittest
+from backplane import Broker, MemoryBackplane, SocketBackplane
+from server import Server
+from tests.support import server, login, settle, frames, events
+
+LOBBY = Server.DEFAULT_ROOM
+
+
+class MemoryBackplaneTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.hub = []
+		self.servers = []
+		self.tasks = []
+		self.s1 = await self.node("one")
+		self.s2 = await self.node("two")
+
+	async def asyncTearDown(self):
+		for s in self.servers:
+			s.backplane.close()
+		await asyncio.gather(*self.tasks)
+
+	async def node(self, name):
+		''' Start a server on the shared backplane '''
+		s = server(backplane=MemoryBackplane(self.hub, name))
+		self.servers.append(s)
+		self.tasks.append(asyncio.ensure_future(s.connect_backplane()))
+		await settle()
+		return s
+
+	async def test_broadcasts_reach_users_of_other_servers(self):
+		a = await login(self.s1, "A")
+		b = await login(self.s2, "B")
+		await settle()
+		events(self.s1, a)
+		events(self.s2, b)  # A joined
+		await self.s1.broadcast(LOBBY, [{"user": "A", "type": "msg", "data": "hi"}])
+		await settle()
+		self.assertEqual(events(self.s2, b), [[("msg", "hi")]])
+		self.assertEqual(events(self.s1, a), [[("msg", "hi")]])  # delivered only once
+
+	async def test_presence(self):
+		await login(self.s1, "A")
+		b = await login(self.s2, "B")
+		await settle()
+		self.assertEqual(self.s2.remote, {LOBBY: {"A": "one"}})
+		events(self.s2, b)
+		await self.s2.list_users(b, LOBBY)
+		self.assertEqual([[p["user"] for p in frame["payload"]] for frame in frames(self.s2, b)], [["A", "B"]])
+		s3 = await self.node("three")  # says hello, and is told who joined so far
+		await settle()
+		self.assertEqual(s3.remote, {LOBBY: {"A": "one", "B": "two"}})
+
+	async def test_leaving_is_shared(self):
+		a = await login(self.s1, "A")
+		await settle()
+		await self.s1.leave(a, LOBBY)
+		await settle()
+		self.assertEqual(self.s2.remote, {})
+
+	async def test_history_is_shared(self):
+		await login(self.s1, "A")
+		await settle()
+		payload = {"time": "", "user": "A", "type": "msg", "data": "hi"}
+		self.s1.history(LOBBY, payload)
+		await settle()
+		self.assertEqual(list(self.s2.history(LOBBY)), [payload])
+
+	async def test_users_of_a_server_that_is_gone_leave(self):
+		await login(self.s1, "A")
+		b = await login(self.s2, "B")
+		await settle()
+		events(self.s2, b)
+		self.s1.backplane.close()
+		await settle()
+		self.assertEqual(self.s2.remote, {})
+		self.assertEqual(events(self.s2, b), [[("leave", "")]])
+		published = self.s1.backplane.published
+		await self.s1.broadcast(LOBBY, [{"user": "A", "type": "msg", "data": "lost"}])
+		await settle()
+		self.assertEqual(self.s1.backplane.published, published)
+		self.assertEqual(events(self.s2, b), [])
+
+
+class SocketBackplaneTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.broker = await asyncio.start_server(Broker().handle, "127.0.0.1", 0)
+		port = self.broker.sockets[0].getsockname()[1]
+		self.received = ([], [])
+		self.backplanes = [SocketBackplane("127.0.0.1", port, name) for name in ("one", "two")]
+		for backplane, received in zip(self.backplanes, self.received):
+			await backplane.start(self.handler(received))
+
+	async def asyncTearDown(self):
+		for backplane in self.backplanes:
+			backplane.close()
+		self.broker.close()
+		await self.broker.wait_closed()
+
+	@staticmethod
+	def handler(received):
+		async def handle(event):
+			received.append(event)
+		return handle
+
+	async def wait(self, received, count):
+		for i in range(500):
+			if len(received) >= count:
+				break
+			await asyncio.sleep(0.01)
+
+	async def test_events_are_forwarded_to_other_nodes(self):
+		self.backplanes[0].publish({"kind": "hello"})
+		await self.wait(self.received[1], 1)
+		self.assertEqual(self.received, ([], [{"kind": "hello", "node": "one"}]))
+
+	async def test_broker_tells_when_a_node_is_gone(self):
+		self.backplanes[0].publish({"kind": "hello"})
+		await self.wait(self.received[1], 1)
+		self.backplanes[0].close()
+		self.backplanes[0].publish({"kind": "hello"})  # dropped once closed
+		await self.wait(self.received[1], 2)
+		self.assertEqual(self.received[1][1:], [{"kind": "gone", "node": "one"}])
+
+
+if __name__ == "__main__":
+	unittest.main()
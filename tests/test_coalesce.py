@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+from tests.support import server, login, events
+
+ROOM = "lobby"
+
+
+def msg(nick, data, kind="msg"):
+	return {"user": nick, "type": kind, "data": data}
+
+
+class CoalesceTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server(coalesce=60.0)  # only flushed explicitly, unless a test changes the window
+		self.a = await login(self.server, "A")
+		self.b = await login(self.server, "B")
+		self.c = await login(self.server, "C")
+		for user in (self.a, self.b, self.c):
+			self.server.users[user].outbox.frames.clear()
+
+	async def asyncTearDown(self):
+		flusher = self.server.rooms[ROOM].flusher
+		if flusher is not None:
+			flusher.cancel()
+
+	async def test_events_are_held_back(self):
+		self.assertEqual(await self.server.broadcast(ROOM, msg("A", "1")), [])
+		for user in (self.a, self.b, self.c):
+			self.assertEqual(events(self.server, user), [])
+		self.assertEqual(len(self.server.rooms[ROOM].pending), 1)
+		self.assertIsNotNone(self.server.rooms[ROOM].flusher)
+
+	async def test_flush_sends_one_frame_in_order(self):
+		for data in ("1", "2", "3"):
+			await self.server.broadcast(ROOM, msg("A", data))
+		await self.server.flush(ROOM)
+		for user in (self.a, self.b, self.c):
+			self.assertEqual(events(self.server, user), [[("msg", "1"), ("msg", "2"), ("msg", "3")]])
+		self.assertEqual(self.server.rooms[ROOM].pending, [])
+		self.assertIsNone(self.server.rooms[ROOM].flusher)
+
+	async def test_flush_keeps_oldest_creation_time(self):
+		await self.server.broadcast(ROOM, msg("A", "1"))
+		created = self.server.rooms[ROOM].pending[0][0].created
+		await self.server.broadcast(ROOM, msg("A", "2"))
+		await self.server.flush(ROOM)
+		self.assertEqual(self.server.users[self.b].outbox.frames[0].created, created)
+
+	async def test_ignored_users_get_their_own_frame(self):
+		await self.server.broadcast(ROOM, msg("A", "1"), ignore=self.a)
+		await self.server.broadcast(ROOM, msg("B", "2"), ignore=self.b)
+		await self.server.broadcast(ROOM, msg("C", "3"))
+		await self.server.flush(ROOM)
+		self.assertEqual(events(self.server, self.a), [[("msg", "2"), ("msg", "3")]])
+		self.assertEqual(events(self.server, self.b), [[("msg", "1"), ("msg", "3")]])
+		self.assertEqual(events(self.server, self.c), [[("msg", "1"), ("msg", "2"), ("msg", "3")]])
+
+	async def test_user_ignored_by_every_event_gets_nothing(self):
+		await self.server.broadcast(ROOM, msg("A", "1"), ignore=self.a)
+		await self.server.broadcast(ROOM, msg("A", "2"), ignore=self.a)
+		await self.server.flush(ROOM)
+		self.assertEqual(events(self.server, self.a), [])
+		self.assertEqual(events(self.server, self.b), [[("msg", "1"), ("msg", "2")]])
+
+	async def test_immediate_types_flush_held_events_first(self):
+		await self.server.broadcast(ROOM, msg("A", "1"))
+		for kind in self.server.IMMEDIATE_TYPES:
+			await self.server.broadcast(ROOM, msg("A", "", kind))
+		self.assertEqual(self.server.rooms[ROOM].pending, [])
+		received = events(self.server, self.b)
+		self.assertEqual(received[0], [("msg", "1")])
+		self.assertEqual([frame[0][0] for frame in received[1:]], list(self.server.IMMEDIATE_TYPES))
+
+	async def test_join_flushes_events_that_happened_before(self):
+		await self.server.broadcast(ROOM, msg("A", "1"))
+		d = await login(self.server, "D", join=False)
+		await self.server.join(d, ROOM)
+		self.assertEqual(events(self.server, self.b), [[("msg", "1")], [("join", "")]])
+		self.assertNotIn([("msg", "1")], events(self.server, d))
+
+	async def test_tic_flushes_held_events(self):
+		await self.server.broadcast(ROOM, msg("A", "1"))
+		await self.server.headsets([ROOM])
+		received = events(self.server, self.b)
+		self.assertEqual(received[0], [("msg", "1")])
+		self.assertTrue(all(kind == "transform" for frame in received[1:] for kind, data in frame))
+		self.assertIsNone(self.server.rooms[ROOM].flusher)
+
+	async def test_window_flushes_on_its_own(self):
+		self.server.rooms[ROOM].window = 0.01
+		await self.server.broadcast(ROOM, msg("A", "1"))
+		await asyncio.sleep(0.05)
+		self.assertEqual(events(self.server, self.b), [[("msg", "1")]])
+		self.assertIsNone(self.server.rooms[ROOM].flusher)
+
+	async def test_messages_to_some_recipients_are_not_held(self):
+		await self.server.broadcast(ROOM, msg("A", "1"), recipients=[self.b])
+		self.assertEqual(events(self.server, self.b), [[("msg", "1")]])
+		self.assertEqual(events(self.server, self.c), [])
+
+	async def test_rooms_without_window_send_right_away(self):
+		self.server.rooms[ROOM].window = 0.0
+		await self.server.broadcast(ROOM, msg("A", "1"))
+		self.assertEqual(events(self.server, self.b), [[("msg", "1")]])
+		self.assertEqual(self.server.rooms[ROOM].pending, [])
+
+
+if __name__ == "__main__":
+	unittest.main()
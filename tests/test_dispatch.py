@@ -0,0 +1,90 @@
+import asyncio
+import functools
+import unittest
+from server import Server
+from tests.support import Client, server, settle
+
+
+class Echo:
+
+	def __init__(self):
+		''' Handler without a __name__, remembers the messages it was called with '''
+		self.messages = []
+
+	async def __call__(self, user, message):
+		self.messages.append(message)
+
+
+class DispatchTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server()
+		self.client = Client()
+		self.task = asyncio.ensure_future(self.server._connection(self.client, "/"))
+		await settle()
+
+	async def asyncTearDown(self):
+		self.client.say(None)
+		await self.task
+
+	async def say(self, message):
+		self.client.say(message)
+		await settle()
+		return self.client.codes()
+
+	async def login(self):
+		self.assertEqual((await self.say({"system": "login", "options": {"user": "A", "pass": ""}}))[0], 202)
+
+	async def test_invalid_messages(self):
+		await self.login()
+		for message in ("[]", '"A"', "1", "null", {"system": []}, {"system": {"a": 1}}, {"room": [], "data": ""}, {"room": Server.DEFAULT_ROOM, "type": [], "data": ""}, {"data": ""}):
+			self.assertEqual(await self.say(message), [400], message)
+		self.assertEqual(await self.say("{not json"), [406])
+		self.assertEqual(await self.say({"system": "ping"}), [220])  # still connected
+
+	async def test_unknown_system_commands(self):
+		self.assertEqual(await self.say({"system": "unknown"}), [403])
+		await self.login()
+		self.assertEqual(await self.say({"system": "unknown"}), [501])
+
+	async def test_auth(self):
+		self.assertEqual(await self.say({"system": "ping"}), [220])
+		self.assertEqual(await self.say({"system": "rooms"}), [403])
+		self.assertEqual(await self.say({"room": Server.DEFAULT_ROOM, "type": "msg", "data": ""}), [403])
+		await self.login()
+		self.assertEqual(await self.say({"system": "rooms"}), [212])
+
+	async def test_rooms_have_to_be_joined(self):
+		await self.login()
+		self.assertEqual(await self.say({"room": "other", "type": "list", "data": ""}), [401])
+		self.assertEqual(await self.say({"room": "other", "type": "msg", "data": ""}), [401])
+		self.assertEqual(await self.say({"room": Server.DEFAULT_ROOM, "type": "join", "data": ""}), [409])
+		self.assertEqual(await self.say({"room": "other", "type": "join", "data": ""}), [])
+		self.assertIn("other", self.server.users[self.client].rooms)
+
+	async def test_registered_handlers(self):
+		echo = Echo()
+		partial = functools.partial(Echo.__call__, echo)
+		self.server.register_system("echo", echo, auth=False)
+		self.server.register_message("echo", partial, joined=None)
+		self.assertEqual(await self.say({"system": "echo"}), [])
+		await self.login()
+		self.assertEqual(await self.say({"room": "other", "type": "echo", "data": 1}), [])
+		self.assertEqual([message.get("data") for message in echo.messages], [None, 1])
+		self.assertEqual({"Echo", "partial"} - set(self.server.timings()), set())
+
+	async def test_transforms_skip_the_handler_table(self):
+		self.assertTrue(self.server.fast_transforms)
+		echo = Echo()
+		self.server.register_message("transform", echo)
+		self.assertFalse(self.server.fast_transforms)
+		await self.login()
+		transform = {"room": Server.DEFAULT_ROOM, "type": "transform", "data": {"pos": {"x": 1.0}}}
+		self.assertEqual(await self.say(transform), [])
+		self.assertEqual(len(echo.messages), 1)
+		self.server.register_message("transform", self.server._on_transform)
+		self.assertTrue(self.server.fast_transforms)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from eventlog import EventLog
+
+
+class FullDisk:
+
+	def __init__(self, file):
+		''' Stands in for the file of an event log, every write and flush fails as if the disk was full '''
+		self.file = file
+
+	def write(self, line):
+		raise OSError(28, "No space left on device")
+
+	def flush(self):
+		raise OSError(28, "No space left on device")
+
+	def close(self):
+		self.file.close()
+
+
+class SlowDisk:
+
+	def __init__(self, file):
+		''' Stands in for the file of an event log, the first write waits until "done" is set '''
+		self.file = file
+		self.writing = threading.Event()
+		self.done = threading.Event()
+
+	def write(self, line):
+		self.writing.set()
+		self.done.wait(5.0)
+		self.file.write(line)
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+
+class EventLogTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, "logs", "events.csv")
+		self.log = EventLog(self.path, interval=0.01)
+
+	def tearDown(self):
+		self.log.close()
+		self.directory.cleanup()
+
+	def wait(self):
+		deadline = time.monotonic() + 5.0
+		while self.log.queue.qsize() and time.monotonic() < deadline:
+			time.sleep(0.005)
+		time.sleep(0.05)  # the last line taken from the queue is being written
+
+	def read(self):
+		with open(self.path, encoding="utf-8", newline="") as f:
+			return f.read()
+
+	def test_lines_are_written_in_order(self):
+		for i in range(1000):
+			self.assertTrue(self.log.write(f"{i};\r\n"))
+		self.log.close()
+		self.assertEqual(self.read(), "".join(f"{i};\r\n" for i in range(1000)))
+		self.assertEqual(self.log.stats()["written"], 1000)
+
+	def test_lines_are_flushed_while_running(self):
+		self.log.write("first;\r\n")
+		self.wait()
+		self.assertEqual(self.read(), "first;\r\n")
+
+	def test_lines_are_dropped_when_the_queue_is_full(self):
+		self.log.file = SlowDisk(self.log.file)
+		self.log.queue.maxsize = 1
+		self.assertTrue(self.log.write("1;\r\n"))
+		self.assertTrue(self.log.file.writing.wait(5.0))  # the thread is stuck writing the first line
+		self.assertTrue(self.log.write("2;\r\n"))
+		self.assertFalse(self.log.write("3;\r\n"))
+		self.assertEqual(self.log.stats()["dropped"], 1)
+		self.log.file.done.set()
+		self.log.close()
+		self.assertEqual(self.read(), "1;\r\n2;\r\n")
+
+	def test_failed_writes_do_not_stop_the_thread(self):
+		file = self.log.file
+		self.log.file = FullDisk(file)
+		for i in range(10):
+			self.log.write(f"lost {i};\r\n")
+		self.wait()
+		self.assertTrue(self.log.thread.is_alive())
+		self.assertEqual(self.log.stats()["errors"], 10)
+		self.log.file = file  # space was freed
+		self.log.write("kept;\r\n")
+		self.log.close()
+		self.assertFalse(self.log.thread.is_alive())
+		self.assertTrue(file.closed)
+		self.assertEqual(self.read(), "kept;\r\n")
+
+
+if __name__ == "__main__":
+	unittest.main()
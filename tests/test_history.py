@@ -0,0 +1,55 @@
+import time
+import unittest
+from collections import deque
+from server import Server
+from tests.support import server, login, frames
+
+ROOM = Server.DEFAULT_ROOM
+
+
+class HistoryTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server()
+		self.a = await login(self.server, "A")
+		for i in range(3):
+			await self.server._on_message(self.a, {"room": ROOM, "type": "msg", "data": str(i), "time": float(i)})
+		self.server.users[self.a].outbox.frames.clear()
+
+	async def test_history_is_sent_on_join(self):
+		b = await login(self.server, "B", join=False)
+		await self.server.join(b, ROOM)
+		received = frames(self.server, b)
+		self.assertEqual([p["user"] for p in received[0]["payload"]], ["A", "B"])  # users in the room
+		self.assertEqual([p["data"] for p in received[1]["payload"]], ["0", "1", "2"])
+
+	async def test_history_is_encoded_once(self):
+		b = await login(self.server, "B", join=False)
+		c = await login(self.server, "C", join=False)
+		await self.server.join(b, ROOM)
+		await self.server.join(c, ROOM)
+		self.assertIs(self.server.users[b].outbox.frames[1].data, self.server.users[c].outbox.frames[1].data)
+
+	async def test_cached_history_is_created_when_it_is_sent(self):
+		self.server.replay(ROOM)
+		self.server.rooms[ROOM].replay.created -= 60.0  # cached a minute ago
+		b = await login(self.server, "B", join=False)
+		await self.server.join(b, ROOM)
+		self.assertLess(time.monotonic() - self.server.users[b].outbox.frames[1].created, 1.0)
+
+	async def test_history_is_rebuilt_after_it_changed(self):
+		self.server.replay(ROOM)
+		await self.server._on_message(self.a, {"room": ROOM, "type": "msg", "data": "3", "time": 3.0})
+		self.assertIsNone(self.server.rooms[ROOM].replay)
+		b = await login(self.server, "B", join=False)
+		await self.server.join(b, ROOM)
+		self.assertEqual([p["data"] for p in frames(self.server, b)[1]["payload"]], ["0", "1", "2", "3"])
+
+	async def test_oldest_events_are_dropped(self):
+		self.server.rooms[ROOM].history = deque(self.server.rooms[ROOM].history, maxlen=2)
+		await self.server._on_message(self.a, {"room": ROOM, "type": "msg", "data": "3", "time": 3.0})
+		self.assertEqual([p["data"] for p in self.server.history(ROOM)], ["2", "3"])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,107 @@
+import asyncio
+import unittest
+from server import Server
+from tests.support import Client, server, login, settle
+
+
+class NickTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server()
+
+	async def test_find(self):
+		a = await login(self.server, "A")
+		self.assertIs(self.server.find("A"), a)
+		self.assertIsNone(self.server.find("B"))
+		self.server.rename(a, "B")
+		self.assertIsNone(self.server.find("A"))
+		self.assertIs(self.server.find("B"), a)
+		await self.server.disconnect(a)
+		self.assertEqual(self.server.nicks, {})
+
+	async def test_shared_nick(self):
+		first = await login(self.server, "dup")
+		second = await login(self.server, "dup")
+		self.assertIs(self.server.find("dup"), second)  # the latest one
+		await self.server.disconnect(second)
+		self.assertIs(self.server.find("dup"), first)
+		second = await login(self.server, "dup")
+		await self.server.disconnect(first)
+		self.assertIs(self.server.find("dup"), second)
+		await self.server.disconnect(second)
+		self.assertIsNone(self.server.find("dup"))
+
+	async def test_kick_by_nick(self):
+		a = await login(self.server, "A")
+		self.assertTrue(await self.server.kick("A"))
+		self.assertFalse(self.server.in_room(a, Server.DEFAULT_ROOM))
+		self.assertFalse(await self.server.kick("nobody"))
+
+
+class LoginTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server()
+		self.client = Client()
+		self.task = asyncio.ensure_future(self.server._connection(self.client, "/"))
+		await settle()
+
+	async def asyncTearDown(self):
+		self.client.say(None)
+		await self.task
+		self.assertEqual(self.server.users, {})
+		self.assertEqual(self.server.nicks, {})
+
+	async def test_login(self):
+		self.client.say({"system": "login", "options": {"user": "A", "pass": ""}})
+		await settle()
+		self.assertEqual(self.client.codes(), [202])
+		self.assertIs(self.server.find("A"), self.client)
+
+	async def test_nick_that_is_not_a_string(self):
+		for nick in ([1], {"a": 1}, 5, None):
+			self.client.say({"system": "login", "options": {"user": nick, "pass": ""}})
+			await settle()
+			self.assertEqual(self.client.codes(), [400])
+		self.assertFalse(self.server.users[self.client].auth)
+		self.assertIsNone(self.client.closed)
+
+	async def test_user_is_removed_even_if_disconnecting_fails(self):
+		self.client.say({"system": "login", "options": {"user": "A", "pass": ""}})
+		await settle()
+
+		async def broken(user):
+			raise RuntimeError("broken")
+		self.server.disconnect = broken
+
+
+class IdTest(unittest.IsolatedAsyncioTestCase):
+
+	async def test_room_ids_are_reused(self):
+		s = server()
+		a = await login(s, "A")
+		for room in ("x", "y", "z"):
+			await s.join(a, room)
+		self.assertEqual({room: s.rooms[room].id for room in s.rooms}, {"lobby": 0, "x": 1, "y": 2, "z": 3})
+		await s.leave(a, "y")
+		self.assertNotIn(2, s.room_ids)
+		await s.join(a, "w")
+		self.assertEqual(s.rooms["w"].id, 2)
+		self.assertEqual(s.room_ids, {room.id: name for name, room in s.rooms.items()})
+
+	async def test_member_ids_are_reused(self):
+		s = server()
+		a, b, c = [await login(s, nick) for nick in "ABC"]
+		members = s.rooms[Server.DEFAULT_ROOM].users
+		self.assertEqual([members[user].id for user in (a, b, c)], [0, 1, 2])
+		await s.leave(b, Server.DEFAULT_ROOM)
+		d = await login(s, "D")
+		self.assertEqual(members[d].id, 1)
+		# every member has its own row of the transform matrix
+		s.transform(d, Server.DEFAULT_ROOM, {"pos": {"x": 4.0}})
+		self.assertEqual(members[d].values.tolist(), [4.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+		self.assertEqual(members[c].values.tolist(), [0.0] * 6)
+
+
+if __name__ == "__main__":
+	unittest.main()
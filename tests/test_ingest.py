@@ -0,0 +1,105 @@
+import math
+import unittest
+import wire
+from server import Server, User
+from tests.support import server, login, frames
+
+LOBBY = Server.DEFAULT_ROOM
+
+
+class TokenBucketTest(unittest.TestCase):
+
+	def test_burst_then_rate(self):
+		user = User("127.0.0.1", "", None, burst=3)
+		self.assertEqual([user.allow(10, 3) for i in range(4)], [True, True, True, False])
+		self.assertEqual(user.throttled, 1)
+		user.refilled -= 0.1  # a token is added every 0.1 seconds
+		self.assertEqual([user.allow(10, 3) for i in range(2)], [True, False])
+
+	def test_tokens_do_not_exceed_the_burst(self):
+		user = User("127.0.0.1", "", None, burst=3)
+		user.refilled -= 3600
+		self.assertEqual(sum(user.allow(10, 3) for i in range(10)), 3)
+		self.assertEqual(user.throttled, 7)
+
+
+class IngestTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server()
+		self.a = await login(self.server, "A")
+		self.room = self.server.rooms[LOBBY]
+
+	def codes(self, user):
+		return [frame["response"]["code"] for frame in frames(self.server, user) if "response" in frame]
+
+	async def ingest(self, message, user=None):
+		user = self.a if user is None else user
+		await self.server.ingest(user, message)
+		return self.codes(user)
+
+	async def test_transforms_are_stored(self):
+		self.assertEqual(await self.ingest({"room": LOBBY, "data": {"pos": {"x": 1, "y": 2.5}, "rot": {"z": -90}}}), [])
+		self.assertEqual(list(self.room.users[self.a].values), [1.0, 2.5, 0.0, 0.0, 0.0, -90.0])
+		self.assertEqual(self.server.users[self.a].accepted, 1)
+
+	async def test_invalid_transforms(self):
+		stranger = await login(self.server, "B", join=False)
+		self.assertEqual(await self.ingest({"room": LOBBY, "data": {}}, stranger), [401])
+		self.server.users[stranger].auth = False
+		self.assertEqual(await self.ingest({"room": LOBBY, "data": {}}, stranger), [403])
+		for message, code in (
+				({"data": {}}, 400),
+				({"room": LOBBY}, 400),
+				({"room": [], "data": {}}, 401),
+				({"room": "other", "data": {}}, 401),
+				({"room": LOBBY, "data": []}, 406),
+				({"room": LOBBY, "data": {"pos": []}}, 406),
+				({"room": LOBBY, "data": {"pos": {"x": "1"}}}, 406),
+				({"room": LOBBY, "data": {"pos": {"x": True}}}, 406),
+				({"room": LOBBY, "data": {"rot": {"y": math.nan}}}, 406),
+				({"room": LOBBY, "data": {"rot": {"y": 1e300}}}, 406)):
+			self.server.users[self.a].tokens = 1.0
+			self.assertEqual(await self.ingest(message), [code], message)
+		self.assertEqual(list(self.room.users[self.a].values), [0.0] * 6)
+		self.assertEqual(self.server.users[self.a].accepted, 0)
+
+	async def test_throttled_transforms_are_dropped_silently(self):
+		for i in range(self.server.TRANSFORM_BURST + 5):
+			self.assertEqual(await self.ingest({"room": LOBBY, "data": {"pos": {"x": i}}}), [])
+		self.assertEqual(self.room.users[self.a].values[0], self.server.TRANSFORM_BURST - 1)
+		rates = self.server.rates()[id(self.a)]
+		self.assertEqual((rates["nick"], rates["accepted"], rates["throttled"]), ("A", self.server.TRANSFORM_BURST, 5))
+		self.assertEqual(self.server.metrics.throttled.values, {(): 5})
+
+	async def test_no_rate_limit(self):
+		self.server.transform_rate = 0
+		for i in range(self.server.TRANSFORM_BURST + 5):
+			await self.ingest({"room": LOBBY, "data": {"pos": {"x": i}}})
+		self.assertEqual(self.room.users[self.a].values[0], self.server.TRANSFORM_BURST + 4)
+		self.assertEqual(self.server.users[self.a].throttled, 0)
+
+	async def test_binary_transforms(self):
+		transform = {"pos": {"x": 1.0, "y": 2.0, "z": 3.0}, "rot": {"x": 0.0, "y": 90.0, "z": 0.0}}
+		await self.server.receive_transform(self.a, wire.pack_transform(self.room.id, transform))
+		self.assertEqual(self.codes(self.a), [])
+		self.assertEqual(list(self.room.users[self.a].values), [1.0, 2.0, 3.0, 0.0, 90.0, 0.0])
+		for data, code in (
+				(wire.INBOUND["float32"].pack(wire.TRANSFORM, 0, self.room.id, math.nan, 0, 0, 0, 0, 0), 406),
+				(b"\x01\x00", 406),
+				(wire.pack_transform(self.room.id + 1, transform), 401)):
+			await self.server.receive_transform(self.a, data)
+			self.assertEqual(self.codes(self.a), [code])
+		self.assertEqual(self.server.users[self.a].accepted, 1)
+
+	async def test_transform(self):
+		self.server.transform(self.a, LOBBY, [1, 2, 3, 4, 5, 6])
+		self.assertEqual(list(self.room.users[self.a].values), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+		for transform in ({"pos": {"x": math.inf}}, [1, 2, 3], [1, 2, 3, 4, 5, "6"]):
+			with self.assertRaises(ValueError):
+				self.server.transform(self.a, LOBBY, transform)
+		self.assertEqual(list(self.room.users[self.a].values), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+
+
+if __name__ == "__main__":
+	unittest.main()
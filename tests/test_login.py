@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+import wire
+from server import Server
+from tests.support import Client, server, settle
+
+
+class LoginTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server()
+		self.client = Client()
+		self.task = asyncio.ensure_future(self.server._connection(self.client, "/"))
+		await settle()
+
+	async def asyncTearDown(self):
+		self.client.say(None)
+		await self.task
+
+	async def login(self, options):
+		self.client.say({"system": "login", "options": options})
+		await settle()
+		return self.client.codes()
+
+	async def test_wire_formats(self):
+		for encoding in ("json", *wire.ENCODINGS):
+			self.assertEqual((await self.login({"user": "A", "pass": "", "wire": encoding}))[0], 202)
+			self.assertEqual(self.server.users[self.client].wire, None if encoding == "json" else encoding)
+
+	async def test_binary_transforms_after_login(self):
+		self.assertEqual((await self.login({"user": "A", "pass": "", "wire": "int16"}))[:2], [202, 213])
+		await self.server.headsets([Server.DEFAULT_ROOM])
+		await settle()
+		frames = [wire.unpack(data) for data in self.client.sent if type(data) is bytes]
+		self.assertEqual([p["user"] for frame in frames for p in frame["payload"]], [0])
+
+	async def test_invalid_options(self):
+		for options in ([], "A", None, {"user": "A", "pass": "", "wire": [1]}, {"user": "A", "pass": "", "wire": "int8"}, {"user": "A"}):
+			self.assertEqual(await self.login(options), [400], options)
+		self.client.say({"system": "login"})
+		await settle()
+		self.assertEqual(self.client.codes(), [400])
+		self.assertFalse(self.server.users[self.client].auth)
+		self.assertIsNone(self.client.closed)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,102 @@
+import asyncio
+import unittest
+from metrics import Registry
+
+
+class RenderTest(unittest.TestCase):
+
+	def setUp(self):
+		self.registry = Registry("test")
+
+	def test_counters_and_gauges(self):
+		sent = self.registry.counter("sent_total", "Frames sent.", ("type",))
+		sent.inc("transform")
+		sent.inc("transform")
+		sent.add(3, "message")
+		self.registry.gauge("users", "Users.").set(1.5)
+		self.assertEqual(self.registry.render(), "\n".join([
+			"# HELP test_sent_total Frames sent.",
+			"# TYPE test_sent_total counter",
+			'test_sent_total{type="transform"} 2',
+			'test_sent_total{type="message"} 3',
+			"# HELP test_users Users.",
+			"# TYPE test_users gauge",
+			"test_users 1.5"
+		]) + "\n")
+
+	def test_label_values_are_escaped(self):
+		self.registry.gauge("rooms", "Rooms.", ("room",)).set(1, 'a"b\\c\nd')
+		self.assertIn('test_rooms{room="a\\"b\\\\c\\nd"} 1', self.registry.render().splitlines())
+
+	def test_histograms(self):
+		latency = self.registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 0.01))
+		latency.observe(0.005)
+		latency.observe(0.01)
+		latency.observe(0.5)
+		self.assertEqual(self.registry.render().splitlines()[2:], [
+			'test_latency_seconds_bucket{le="0.01"} 2',
+			'test_latency_seconds_bucket{le="0.1"} 2',
+			'test_latency_seconds_bucket{le="+Inf"} 3',
+			"test_latency_seconds_sum 0.515",
+			"test_latency_seconds_count 3"
+		])
+
+	def test_functions_are_called_when_rendering(self):
+		users = {}
+		self.registry.gauge("users", "Users.", function=lambda: len(users))
+		self.registry.gauge("queued", "Queued.", ("nick", "room"), function=lambda: {("A", "lobby"): 4})
+		self.registry.counter("ticks_total", "Ticks.", ("kind",), function=lambda: {"late": 1})
+		users["A"] = None
+		self.assertEqual([line for line in self.registry.render().splitlines() if not line.startswith("#")], [
+			"test_users 1",
+			'test_queued{nick="A",room="lobby"} 4',
+			'test_ticks_total{kind="late"} 1'
+		])
+
+	def test_remove(self):
+		gauge = self.registry.gauge("users", "Users.", ("room",))
+		gauge.set(1, "a")
+		gauge.set(2, "b")
+		gauge.remove("a")
+		gauge.remove("missing")
+		self.assertEqual(gauge.values, {("b",): 2})
+
+
+class ServeTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.registry = Registry("test")
+		self.registry.counter("requests_total", "Requests.").inc()
+		self.http = await self.registry.serve("127.0.0.1", 0)
+		self.port = self.http.sockets[0].getsockname()[1]
+
+	async def asyncTearDown(self):
+		self.http.close()
+		await self.http.wait_closed()
+
+	async def get(self, request):
+		reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+		writer.write(request)
+		response = await asyncio.wait_for(reader.read(), 5.0)
+		writer.close()
+		return response
+
+	async def test_metrics_are_served(self):
+		response = await self.get(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+		self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+		self.assertTrue(response.endswith(b"\r\n\r\n" + self.registry.render().encode()))
+
+	async def test_other_paths_are_not_found(self):
+		response = await self.get(b"GET /other HTTP/1.1\r\n\r\n")
+		self.assertTrue(response.startswith(b"HTTP/1.1 404 Not Found\r\n"))
+
+	async def test_silent_clients_are_closed(self):
+		self.registry.TIMEOUT = 0.05
+		reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+		writer.write(b"GET /metrics HTTP/1.1\r\n")  # the headers never end
+		self.assertEqual(await asyncio.wait_for(reader.read(), 5.0), b"")
+		writer.close()
+
+
+if __name__ == "__main__":
+	unittest.main()
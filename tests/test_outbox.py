@@ -0,0 +1,100 @@
+import asyncio
+import unittest
+from server import Frame, Outbox
+from tests.support import server, login, events
+
+ROOM = "lobby"
+
+
+def transforms(*users, room=ROOM):
+	return Frame({"info": "user", "room": room, "payload": [{"user": user, "type": "transform", "data": i} for i, user in users]}, "transform", room)
+
+
+def message(data, kind="msg"):
+	return Frame({"info": "user", "room": ROOM, "payload": [{"user": "A", "type": kind, "data": data}]}, kind, ROOM)
+
+
+class OutboxTest(unittest.TestCase):
+
+	def test_put_and_peak(self):
+		outbox = Outbox(2)
+		outbox.put(message("1"))
+		self.assertFalse(outbox.full())
+		outbox.put(message("2"))
+		self.assertTrue(outbox.full())
+		self.assertEqual((len(outbox), outbox.peak), (2, 2))
+		outbox.clear()
+		self.assertEqual((len(outbox), outbox.peak, outbox.dropped), (0, 2, 2))
+
+	def test_coalesce_keeps_latest_event_of_every_user(self):
+		outbox = Outbox(2)
+		first = transforms((1, "A"), (1, "B"))
+		outbox.put(first)
+		outbox.put(message("1"))
+		self.assertTrue(outbox.coalesce(transforms((2, "B"), (2, "C"))))
+		merged = outbox.frames[0]
+		self.assertEqual([(p["user"], p["data"]) for p in merged.message["payload"]], [("A", 1), ("B", 2), ("C", 2)])
+		self.assertEqual(merged.created, first.created)
+		self.assertEqual((len(outbox), outbox.coalesced), (2, 1))
+
+	def test_coalesce_only_into_same_kind_and_room(self):
+		outbox = Outbox(2)
+		outbox.put(message("1"))
+		outbox.put(transforms((1, "A"), room="other"))
+		self.assertFalse(outbox.coalesce(transforms((2, "A"))))
+		self.assertEqual(outbox.coalesced, 0)
+
+
+class QueuePolicyTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server(queue_size=2)
+		self.user = await login(self.server, "A")
+		self.outbox = self.server.users[self.user].outbox
+
+	async def test_transforms_are_coalesced_when_full(self):
+		await self.server.post(self.user, transforms((1, "A")))
+		await self.server.post(self.user, transforms((1, "B")))
+		self.assertTrue(await self.server.post(self.user, transforms((2, "A"))))
+		self.assertEqual(len(self.outbox), 2)
+		self.assertEqual(events(self.server, self.user), [[("transform", 1)], [("transform", 1), ("transform", 2)]])
+		self.assertEqual(self.outbox.dropped, 0)
+
+	async def test_transforms_are_dropped_without_one_to_merge_into(self):
+		await self.server.post(self.user, message("1"))
+		await self.server.post(self.user, message("2"))
+		self.assertFalse(await self.server.post(self.user, transforms((1, "A"))))
+		self.assertEqual(self.outbox.dropped, 1)
+		self.assertEqual(events(self.server, self.user), [[("msg", "1")], [("msg", "2")]])
+		self.assertIsNone(self.user.closed)
+
+	async def test_drop_policy(self):
+		self.server.QUEUE_POLICY = {"button": "drop"}
+		await self.server.post(self.user, message("1"))
+		await self.server.post(self.user, message("2"))
+		self.assertFalse(await self.server.post(self.user, message("3", "button")))
+		self.assertEqual(self.outbox.dropped, 1)
+		self.assertEqual(events(self.server, self.user), [[("msg", "1")], [("msg", "2")]])
+		self.assertIsNone(self.user.closed)
+
+	async def test_disconnect_policy(self):
+		await self.server.post(self.user, message("1"))
+		await self.server.post(self.user, message("2"))
+		self.assertFalse(await self.server.post(self.user, message("3")))
+		self.assertTrue(self.outbox.closing)
+		self.assertEqual((len(self.outbox), self.outbox.dropped), (0, 3))
+		self.assertEqual(self.server.metrics.dropped.values[("disconnect",)], 3)
+		await asyncio.sleep(0)
+		self.assertEqual(self.user.closed, 1008)
+		# nothing is queued for a connection that is being closed
+		self.assertFalse(await self.server.post(self.user, message("4")))
+		self.assertEqual(len(self.outbox), 0)
+
+	async def test_frames_are_queued_while_there_is_room(self):
+		self.assertTrue(await self.server.post(self.user, message("1")))
+		self.assertTrue(await self.server.post(self.user, {"info": "system", "response": {}}))
+		self.assertEqual([frame.kind for frame in self.outbox.frames], ["msg", "system"])
+
+
+if __name__ == "__main__":
+	unittest.main()
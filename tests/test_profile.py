@@ -0,0 +1,57 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from tests.support import Client, server, settle
+
+
+class ProfileTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.server = server(admin_pass="jelszó", profile_dir=self.directory.name)
+		self.client = Client()
+		self.task = asyncio.ensure_future(self.server._connection(self.client, "/"))
+
+	async def asyncTearDown(self):
+		self.client.say(None)
+		await self.task
+		if self.server.profiler:
+			self.server.profiler.cancel()
+		self.directory.cleanup()
+
+	async def say(self, message):
+		self.client.say(message)
+		await settle()
+		return self.client.codes()
+
+	async def login(self, password):
+		self.assertEqual((await self.say({"system": "login", "options": {"user": "A", "pass": password}}))[0], 202)
+
+	async def test_only_admins_can_profile(self):
+		await self.login("jelszo")
+		self.assertEqual(self.server.users[self.client].level, "user")
+		self.assertEqual(await self.say({"system": "profile"}), [403])
+		self.assertIsNone(self.server.profiler)
+
+	async def test_invalid_options(self):
+		await self.login("jelszó")
+		self.assertEqual(self.server.users[self.client].level, "admin")
+		for options in ([], "10", None, {"seconds": "10"}, {"seconds": -1}, {"seconds": True}, {"seconds": [1]}):
+			self.assertEqual(await self.say({"system": "profile", "options": options}), [400], options)
+		self.assertIsNone(self.server.profiler)
+		self.assertIsNone(self.client.closed)
+
+	async def test_profile_is_saved(self):
+		await self.login("jelszó")
+		self.assertEqual(await self.say({"system": "profile", "options": {"seconds": 10}}), [200])
+		self.assertEqual(await self.say({"system": "profile", "options": {"seconds": 10}}), [409])
+		profiler = self.server.profiler
+		self.assertEqual(await self.say({"system": "profile", "options": {"seconds": 0}}), [200])
+		await profiler
+		self.assertIsNone(self.server.profiler)
+		self.assertEqual(len([name for name in os.listdir(self.directory.name) if name.endswith(".prof")]), 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,93 @@
+import json
+import os
+import tempfile
+import unittest
+import recorder
+from recorder import TransformRecorder
+from server import Server
+from tests.support import server, login
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def records(directory):
+	''' Read every record of a recording without NumPy '''
+	result = []
+	for name in sorted(os.listdir(directory)):
+		if name.endswith(".bin"):
+			start, count = recorder.read_header(os.path.join(directory, name))
+			with open(os.path.join(directory, name), "rb") as f:
+				f.seek(recorder.HEADER_SIZE)
+				result += list(recorder.RECORD.iter_unpack(f.read(count * recorder.RECORD.size)))
+	return result
+
+
+class RecorderTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = self.directory.name
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_records_are_split_into_chunks(self):
+		r = TransformRecorder(self.path, chunk=3, block=recorder.RECORD.size * 2)
+		for i in range(7):
+			r.write(100.0 + i, "lobby", 1, "A", "1.2.3.4", (i, 1.5, -2.0, 0.0, 90.0, 0.0))
+		r.close()
+		self.assertEqual(sorted(name for name in os.listdir(self.path) if name.endswith(".bin")),
+						 ["transforms_000000.bin", "transforms_000001.bin", "transforms_000002.bin"])
+		self.assertEqual([record[0] for record in records(self.path)], [100.0 + i for i in range(7)])
+		self.assertEqual(records(self.path)[6][3:], (6.0, 1.5, -2.0, 0.0, 90.0, 0.0))
+		self.assertEqual(r.stats(), {"queued": 0, "written": 7, "dropped": 0})
+
+	def test_connections_sharing_nick_and_ip_are_separate_users(self):
+		r = TransformRecorder(self.path)
+		r.write(1.0, "lobby", 1, "A", "1.2.3.4", (0.0,) * 6)
+		r.write(1.0, "lobby", 2, "A", "1.2.3.4", (1.0,) * 6)
+		r.write(2.0, "lobby", 1, "A", "1.2.3.4", (2.0,) * 6)
+		r.close()
+		self.assertEqual([record[2] for record in records(self.path)], [0, 1, 0])
+		with open(os.path.join(self.path, "index.json"), encoding="utf-8") as f:
+			index = json.load(f)
+		self.assertEqual(index["users"], {
+			"0": {"nick": "A", "ip": "1.2.3.4", "connection": 1},
+			"1": {"nick": "A", "ip": "1.2.3.4", "connection": 2}
+		})
+
+	def test_values_beyond_float32_are_dropped(self):
+		r = TransformRecorder(self.path)
+		r.write(1.0, "lobby", 1, "A", "1.2.3.4", (1e39, 0.0, 0.0, 0.0, 0.0, 0.0))
+		r.write(2.0, "lobby", 1, "A", "1.2.3.4", (1.0, 0.0, 0.0, 0.0, 0.0, 0.0))
+		r.close()
+		self.assertEqual([record[0] for record in records(self.path)], [2.0])
+		self.assertEqual(r.stats()["dropped"], 1)
+
+	@unittest.skipIf(numpy is None, "NumPy is not installed")
+	def test_load(self):
+		r = TransformRecorder(self.path, chunk=2)
+		for i in range(3):
+			r.write(float(i), "lobby", 1, "A", "1.2.3.4", (i, 0.0, 0.0, 0.0, 0.0, float(i)))
+		r.close()
+		loaded, index = recorder.load(self.path)
+		self.assertEqual(loaded["pos"][:, 0].tolist(), [0.0, 1.0, 2.0])
+		self.assertEqual(loaded["rot"][:, 2].tolist(), [0.0, 1.0, 2.0])
+		self.assertEqual(index["rooms"], {"0": "lobby"})
+
+
+class ServerRecordingTest(unittest.IsolatedAsyncioTestCase):
+
+	async def test_headsets_of_every_connection_are_recorded_apart(self):
+		with tempfile.TemporaryDirectory() as path:
+			s = server(record_dir=path)
+			a = await login(s, "A")
+			b = await login(s, "A")  # same nick, from the same address
+			s.transform(a, Server.DEFAULT_ROOM, {"pos": {"x": 1.0}})
+			s.transform(b, Server.DEFAULT_ROOM, {"pos": {"x": 2.0}})
+			await s.headsets([Server.DEFAULT_ROOM])
+			s.recorder.close()
+			self.assertEqual(sorted((record[2], record[3]) for record in records(path)), [(0, 1.0), (1, 2.0)])
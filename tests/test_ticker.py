@@ -0,0 +1,94 @@
+import time
+import unittest
+from unittest import mock
+from server import Server, Ticker
+from tests.support import server, login
+
+
+class TickerTest(unittest.TestCase):
+
+	def ticker(self, fps=10, deadline=100.0):
+		ticker = Ticker(fps)
+		ticker.deadline = deadline
+		return ticker
+
+	def test_on_time(self):
+		ticker = self.ticker()
+		ticker.done(100.0, 100.01, 1)
+		self.assertAlmostEqual(ticker.deadline, 100.1)
+		self.assertEqual((ticker.tics, ticker.skipped), (1, 0))
+
+	def test_deadlines_do_not_drift(self):
+		ticker = self.ticker()
+		for i in range(100):
+			start = ticker.deadline + 0.003  # every tic starts a bit late
+			ticker.done(start, start + 0.01, 1)
+		self.assertAlmostEqual(ticker.deadline, 110.0)
+		self.assertEqual(ticker.skipped, 0)
+
+	def test_late_tics_catch_up(self):
+		ticker = self.ticker()
+		ticker.done(100.15, 100.16, 1)  # one tic missed, it runs right away
+		self.assertAlmostEqual(ticker.deadline, 100.1)
+		self.assertEqual(ticker.skipped, 0)
+
+	def test_tics_beyond_catchup_are_skipped(self):
+		ticker = self.ticker()
+		ticker.done(100.55, 100.56, 1)  # deadlines at 100.1 ... 100.5 were missed
+		self.assertAlmostEqual(ticker.deadline, 100.4)
+		self.assertEqual(ticker.skipped, 3)
+		ticker = self.ticker()
+		ticker.done(100.3, 100.31, 1)  # 100.1 and 100.2 were missed, only one of them runs late
+		self.assertAlmostEqual(ticker.deadline, 100.2)
+		self.assertEqual(ticker.skipped, 1)
+		ticker = self.ticker()
+		ticker.done(100.55, 100.56, 0)
+		self.assertAlmostEqual(ticker.deadline, 100.5)
+		self.assertEqual(ticker.skipped, 4)
+
+	def test_stats(self):
+		ticker = self.ticker()
+		ticker.done(100.02, 100.03, 1)
+		ticker.done(100.1, 100.14, 1)
+		stats = ticker.stats()
+		self.assertEqual((stats["fps"], stats["tics"], stats["skipped"]), (10.0, 2, 0))
+		self.assertAlmostEqual(stats["duration"], 0.025)
+		self.assertAlmostEqual(stats["duration_max"], 0.04)
+		self.assertAlmostEqual(stats["jitter"], 0.01)
+		self.assertAlmostEqual(stats["jitter_max"], 0.02)
+		self.assertEqual(Ticker(10).stats()["duration"], 0.0)
+
+
+class KeyframeTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.server = server()
+		self.a = await login(self.server, "A")
+		self.b = await login(self.server, "B")
+		self.room = self.server.rooms[Server.DEFAULT_ROOM]
+
+	def sent(self):
+		return sorted({p["user"] for frame in self.server.users[self.b].outbox.frames for p in frame.message["payload"]})
+
+	async def tic(self):
+		self.server.users[self.b].outbox.frames.clear()
+		await self.server.headsets([Server.DEFAULT_ROOM])
+		return self.sent()
+
+	async def test_only_moved_headsets_are_sent_between_keyframes(self):
+		self.assertEqual(await self.tic(), ["A", "B"])  # keyframe after joining
+		self.assertEqual(await self.tic(), [])
+		self.server.transform(self.a, Server.DEFAULT_ROOM, {"pos": {"x": 1.0}})
+		self.assertEqual(await self.tic(), ["A"])
+		self.room.keyframe -= self.server.KEYFRAME_INTERVAL
+		self.assertEqual(await self.tic(), ["A", "B"])
+
+	async def test_keyframes_do_not_depend_on_the_system_clock(self):
+		await self.tic()
+		with mock.patch("time.time", return_value=time.time() - 3600):  # clock set back an hour
+			self.room.keyframe -= self.server.KEYFRAME_INTERVAL
+			self.assertEqual(await self.tic(), ["A", "B"])
+
+
+if __name__ == "__main__":
+	unittest.main()
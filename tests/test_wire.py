@@ -0,0 +1,91 @@
+import math
+import struct
+import unittest
+import wire
+
+TRANSFORM = {"pos": {"x": 1.5, "y": -2.25, "z": 3.0}, "rot": {"x": 10.0, "y": -90.5, "z": 179.0}}
+
+
+class PackTest(unittest.TestCase):
+
+	def message(self):
+		return {"room": 7, "time": 1568979503.25, "payload": [
+			{"user": 1, "data": TRANSFORM},
+			{"user": 65535, "data": [0.5, 0.0, -0.5, 0.0, 45.0, -45.0]}
+		]}
+
+	def test_float32_round_trip(self):
+		frame = wire.unpack(wire.pack(self.message(), "float32"))
+		self.assertEqual((frame["room"], frame["time"]), (7, 1568979503.25))
+		self.assertEqual([p["user"] for p in frame["payload"]], [1, 65535])
+		self.assertEqual(frame["payload"][0]["data"], TRANSFORM)  # all of these are exact in float32
+		self.assertEqual(wire.flatten(frame["payload"][1]["data"]), [0.5, 0.0, -0.5, 0.0, 45.0, -45.0])
+
+	def test_int16_round_trip(self):
+		frame = wire.unpack(wire.pack(self.message(), "int16"))
+		for sent, received in zip(wire.flatten(TRANSFORM), wire.flatten(frame["payload"][0]["data"])):
+			self.assertAlmostEqual(sent, received, delta=0.01)
+
+	def test_int16_clamps_positions_and_wraps_rotations(self):
+		values = wire.dequantize(wire.quantize([40.0, -40.0, 0.0, 190.0, -190.0, 360.0]))
+		self.assertAlmostEqual(values[0], wire.LIMIT / wire.POS_SCALE)
+		self.assertAlmostEqual(values[1], -wire.LIMIT / wire.POS_SCALE)
+		self.assertAlmostEqual(values[3], -170.0, delta=0.01)
+		self.assertAlmostEqual(values[4], 170.0, delta=0.01)
+		self.assertAlmostEqual(values[5], 0.0, delta=0.01)
+
+	def test_frame_size(self):
+		data = wire.pack(self.message(), "float32")
+		self.assertEqual(len(data), wire.HEADER.size + 2 * wire.RECORDS["float32"].size)
+
+	def test_unpack_rejects_invalid_frames(self):
+		data = wire.pack(self.message(), "float32")
+		for invalid in (data[:-1], data + b"\0", b"", bytes([2]) + data[1:], data[:1] + bytes([9]) + data[2:]):
+			with self.assertRaises(ValueError):
+				wire.unpack(invalid)
+
+
+class InboundTest(unittest.TestCase):
+
+	def test_round_trip(self):
+		for encoding in wire.ENCODINGS:
+			room, values = wire.unpack_values(wire.pack_transform(3, TRANSFORM, encoding))
+			self.assertEqual(room, 3)
+			for sent, received in zip(wire.flatten(TRANSFORM), values):
+				self.assertAlmostEqual(sent, received, delta=0.01)
+			self.assertEqual(wire.unpack_transform(wire.pack_transform(3, TRANSFORM, encoding))[0], 3)
+
+	def test_rejects_invalid_transforms(self):
+		data = wire.pack_transform(3, TRANSFORM)
+		for invalid in (data[:-1], b"\x01", b"", bytes([2]) + data[1:], data[:1] + bytes([9]) + data[2:]):
+			with self.assertRaises(ValueError):
+				wire.unpack_values(invalid)
+
+	def test_rejects_coordinates_that_are_not_finite(self):
+		for value in (math.nan, math.inf, -math.inf):
+			with self.assertRaises(ValueError):
+				wire.unpack_values(wire.INBOUND["float32"].pack(wire.TRANSFORM, 0, 3, 0.0, value, 0.0, 0.0, 0.0, 0.0))
+
+
+class ValuesTest(unittest.TestCase):
+
+	def test_missing_coordinates_are_zero(self):
+		self.assertEqual(wire.values({"pos": {"x": 1, "z": 2.5}}), (1.0, 0.0, 2.5, 0.0, 0.0, 0.0))
+		self.assertEqual(wire.values({}), (0.0,) * 6)
+
+	def test_rejects_values_that_are_not_finite_numbers(self):
+		for value in ("1.5", "nan", True, None, [], math.nan, math.inf, 1e39, 10 ** 400):
+			with self.assertRaises(ValueError, msg=repr(value)):
+				wire.values({"pos": {"x": value}})
+		self.assertEqual(wire.number(-wire.FLOAT32_MAX), -wire.FLOAT32_MAX)
+		struct.pack("<f", wire.number(wire.FLOAT32_MAX))  # fits float32
+
+	def test_checked(self):
+		self.assertEqual(wire.checked((1, 2, 3, 4, 5, 6)), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+		for invalid in ((1, 2, 3), (0, 0, 0, 0, 0, math.nan)):
+			with self.assertRaises(ValueError):
+				wire.checked(invalid)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+''' Compact binary wire format for headset transforms
+
+Clients can ask for it when logging in ({"wire": "float32"} or {"wire": "int16"} in "options"),
+everything other than transforms is still sent as JSON.
+
+Server to client (one frame per room per tic):
+	header:  kind (uint8), encoding (uint8), room id (uint16), number of users (uint16), server time (float64)
+	records: user id (uint16), pos x, y, z, rot x, y, z (float32 or int16 each)
+
+Client to server (one transform):
+	kind (uint8), encoding (uint8), room id (uint16), pos x, y, z, rot x, y, z (float32 or int16 each)
+
+Room and user ids are sent as JSON system messages (code 213) whenever someone joins or leaves.
+All values are little-endian. int16 positions are in millimeters, int16 rotations cover -180..180 degrees.
+
+'''
+
+import math
+import struct
+
+TRANSFORM = 1
+ENCODINGS = {"float32": 0, "int16": 1}
+NAMES = {code: name for name, code in ENCODINGS.items()}
+
+HEADER = struct.Struct("<BBHHd")
+RECORDS = {"float32": struct.Struct("<H6f"), "int16": struct.Struct("<H6h")}
+INBOUND = {"float32": struct.Struct("<BBH6f"), "int16": struct.Struct("<BBH6h")}
+
+POS_SCALE = 1000.0
+ROT_SCALE = 32767 / 180.0
+LIMIT = 32767
+FLOAT32_MAX = 3.4028234663852886e38  # coordinates are sent and recorded as float32
+EMPTY = {}  # stands in for "pos" or "rot" missing from a transform
+
+
+def flatten(transform):
+	''' Return transform dict as a list of 6 floats (pos x, y, z, rot x, y, z) '''
+	return [float(transform[key][cord]) for key in ("pos", "rot") for cord in ("x", "y", "z")]
+
+
+def number(value):
+	''' Return a coordinate sent by a client as a float, ValueError if it is not a finite int or float that fits float32 '''
+	if type(value) is not float and type(value) is not int:  # not bool or str, float("nan") would accept those
+		raise ValueError(f"coordinate is not a number: {value!r}")
+	if not abs(value) <= FLOAT32_MAX:  # also false for NaN
+		raise ValueError(f"coordinate is not finite or too large: {value!r}")
+	return float(value)
+
+
+def values(transform):
+	''' Return the 6 floats of a transform dict sent by a client, missing coordinates are 0 (ValueError if one is not a number) '''
+	pos = transform.get("pos", EMPTY)
+	rot = transform.get("rot", EMPTY)
+	return (number(pos.get("x", 0)), number(pos.get("y", 0)), number(pos.get("z", 0)),
+			number(rot.get("x", 0)), number(rot.get("y", 0)), number(rot.get("z", 0)))
+
+
+def checked(values):
+	''' Return a sequence of 6 coordinates as floats, ValueError if there are not 6 or one is not a number '''
+	if len(values) != 6:
+		raise ValueError(f"transform has {len(values)} values instead of 6")
+	return [number(v) for v in values]
+
+
+def unflatten(values):
+	''' Return list of 6 floats as a transform dict '''
+	return {
+		"pos": {"x": values[0], "y": values[1], "z": values[2]},
+		"rot": {"x": values[3], "y": values[4], "z": values[5]}
+	}
+
+
+def quantize(values):
+	''' Convert 6 floats to int16 values '''
+	pos = [max(-LIMIT, min(LIMIT, round(v * POS_SCALE))) for v in values[:3]]
+	rot = [round(((v + 180.0) % 360.0 - 180.0) * ROT_SCALE) for v in values[3:]]
+	return pos + rot
+
+
+def dequantize(values):
+	''' Convert 6 int16 values back to floats '''
+	return [v / POS_SCALE for v in values[:3]] + [v / ROT_SCALE for v in values[3:]]
+
+
+def pack(message, encoding):
+	''' Encode {"room": id, "time": t, "payload": [{"user": id, "data": transform or 6 floats}]} as a binary frame '''
+	record = RECORDS[encoding]
+	chunks = [HEADER.pack(TRANSFORM, ENCODINGS[encoding], message["room"], len(message["payload"]), message["time"])]
+	for p in message["payload"]:
+		values = flatten(p["data"]) if type(p["data"]) is dict else p["data"]
+		chunks.append(record.pack(p["user"], *(quantize(values) if encoding == "int16" else values)))
+	return b"".join(chunks)
+
+
+def unpack(data):
+	''' Decode a binary frame into {"room": id, "time": t, "payload": [{"user": id, "data": transform}]} '''
+	try:
+		kind, code, room, count, time = HEADER.unpack_from(data)
+		encoding = NAMES[code]
+		record = RECORDS[encoding]
+		if kind != TRANSFORM or len(data) != HEADER.size + count * record.size:
+			raise ValueError("invalid transform frame")
+		payload = []
+		for user, *values in record.iter_unpack(data[HEADER.size:]):
+			payload.append({"user": user, "data": unflatten(dequantize(values) if encoding == "int16" else values)})
+	except (struct.error, KeyError) as e:
+		raise ValueError(f"invalid transform frame: {e}")
+	return {"room": room, "time": time, "payload": payload}
+
+
+def pack_transform(room, transform, encoding="float32"):
+	''' Encode a single transform sent by a client to a room '''
+	values = flatten(transform)
+	return INBOUND[encoding].pack(TRANSFORM, ENCODINGS[encoding], room, *(quantize(values) if encoding == "int16" else values))
+
+
+def unpack_transform(data):
+	''' Decode a single transform sent by a client, return (room id, transform) '''
+	room, values = unpack_values(data)
+	return room, unflatten(values)
+
+
+def unpack_values(data):
+	''' Decode a single transform sent by a client, return (room id, list of 6 floats) '''
+	try:
+		encoding = NAMES[data[1]]
+		kind, code, room, *values = INBOUND[encoding].unpack(data)
+	except (struct.error, KeyError, IndexError) as e:
+		raise ValueError(f"invalid transform: {e}")
+	if kind != TRANSFORM:
+		raise ValueError(f"invalid transform kind {kind}")
+	if encoding == "int16":
+		return room, dequantize(values)
+	if not all(map(math.isfinite, values)):
+		raise ValueError("invalid transform: coordinate is not finite")
+	return room, values
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+''' Run the server on multiple cores
+
+A gateway accepts every connection on the public port and proxies it to worker processes,
+each running its own Server on a local port. Rooms are assigned to workers by a stable hash
+of their name, so all members of a room always share a worker:
+
+	python workers.py --workers 4 --fps 30
+
+Clients connect to the gateway exactly as they would connect to a single Server. Behind the
+gateway a client has one connection to every worker that runs a room it sent messages to,
+these are opened when they are first needed and logged in with the client's credentials.
+Binary transforms are routed by room id, as workers only hand out ids where
+id % number of workers == index of the worker.
+
+Workers publish the rooms they open and close on a bus (a multiprocessing queue), so the
+gateway can list the rooms of every worker.
+
+'''
+
+import argparse
+import asyncio
+import codec
+import multiprocessing
+import os
+import threading
+import websockets
+import zlib
+from socket import gethostbyname, gethostname
+from compression import Compression
+from server import Server, use_loop
+
+
+def worker_of(room, count):
+	''' Return the index of the worker running "room" (the same in every process, unlike hash()) '''
+	return zlib.crc32(room.encode("utf-8")) % count
+
+
+class Worker(Server):
+
+	def __init__(self, index, count, bus, **options):
+		''' Server running the rooms of worker "index" out of "count", publishing rooms opened and closed on "bus" '''
+		self.index = index
+		self.count = count
+		self.bus = bus
+		# users are logged in to every worker they need, only the lobby's worker makes them join it
+		self.JOIN_DEFAULT_ROOM = self.JOIN_DEFAULT_ROOM and index == worker_of(self.DEFAULT_ROOM, count)
+		super().__init__(**options)
+
+	def _room_id(self):
+		return next(i for i in range(self.index, 65536, self.count) if i not in self.room_ids)
+
+	def open(self, room, payload={}):
+		opened = room not in self.rooms
+		super().open(room, payload)
+		if opened:
+			self.bus.put(("open", self.index, room, self.rooms[room].title))
+
+	async def leave(self, user, room, force=False):
+		opened = room in self.rooms
+		await super().leave(user, room, force)
+		if opened and room not in self.rooms:
+			self.bus.put(("close", self.index, room))
+
+
+class Session:
+
+	__slots__ = ("client", "login", "auth", "upstreams", "pumps", "skip", "deflate")
+
+	def __init__(self, client):
+		''' A client connected to the gateway, with its connections to the workers '''
+		self.client = client
+		self.login = None  # last login message, sent to every worker connected later
+		self.auth = False
+		self.upstreams = {}  # worker index: websocket
+		self.pumps = []
+		self.skip = {}  # worker index: login responses that should not reach the client
+		self.deflate = None  # compression extension of the client's connection
+
+
+class Gateway:
+
+	CONNECT_TIMEOUT = 10.0  # seconds to wait for workers to start
+
+	def __init__(self, ip, port, workers, bus, log_level=3, compression={}):
+		''' Accept connections on ip:port and proxy them to "workers" (list of websocket urls)
+
+		Messages are compressed by the gateway with the same options as a Server's "compression",
+		except that their types are not known, so only "threshold" decides.
+
+		'''
+		self.ip = ip if ip else gethostbyname(gethostname())
+		self.port = port
+		self.workers = workers
+		self.bus = bus
+		self.log_level = log_level
+		self.primary = worker_of(Server.DEFAULT_ROOM, len(workers))  # also handles system commands
+		self.rooms = {}  # room: (title, worker index), as published by the workers
+		self.compression = None if compression is None else Compression(**compression)
+
+	def log(self, msg, level=0):
+		if level <= self.log_level:
+			print(f'{Server.now("%H:%M:%S")} > {msg}')
+
+	async def serve(self):
+		''' Wait for the workers to start, then accept connections until cancelled '''
+		loop = asyncio.get_running_loop()
+		threading.Thread(target=self._listen, args=(loop,), name="Gateway bus", daemon=True).start()
+		for url in self.workers:
+			await self._wait(url)
+		extensions = [self.compression.factory()] if self.compression else None
+		async with websockets.serve(self._connection, self.ip, self.port, compression=None, extensions=extensions):
+			self.log(f"Gateway starting at {self.ip}:{self.port} with {len(self.workers)} workers")
+			await asyncio.Future()
+
+	async def _wait(self, url):
+		deadline = asyncio.get_running_loop().time() + self.CONNECT_TIMEOUT
+		while True:
+			try:
+				ws = await websockets.connect(url)
+				await ws.close()
+				return
+			except OSError:
+				if asyncio.get_running_loop().time() > deadline:
+					raise
+				await asyncio.sleep(0.1)
+
+	def _listen(self, loop):
+		''' Hand events of the bus over to the event loop '''
+		while True:
+			loop.call_soon_threadsafe(self._event, self.bus.get())
+
+	def _event(self, event):
+		if event[0] == "open":
+			self.rooms[event[2]] = (event[3], event[1])
+		elif event[0] == "close" and self.rooms.get(event[2], (None, None))[1] == event[1]:
+			del self.rooms[event[2]]
+
+	async def _connection(self, client, path):
+		''' Route every message of a client to the worker of its room '''
+		session = Session(client)
+		session.deflate = Compression.extension(client) if self.compression else None
+		ip = client.remote_address[0] if client.remote_address else "0.0.0.0"
+		self.log(f"{ip} connected", 1)
+		try:
+			async for message in client:
+				if type(message) is bytes:
+					# binary transforms start with kind, encoding and the room id (see wire.py)
+					index = int.from_bytes(message[2:4], "little") % len(self.workers) if len(message) >= 4 else self.primary
+					await (await self.upstream(session, index)).send(message)
+					continue
+				try:
+					data = codec.loads(message)
+				except codec.DecodeError:
+					data = None
+				if type(data) is not dict:
+					# malformed, let a worker answer with the usual error
+					await (await self.upstream(session, self.primary)).send(message)
+				elif "system" in data:
+					await self.system(session, data, message)
+				else:
+					room = data.get("room")
+					index = worker_of(room, len(self.workers)) if type(room) is str else self.primary
+					await (await self.upstream(session, index)).send(message)
+		except (websockets.ConnectionClosed, OSError) as e:
+			self.log(f"{ip} lost connection: {e}", 1)
+		finally:
+			self.log(f"{ip} disconnected", 1)
+			await asyncio.gather(*(ws.close() for ws in session.upstreams.values()), return_exceptions=True)
+			await asyncio.gather(*session.pumps, return_exceptions=True)
+
+	async def system(self, session, data, message):
+		''' Log in to every worker connected so far, answer listing rooms, send the rest to the primary worker '''
+		if data["system"] == "login":
+			session.login = message
+			session.auth = False
+			await (await self.upstream(session, self.primary)).send(message)
+			for index, ws in session.upstreams.items():
+				if index != self.primary:
+					session.skip[index] = session.skip.get(index, 0) + 1
+					await ws.send(message)
+		elif data["system"] == "rooms" and session.auth:
+			await session.client.send(codec.dumps({
+				"info": "system",
+				"response": {
+					"time": Server.now(),
+					"code": 212,
+					"msg": Server.SYSTEM_MESSAGES[212],
+					"detail": {room: title for room, (title, index) in self.rooms.items()}
+				}
+			}))
+		else:
+			await (await self.upstream(session, self.primary)).send(message)
+
+	async def upstream(self, session, index):
+		''' Return the connection of a client to a worker, open it (and log in) when it is first needed '''
+		if index not in session.upstreams:
+			ws = await websockets.connect(self.workers[index], max_size=None, compression=None)  # only compressed by the gateway
+			if session.login and index != self.primary:
+				# nothing else can arrive before the response, the client has not joined any room there yet
+				await ws.send(session.login)
+				response = await ws.recv()
+				if codec.loads(response).get("response", {}).get("code") != 202:
+					await session.client.send(response)
+			session.upstreams[index] = ws
+			session.pumps.append(asyncio.ensure_future(self.pump(session, index, ws)))
+		return session.upstreams[index]
+
+	async def pump(self, session, index, ws):
+		''' Forward everything a worker sends to the client, close the client if the worker closes the connection
+
+		Messages are read until the worker's connection is closed, even after the client is gone,
+		otherwise the closing handshake would wait behind unread messages.
+
+		'''
+		try:
+			async for message in ws:
+				if session.client.closed:
+					continue
+				if type(message) is str and (session.skip.get(index) or (index == self.primary and not session.auth)):
+					response = codec.loads(message).get("response", {})
+					if response.get("code") in (202, 400) and session.skip.get(index):
+						session.skip[index] -= 1
+						continue
+					if response.get("code") == 202 and index == self.primary:
+						session.auth = True
+				await self.forward(session, message)
+		except websockets.ConnectionClosed:
+			pass
+		await session.client.close()
+
+	async def forward(self, session, message):
+		try:
+			if session.deflate is not None:
+				session.deflate.compress = self.compression.wants(None, len(message))
+			await session.client.send(message)
+		except websockets.ConnectionClosed:
+			pass
+
+
+def work(index, count, bus, options):
+	''' Run a single worker (in its own process) '''
+	Worker(index, count, bus, **options).run()
+
+
+def serve(workers, ip="", port=42069, worker_port=0, log_level=3, log_file="", record_dir="", **options):
+	''' Start "workers" processes on local ports from "worker_port" (port + 1 by default), then run the gateway
+
+	Other options are passed to every worker's Server. Every worker writes its own event log
+	and recording, the index of the worker is added to "log_file" and "record_dir". Workers
+	serve their metrics on consecutive ports from "metrics_port" (if set).
+
+	'''
+	bus = multiprocessing.Queue()
+	worker_port = worker_port or port + 1
+	processes = []
+	for i in range(workers):
+		worker = {**options, "ip": "127.0.0.1", "port": worker_port + i, "log_level": log_level}
+		if log_file:
+			root, ext = os.path.splitext(log_file)
+			worker["log_file"] = f"{root}_{i}{ext}"
+		if record_dir:
+			worker["record_dir"] = os.path.join(record_dir, f"worker_{i}")
+		if options.get("metrics_port"):
+			worker["metrics_port"] = options["metrics_port"] + i
+		processes.append(multiprocessing.Process(target=work, args=(i, workers, bus, worker), name=f"Worker {i}", daemon=True))
+		processes[-1].start()
+	gateway = Gateway(ip, port, [f"ws://127.0.0.1:{worker_port + i}" for i in range(workers)], bus, log_level, options.get("compression", {}))
+	use_loop(options.get("event_loop", ""))
+	try:
+		asyncio.run(gateway.serve())
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for process in processes:
+			process.terminate()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run the server on multiple cores.")
+	parser.add_argument("--workers", type=int, default=os.cpu_count())
+	parser.add_argument("--ip", default="")
+	parser.add_argument("--port", type=int, default=42069)
+	parser.add_argument("--worker-port", type=int, default=0, help="first local port of the workers (port + 1 by default)")
+	parser.add_argument("--fps", type=float, default=1)
+	parser.add_argument("--log-level", type=int, default=3)
+	parser.add_argument("--log-file", default="")
+	parser.add_argument("--record-dir", default="")
+	parser.add_argument("--metrics-port", type=int, default=0, help="first port of the workers' metrics (not served by default)")
+	args = parser.parse_args()
+
+	serve(args.workers, args.ip, args.port, args.worker_port, args.log_level, args.log_file, args.record_dir,
+		  fps=args.fps, metrics_port=args.metrics_port)